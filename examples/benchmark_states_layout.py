@@ -0,0 +1,128 @@
+"""Benchmark of the storage layouts for the states in collected.hdf5
+
+Writes synthetic states for a small grid with each layout and measures the
+on-disk size and the latency of reading the states of random grid points,
+as done by ScanPlotter.get_states() and the fit only jobs.
+
+Call as:
+    python benchmark_states_layout.py [folder]
+"""
+
+import sys
+import time
+from os import path
+
+import h5py
+import numpy as np
+
+from prince_analysis_tools.collect import (
+    SparseStates,
+    chunk_cache_kwargs,
+    open_states,
+    register_filters,
+    states_dtype,
+    states_layout_kwargs,
+)
+
+# grid and state dimensions, a state has len(known_spec) * egrid.size entries
+grid_shape = (11, 16, 16)
+nspec = 120
+state_shape = (5, nspec * 60)
+nreads = 300
+
+layouts = {
+    "contiguous": {"chunks": None},
+    "point chunks": {"chunks": "point"},
+    "species chunks": {"chunks": "species"},
+    "auto chunks": {"chunks": "auto"},
+    "point chunks, gzip": {"chunks": "point", "compression": "gzip"},
+    "point chunks, lzf": {"chunks": "point", "compression": "lzf"},
+    "point chunks, blosc": {"chunks": "point", "compression": "blosc"},
+    "float32, gzip": {"chunks": "point", "compression": "gzip", "dtype": "float32"},
+    "sparse": {"sparse threshold": 1e-6},
+    "sparse, gzip": {"sparse threshold": 1e-6, "compression": "gzip"},
+}
+
+
+def synthetic_state(rng):
+    """Power laws with a cutoff for the produced species, zero for the others
+
+    Only species lighter than the injected one are produced, as in the
+    disintegration of nuclei
+    """
+    nbins = state_shape[1] // nspec
+    egrid = np.logspace(0, 3, nbins)
+    state = np.zeros((state_shape[0], nspec, nbins))
+    for inj in range(state_shape[0]):
+        lighter = np.arange(nspec) < nspec * (inj + 1) // state_shape[0]
+        produced = lighter & (rng.random(nspec) < 0.2)
+        gamma = rng.uniform(1.0, 3.0, size=(produced.sum(), 1))
+        cutoff = rng.uniform(1e1, 1e3, size=(produced.sum(), 1))
+        state[inj, produced] = egrid ** (-gamma) * np.exp(-egrid / cutoff)
+    return state.reshape(state_shape)
+
+
+def benchmark(folder, name, layout, states):
+    filepath = path.join(folder, "states_{:}.hdf5".format(name.replace(" ", "_")))
+    try:
+        kwargs = states_layout_kwargs(layout, grid_shape, state_shape)
+    except Exception as e:
+        print(("{:<22} skipped: {:}".format(name, e)))
+        return
+
+    start = time.time()
+    with h5py.File(filepath, "w") as f:
+        if "sparse threshold" in layout:
+            dset = SparseStates.create(f, grid_shape, state_shape, nspec, layout)
+        else:
+            dset = f.create_dataset(
+                "states",
+                grid_shape + state_shape,
+                dtype=states_dtype(layout),
+                **kwargs,
+            )
+        for idx in np.ndindex(*grid_shape):
+            # written along the last axis, as done by the collection
+            sel = idx[:-1] + (slice(idx[-1], idx[-1] + 1),)
+            dset[sel] = states[idx[-1] % len(states)][np.newaxis]
+    twrite = time.time() - start
+
+    rng = np.random.default_rng(1)
+    indices = [tuple(rng.integers(0, n) for n in grid_shape) for _ in range(nreads)]
+    with h5py.File(filepath, "r", **chunk_cache_kwargs(layout.get("cache MB"))) as f:
+        start = time.time()
+        for idx in indices:
+            _ = open_states(f)[idx]
+        tread = (time.time() - start) / nreads
+
+    print(
+        (
+            "{:<22} size {:8.1f} MB, read {:7.2f} ms/point, write {:6.1f} s".format(
+                name, path.getsize(filepath) / 2**20, tread * 1e3, twrite
+            )
+        )
+    )
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    from os import makedirs
+
+    folder = sys.argv[1] if len(sys.argv) > 1 else tempfile.mkdtemp()
+    makedirs(folder, exist_ok=True)
+    register_filters()
+
+    rng = np.random.default_rng(0)
+    states = [synthetic_state(rng) for _ in range(16)]
+    print(
+        (
+            "grid {:}, states {:}, {:.1f} MB uncompressed".format(
+                grid_shape,
+                state_shape,
+                np.prod(grid_shape + state_shape) * 8 / 2**20,
+            )
+        )
+    )
+    for name, layout in layouts.items():
+        benchmark(folder, name, layout, states)
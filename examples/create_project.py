@@ -6,12 +6,13 @@ def setup_run():
     """Setup function is executed at the start of each job
     The return value is passed to single_run for each index
     """
-    import pickle as pickle
+    from analyzer.setupcache import load_shared
 
     # NOTE: Set the path to your PriNCe kernels below
-    path = path.expanduser("~/---/---/")
-    with open(path + "prince_run_xxx.ppo", "rb") as thefile:
-        prince_run = pickle.load(thefile)
+    kernel_path = path.expanduser("~/---/---/")
+    # The kernels are converted once per node to memory-mapped arrays in
+    # /dev/shm, which are shared by all jobs running on that node
+    prince_run = load_shared(path.join(kernel_path, "prince_run_xxx.ppo"))
     return prince_run
 
 
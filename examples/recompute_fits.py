@@ -0,0 +1,89 @@
+from os import path
+
+
+def setup_fit():
+    """Setup function is executed at the start of each job
+    The return value is passed to single_run for each index
+    """
+    from os import path
+
+    filepath = path.join(config["targetdir"], config["project_tag"], "collected.hdf5")
+    input_spec = config["input_spec"]
+    paramlist = config["paramlist"]
+
+    from analyzer.plotter import ScanPlotter
+
+    scan = ScanPlotter(filepath, input_spec, paramlist)
+
+    scan.print_summary()
+    return scan
+
+
+def single_fit(setup, index):
+    """Single run function is executed for each index
+    The states of the index are read once and fitted with all configurations
+    in config['fit configs'], the results are returned as dict by fit_tag
+    """
+    scan = setup
+
+    fits = scan.recompute_fits(index, config["fit configs"])
+    res = {}
+    for conf, (m, opt) in zip(config["fit configs"], fits):
+        print(
+            conf["fit_tag"],
+            "chi2:",
+            opt.get_chi2_spectrum(),
+            opt.get_chi2_Xmax(),
+            opt.get_chi2_VarXmax(),
+        )
+        res[conf["fit_tag"]] = m.fval, (m.parameters, m.args, m.values, m.errors)
+    return res
+
+
+# The base path assumes that this files is in the folder of the project created by example_create_project.py
+from run import config
+
+base = path.abspath(__file__)
+
+# Each configuration is collected into the group of its fit_tag in collected.hdf5
+fit_configs = []
+for xmax_model in ["epos", "qgsjet", "sibyll"]:
+    for dataset in [2015, 2017, 2019]:
+        for Emin in [6e9, 1e10]:
+            fit_configs.append(
+                {
+                    "fit_tag": "floating_E_{:}_{:}_Emin{:.0e}".format(
+                        xmax_model, dataset, Emin
+                    ),
+                    "xmax_model": xmax_model,
+                    "dataset": dataset,
+                    "Emin": Emin,
+                    "minimizer_args": {"fix_deltaE": False},
+                }
+            )
+
+# set config for jobs options below
+# The project will loop over all index combinations in 'paramlist'
+# Each job will receive an equal subset of indices to compute
+config.update(
+    {
+        "fit_tag": "floating_E_all",
+        "fit_only": True,
+        "fit configs": fit_configs,
+        "inputpath": base,
+        "setup_func": setup_fit,
+        "single_run_func": single_fit,
+        "njobs": 600,
+        "hours per job": 8,
+        "max memory GB": 3,
+    }
+)
+
+# run this script as python example_recompute_fits.py -[options]
+# PropagationProject.run_from_terminal() for all options
+if __name__ == "__main__":
+    # Parse the run arguments
+    from analyzer.cluster import PropagationProject
+
+    project = PropagationProject(config)
+    project.run_from_terminal()
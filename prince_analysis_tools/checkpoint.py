@@ -0,0 +1,156 @@
+"""Per grid point checkpoints for the jobs of a PropagationProject
+
+The results of a job are appended to a checkpoint file after each grid
+point by a background thread, so that computation and I/O overlap. A job
+restarted after being killed skips the grid points found in its checkpoint.
+"""
+
+import os
+import pickle as pickle
+import threading
+
+
+def scan_records(filepath):
+    """Number of complete records and the size of the complete part of a file
+
+    Only reads the file, so it can be used on the checkpoint of a running job.
+    """
+    count, valid = 0, 0
+    try:
+        with open(filepath, "rb") as thefile:
+            pickle.load(thefile)
+            valid = thefile.tell()
+            while True:
+                pickle.load(thefile)
+                count += 1
+                valid = thefile.tell()
+    except (IOError, OSError):
+        return 0, 0
+    except Exception:
+        # end of file or a record, which is still being written
+        pass
+    return count, valid
+
+
+def copy_records(source, target):
+    """Copies the complete records of the checkpoint source to target"""
+    _, valid = scan_records(source)
+    if valid == 0:
+        return
+    with open(source, "rb") as infile, open(target, "wb") as outfile:
+        outfile.write(infile.read(valid))
+
+
+class Checkpoint(object):
+    """Append-only pickle stream of (location, result, cost) records
+
+    The first record is a header with the jobid, the number of grid points
+    and a hash of their flat positions in the grid, a checkpoint written for
+    a different slicing (e.g. after balance_jobs) is ignored. positions is
+    None for jobs without fixed grid points (work stealing).
+    The costs of the loaded grid points are kept in self.costs.
+    """
+
+    def __init__(self, filepath, jobid, positions):
+        import hashlib
+        import numpy as np
+
+        npoints, digest = None, None
+        if positions is not None:
+            positions = np.ascontiguousarray(positions, dtype=np.int64)
+            npoints = len(positions)
+            digest = hashlib.sha1(positions.tobytes()).hexdigest()
+        self.filepath = filepath
+        self.header = (
+            "header",
+            {"jobid": jobid, "npoints": npoints, "positions": digest},
+        )
+        self._queue = None
+        self._thread = None
+        self._error = None
+        self.costs = {}
+
+    def load(self):
+        """Returns a dict {location: result} of the checkpointed grid points
+
+        A truncated last record (e.g. from a job killed while writing) is
+        cut off, so new records are appended after the last complete one.
+        """
+        done = {}
+        if not os.path.exists(self.filepath):
+            return done
+
+        valid = 0
+        with open(self.filepath, "rb") as thefile:
+            try:
+                if pickle.load(thefile) != self.header:
+                    print(("Ignoring checkpoint of different job", self.filepath))
+                    os.remove(self.filepath)
+                    return done
+                valid = thefile.tell()
+                while True:
+                    record = pickle.load(thefile)
+                    done[record[0]] = record[1]
+                    if len(record) > 2 and record[2] is not None:
+                        self.costs[record[0]] = record[2]
+                    valid = thefile.tell()
+            except EOFError:
+                pass
+            except Exception:
+                print(("Truncating incomplete checkpoint record in", self.filepath))
+
+        if valid == 0:
+            os.remove(self.filepath)
+        elif valid < os.path.getsize(self.filepath):
+            with open(self.filepath, "r+b") as thefile:
+                thefile.truncate(valid)
+        return done
+
+    def start(self):
+        """Starts the background thread writing the records"""
+        import queue
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_records, daemon=True)
+        self._thread.start()
+
+    def append(self, loc, result, cost=None):
+        """Queues the result (and runtime cost) of grid point loc to be written"""
+        if self._error is not None:
+            raise self._error
+        self._queue.put((loc, result, cost))
+
+    def close(self):
+        """Waits until all queued records are written"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            raise self._error
+
+    def remove(self):
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
+
+    def _write_records(self):
+        try:
+            new = not os.path.exists(self.filepath)
+            with open(self.filepath, "ab") as thefile:
+                if new:
+                    self._dump(thefile, self.header)
+                while True:
+                    record = self._queue.get()
+                    if record is None:
+                        break
+                    self._dump(thefile, record)
+        except Exception as e:
+            self._error = e
+
+    def _dump(self, thefile, record):
+        from .tracing import span
+
+        with span("checkpoint write", loc=record[0]):
+            pickle.dump(record, thefile, protocol=pickle.HIGHEST_PROTOCOL)
+            thefile.flush()
+            os.fsync(thefile.fileno())
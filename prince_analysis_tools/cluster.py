@@ -1,26 +1,80 @@
 import os.path as path
 
+from .scheduler import get_scheduler, array_spec
+from .scheduler import template_sge as template_submit  # noqa: F401
 
-template_submit = """#!/bin/zsh
-#$ -N {project_tag}
-#$ -l h_rt={hours}:00:00
-#$ -l h_rss={mem}G
-#$ -j y
-#$ -m ae
-#$ -o {folder_log}/{project_tag}$TASK_ID.log
 
-OUTFILE={folder_out}/{project_tag}$SGE_TASK_ID.out
-TMPOUT=$TMPDIR/tmp.out
+def _expand_ranges(ranges):
+    """Expands a list of (first, last) tuples to a list of ids"""
+    return [jobid for first, last in ranges for jobid in range(first, last + 1)]
 
-echo Starting job with options on
-echo `hostname`. Now is `date`
 
-source ~/.zshrc
-python {runfile} -r --jobid $SGE_TASK_ID --outfile $TMPOUT
+def _to_ranges(jobids):
+    """Collapses a sorted list of ids to a list of (first, last) tuples"""
+    import itertools
 
-#Copy output to destination
-mv $TMPOUT $OUTFILE
-"""
+    res = []
+    for _, group in itertools.groupby(enumerate(jobids), lambda x: x[1] - x[0]):
+        group = list(group)
+        res.append((group[0][1], group[-1][1]))
+    return res
+
+
+# state of a worker process in PropagationProject.run_local()
+_local_project = None
+_local_setup = None
+
+
+_inherited = []
+
+
+def _init_local_worker(project, setup=None):
+    global _local_project, _local_setup
+    # forked workers inherit the database connections of the parent, they
+    # are kept unused, closing them in the worker would break the database
+    _inherited.append(
+        (project.__dict__.get("_manifest"), project.__dict__.get("_task_queue"))
+    )
+    project._manifest = None
+    project._task_queue = None
+    _local_project = project
+    _local_setup = project.conf["setup_func"]() if setup is None else setup
+
+
+def _run_pilot_point(perm):
+    from .costs import PointTimer
+
+    with PointTimer() as timer:
+        result = _local_project.conf["single_run_func"](_local_setup, perm)
+    return result, timer.cost
+
+
+def _run_local_job(jobid):
+    import os
+    import socket
+    import time
+    from contextlib import redirect_stdout, redirect_stderr
+
+    project = _local_project
+    logfile = path.join(project.folder_log, project.logfile(jobid))
+    outfile = path.join(project.folder_out, project.outfile(jobid))
+    tmpfile = path.join(project.folder_out, "." + project.outfile(jobid) + ".tmp")
+
+    project.mark_job(jobid, "running")
+    try:
+        with open(logfile, "w") as log, redirect_stdout(log), redirect_stderr(log):
+            print("Starting job {:} with options on".format(jobid))
+            print("{:}. Now is {:}".format(socket.gethostname(), time.ctime()))
+            project.run_subset(jobid, tmpfile, setup=_local_setup)
+
+        # Move output to destination, mirrors the mv in the submit script
+        os.replace(tmpfile, outfile)
+        os.replace(tmpfile + ".json", outfile + ".json")
+    except:  # noqa: E722
+        project.mark_job(jobid, "failed")
+        raise
+    project.mark_job(jobid, "done")
+    return jobid
 
 
 class PropagationProject(object):
@@ -35,6 +89,8 @@ class PropagationProject(object):
         self.project_tag = conf["project_tag"]
         if "fit_tag" in conf:
             self.fit_tag = conf["fit_tag"]
+        # several fits per grid point, each collected to the group of its fit_tag
+        self.fit_configs = conf["fit configs"] if "fit configs" in conf else None
         # basefolder where to create the project tag
         self.targetdir = path.join(conf["targetdir"], self.project_tag)
         # path where the input file is located
@@ -48,8 +104,87 @@ class PropagationProject(object):
             self.folder_log = path.join(self.targetdir, "log")
             self.folder_out = path.join(self.targetdir, "out")
 
+        # format of the job outputs and its compression, see outputs.py
+        self.output_format = (
+            conf["output format"] if "output format" in conf else "pickle",
+            conf["output compression"] if "output compression" in conf else None,
+        )
+
+        # the collection maps the states of the hdf5 shards as virtual
+        # dataset instead of copying them to collected.hdf5
+        self.virtual_states = (
+            conf["virtual states"] if "virtual states" in conf else False
+        )
+        if (
+            self.virtual_states
+            and self.output_format[0] != "hdf5"
+            and not self.fit_only
+        ):
+            raise Exception("Virtual states need the hdf5 output format")
+
+        # jobs claim grid points from a shared queue instead of fixed slices
+        self.work_stealing = conf["work stealing"] if "work stealing" in conf else False
+        self.queue_batch = conf["queue batch"] if "queue batch" in conf else 4
+        self.queue_lease_hours = (
+            conf["queue lease hours"] if "queue lease hours" in conf else 2
+        )
+        self.queue_journal_mode = (
+            conf["queue journal mode"] if "queue journal mode" in conf else "wal"
+        )
+
+        # states of the jobs in an SQLite database, see manifest.py
+        self.use_manifest = conf["job manifest"] if "job manifest" in conf else True
+        self.manifest_journal_mode = (
+            conf["manifest journal mode"]
+            if "manifest journal mode" in conf
+            else "delete"
+        )
+
+        # speculative duplicates of slow jobs, see submit_stragglers
+        self.straggler_factor = (
+            conf["straggler factor"] if "straggler factor" in conf else 3.0
+        )
+        self.straggler_min_done = (
+            conf["straggler min done"] if "straggler min done" in conf else 10
+        )
+        self.max_duplicates = conf["max duplicates"] if "max duplicates" in conf else 1
+
+        # unattended job control with --daemon, see daemon.py
+        self.max_queued = conf["max queued"] if "max queued" in conf else 1000
+        self.max_retries = conf["max retries"] if "max retries" in conf else 2
+        self.poll_minutes = conf["poll minutes"] if "poll minutes" in conf else 5
+
+        # checkpoints of the single grid points in running jobs
+        self.checkpointing = conf["checkpoint"] if "checkpoint" in conf else True
+        if "checkpoint dir" in conf:
+            self.folder_ckpt = conf["checkpoint dir"]
+        elif self.fit_only:
+            self.folder_ckpt = path.join(self.targetdir, "checkpoint_fit")
+        else:
+            self.folder_ckpt = path.join(self.targetdir, "checkpoint")
+
+        # opt-in tracing of the stages of the jobs, see tracing.py
+        self.trace = conf["trace"] if "trace" in conf else False
+
+        # progress records of the running jobs, see heartbeat.py
+        self.heartbeat = conf["heartbeat"] if "heartbeat" in conf else True
+
+        # runtime costs of the grid points, see costs.py
+        if self.fit_only:
+            self.folder_cost = path.join(self.targetdir, "cost_fit")
+        else:
+            self.folder_cost = path.join(self.targetdir, "cost")
+
         # list of parameters to run the prog with
-        self.paramlist = conf["paramlist"]
+        # a sampled scan is a one dimensional grid of sample numbers, see sampling.py
+        if "sampling" in conf:
+            import numpy as np
+
+            self.sampling = conf["sampling"]
+            self.paramlist = (("sample", np.arange(int(self.sampling["npoints"]))),)
+        else:
+            self.sampling = None
+            self.paramlist = conf["paramlist"]
         self.njobs = conf["njobs"]
 
         if "run_subset" in conf and conf["run_subset"] is True:
@@ -57,9 +192,58 @@ class PropagationProject(object):
         else:
             self._perm_subset = None
 
+        # cost balanced assignment of the grid points to the jobs
+        self.partition_file = (
+            conf["partition file"] if "partition file" in conf else None
+        )
+
         self.max_memory = conf["max memory GB"] if "max memory GB" in conf else 2
         self.hours_per_job = conf["hours per job"] if "hours per job" in conf else 3
 
+        # adaptive scan on successively finer sub-grids, see refine.py
+        if "refinement" in conf and not self.fit_only:
+            if self.sampling is not None:
+                raise Exception("A sampled scan cannot be refined on a grid")
+            self.refinement = conf["refinement"]
+            self._enter_stage(self._refinement_state()["stage"])
+        else:
+            self.refinement = None
+            self.stage = None
+            # the fit of an adaptive scan covers only its computed grid points
+            if (
+                self.fit_only
+                and "refinement" in conf
+                and path.exists(self.fitpointsfile)
+            ):
+                self._load_points(self.fitpointsfile)
+
+        # only the new grid points of an extended earlier scan, see extend.py
+        if "extends" in conf and not self.fit_only:
+            if self.sampling is not None or self.refinement is not None:
+                raise Exception("Only a plain grid scan can extend an earlier scan")
+            if self.virtual_states:
+                raise Exception("Virtual states cannot include the old states")
+            self.extends = conf["extends"]
+            if path.exists(self.extensionfile):
+                self._load_points(self.extensionfile)
+        else:
+            self.extends = None
+
+        # backend used to submit the jobs, see scheduler.py
+        if dryrun:
+            self.scheduler = get_scheduler("dryrun")
+        elif "scheduler" in conf:
+            self.scheduler = get_scheduler(conf["scheduler"])
+        else:
+            self.scheduler = get_scheduler("sge")
+
+    def __getstate__(self):
+        # database connections are not shared with worker processes
+        state = self.__dict__.copy()
+        state.pop("_manifest", None)
+        state.pop("_task_queue", None)
+        return state
+
     # shortcuts for parameters
     @property
     def param_names(self):
@@ -75,6 +259,21 @@ class PropagationProject(object):
         elif type(self.paramlist) is tuple:
             return tuple(param[1] for param in self.paramlist)
 
+    @property
+    def shape(self):
+        """Shape of the full parameter grid"""
+        return tuple(len(values) for values in self.param_values)
+
+    @property
+    def nperms(self):
+        """Total number of grid points (or subset entries) in the scan"""
+        if self._perm_subset is not None:
+            return len(self._perm_subset)
+        else:
+            import numpy as np
+
+            return int(np.prod(self.shape, dtype=np.int64))
+
     @property
     def permutations(self):
         if self._perm_subset is not None:
@@ -83,77 +282,262 @@ class PropagationProject(object):
             import itertools as it
 
             # Create a list of all permutations of the scan parameters
+            # NOTE: this materializes the full grid, the methods below
+            # compute the same ordering arithmetically without building it
             permutations = it.product(
                 *[list(range(arr.size)) for arr in self.param_values]
             )
             return list(permutations)
 
+    @property
+    def _subset_array(self):
+        """Cached array version of the permutation subset"""
+        import numpy as np
+
+        if getattr(self, "_subset_cache", None) is None:
+            subset = np.array(self._perm_subset, dtype=np.int64)
+            self._subset_cache = subset.reshape(len(self._perm_subset), -1)
+        return self._subset_cache
+
+    @property
+    def _subset_lookup(self):
+        """Cached mapping from index tuple to its position in the subset"""
+        if getattr(self, "_subset_lookup_cache", None) is None:
+            self._subset_lookup_cache = {
+                tuple(idx): pos for pos, idx in enumerate(self._subset_array.tolist())
+            }
+        return self._subset_lookup_cache
+
+    def flat_to_indices(self, flat):
+        """Converts positions in the permutation order to index tuples
+
+        Vectorized, accepts a scalar or an array of positions
+        and returns an integer array of shape (npos, ndim)
+        """
+        import numpy as np
+
+        flat = np.atleast_1d(np.asarray(flat, dtype=np.int64))
+        if flat.size > 0 and (flat.min() < 0 or flat.max() >= self.nperms):
+            raise Exception(
+                "Error: positions out of range for {:} permutations".format(self.nperms)
+            )
+        if self._perm_subset is not None:
+            return self._subset_array[flat]
+        else:
+            # mixed-radix unravel, last parameter runs fastest as in itertools.product
+            return np.stack(np.unravel_index(flat, self.shape), axis=-1)
+
+    def indices_to_flat(self, indices):
+        """Converts index tuples to positions in the permutation order
+
+        Vectorized, accepts a single index tuple or an array of shape (npos, ndim)
+        and returns an integer array of positions
+        """
+        import numpy as np
+
+        indices = np.asarray(indices, dtype=np.int64)
+        indices = indices.reshape(-1, len(self.shape))
+        if self._perm_subset is not None:
+            lookup = self._subset_lookup
+            try:
+                return np.array(
+                    [lookup[idx] for idx in map(tuple, indices.tolist())],
+                    dtype=np.int64,
+                )
+            except KeyError as err:
+                raise Exception(
+                    "Error: could not find index ({:}) in permutations".format(
+                        err.args[0]
+                    )
+                )
+        else:
+            try:
+                return np.ravel_multi_index(tuple(indices.T), self.shape)
+            except ValueError:
+                raise Exception(
+                    "Error: indices out of range for grid of shape {:}".format(
+                        self.shape
+                    )
+                )
+
+    @property
+    def samplefile(self):
+        return path.join(self.targetdir, "samples.npz")
+
+    @property
+    def sample_points(self):
+        """Parameter values (npoints, ndim) of a sampled scan, None for a grid"""
+        if self.sampling is None:
+            return None
+        if getattr(self, "_sample_points", None) is None:
+            from .sampling import read_samples
+
+            self._sample_points = read_samples(self.samplefile)[1]
+        return self._sample_points
+
     def index_to_params(self, index):
+        if self.sampling is not None:
+            return list(self.sample_points[index[0]])
         values = self.param_values
         return [v[i] for i, v in zip(index, values)]
 
-    def params_to_index(self, params):
+    def indices_to_params(self, indices):
+        """Vectorized version of index_to_params
+
+        Returns a list with one array of parameter values per parameter
+        """
         import numpy as np
 
-        values = self.param_values
-        names = self.param_names
-        res = []
-        for par, na, arr in zip(params, names, values):
-            loc = np.argwhere(arr == par)
-            if len(loc) < 1:
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1, len(self.shape))
+        if self.sampling is not None:
+            return list(self.sample_points[indices[:, 0]].T)
+        return [
+            np.asarray(values)[col] for values, col in zip(self.param_values, indices.T)
+        ]
+
+    def params_to_index(self, params, rtol=1e-5, atol=1e-8):
+        return tuple(
+            int(i) for i in self.params_to_indices([params], rtol=rtol, atol=atol)[0]
+        )
+
+    def params_to_indices(self, params, rtol=1e-5, atol=1e-8):
+        """Vectorized version of params_to_index
+
+        Accepts an array of shape (npos, ndim) and returns an integer array
+        of the same shape, for a sampled scan of shape (npos, 1). Numeric
+        values are matched within the tolerance of np.isclose, others exactly.
+        """
+        import numpy as np
+        from .extend import value_matches
+
+        if self.sampling is not None:
+            points = self.sample_points
+            params = np.asarray(params).reshape(-1, points.shape[1])
+            matches = np.isclose(
+                points[np.newaxis, :, :], params[:, np.newaxis, :], rtol, atol
+            ).all(axis=2)
+            if (matches.sum(axis=1) != 1).any():
+                raise Exception(
+                    "Error: could not find sample point ({:})".format(
+                        params[np.argmax(matches.sum(axis=1) != 1)]
+                    )
+                )
+            return matches.argmax(axis=1)[:, np.newaxis]
+
+        params = np.asarray(params).reshape(-1, len(self.shape))
+        res = np.empty(params.shape, dtype=np.int64)
+        for dim, (na, arr) in enumerate(zip(self.param_names, self.param_values)):
+            matches = value_matches(params[:, dim], arr, rtol, atol)
+            counts = matches.sum(axis=1)
+            if (counts < 1).any():
                 raise Exception(
                     "Error: could not find value ({:}) for the parameter ({:})".format(
-                        par, na
+                        params[np.argmax(counts < 1), dim], na
                     )
                 )
-            elif len(loc) > 1:
+            elif (counts > 1).any():
+                pos = np.argmax(counts > 1)
                 raise Exception(
                     "Error: found value {:} for parameter ({:}) {:} times".format(
-                        par, na, len(loc)
+                        params[pos, dim], na, counts[pos]
                     )
                 )
-            else:
-                res.append(int(loc[0]))
-        return tuple(res)
+            res[:, dim] = matches.argmax(axis=1)
+        return res
 
     def index_to_jobid(self, idx):
+        jobids, joblocs = self.indices_to_jobids([idx])
+        return int(jobids[0]), int(joblocs[0])
+
+    def indices_to_jobids(self, indices):
+        """Vectorized version of index_to_jobid
+
+        Returns two arrays, the jobids and the locations in the job results lists
+        """
+        if self.work_stealing:
+            raise Exception("Error: jobs have no fixed indices with work stealing")
+        flat = self.indices_to_flat(indices)
+        if self.partition is not None:
+            jobof, locof = self._partition_lookup
+            return jobof[flat], locof[flat]
+        # The jobid is given by the rest, the location in the job results list is given by the devision
+        # plus 1 for the jobid, as job indexing starts at 1 and not zero
+        jobids = flat % self.njobs + 1
+        joblocs = flat // self.njobs
+        return jobids, joblocs
+
+    @property
+    def partition(self):
+        """Positions of each job from the partition file, None if not set"""
+        if self.partition_file is None:
+            return None
+        if getattr(self, "_partition", None) is None:
+            import numpy as np
+            from .costs import load_partition
+
+            partition = load_partition(self.partition_file)
+            counts = np.bincount(np.concatenate(partition), minlength=self.nperms)
+            if len(partition) != self.njobs:
+                raise Exception(
+                    "Error: partition has {:} jobs, njobs is {:}".format(
+                        len(partition), self.njobs
+                    )
+                )
+            elif counts.size != self.nperms or (counts != 1).any():
+                raise Exception(
+                    "Error: partition does not cover the {:} permutations".format(
+                        self.nperms
+                    )
+                )
+            self._partition = partition
+        return self._partition
+
+    @property
+    def _partition_lookup(self):
+        """Cached arrays of the jobid and the job location of each position"""
         import numpy as np
 
-        perms = np.array(self.permutations)
+        if getattr(self, "_partition_lookup_cache", None) is None:
+            jobof = np.empty(self.nperms, dtype=np.int64)
+            locof = np.empty(self.nperms, dtype=np.int64)
+            for jobid, positions in enumerate(self.partition, start=1):
+                jobof[positions] = jobid
+                locof[positions] = np.arange(len(positions))
+            self._partition_lookup_cache = jobof, locof
+        return self._partition_lookup_cache
+
+    def job_positions(self, jobid):
+        """Positions in the permutation order computed by job jobid"""
+        import numpy as np
 
-        loc = np.argwhere((perms == idx).all(axis=1)).flatten()
-        if len(loc) < 1:
-            raise Exception(
-                "Error: could not find index ({:}) in permutations".format(idx)
-            )
-        elif len(loc) > 1:
-            raise Exception(
-                "Error: found index {:} in permutations {:} times".format(idx, len(loc))
-            )
-        loc = loc[0]
-        div = loc / self.njobs
-        rest = loc % self.njobs
-        # The jobid is given by the rest, the location in the job results list is given by the devision
-        jobid = rest + 1  # plus 1 here, as job indexing starts at 1 and not zero
-        jobloc = div
+        if self.partition is not None:
+            return self.partition[jobid - 1]
+        return np.arange(jobid - 1, self.nperms, self.njobs, dtype=np.int64)
 
-        # test by forwarding again to perm_slice
-        if not idx == self.perm_slice(jobid)[jobloc]:
-            raise Exception(
-                "Error: Wrong result for index {:}, found jobid {:} and jobloc {:}, which leads to {:}".format(
-                    idx, jobid, jobloc, self.perm_slice(jobid)[jobloc]
-                )
-            )
-        else:
-            return jobid, jobloc
+    def perm_slice_array(self, jobid):
+        """Array version of perm_slice with shape (npos, ndim)"""
+        return self.flat_to_indices(self.job_positions(jobid))
 
     def perm_slice(self, jobid):
-        return self.permutations[jobid - 1 :: self.njobs]
+        if self._perm_subset is not None and self.partition is None:
+            return self._perm_subset[jobid - 1 :: self.njobs]
+        else:
+            return [tuple(idx) for idx in self.perm_slice_array(jobid).tolist()]
 
     def values_slice(self, jobid):
         index_list = self.perm_slice(jobid)
         return [self.index_to_params(idx) for idx in index_list]
 
+    @property
+    def _stage_tag(self):
+        """Suffix of the files and folders of the current refinement stage"""
+        return "" if self.stage is None else "_stage{:}".format(self.stage)
+
+    @property
+    def job_name(self):
+        """Name of the jobs in the scheduler, set by the submit file"""
+        return self.fit_tag if self.fit_only else self.project_tag
+
     @property
     def runfile(self):
         if self.fit_only:
@@ -161,12 +545,26 @@ class PropagationProject(object):
         else:
             return path.join(self.targetdir, "run.py")
 
+    @property
+    def queuefile(self):
+        if self.fit_only:
+            return path.join(self.targetdir, "queue_" + self.fit_tag + ".sqlite")
+        else:
+            return path.join(self.targetdir, "queue" + self._stage_tag + ".sqlite")
+
+    @property
+    def manifestfile(self):
+        if self.fit_only:
+            return path.join(self.targetdir, "manifest_" + self.fit_tag + ".sqlite")
+        else:
+            return path.join(self.targetdir, "manifest" + self._stage_tag + ".sqlite")
+
     @property
     def subfile(self):
         if self.fit_only:
             return path.join(self.targetdir, "fit_" + self.fit_tag + ".sh")
         else:
-            return path.join(self.targetdir, "sub.sh")
+            return path.join(self.targetdir, "sub" + self._stage_tag + ".sh")
 
     def logfile(self, num):
         if self.fit_only:
@@ -180,10 +578,69 @@ class PropagationProject(object):
         else:
             return self.project_tag + "{:}.out".format(num)
 
+    def checksumfile(self, num):
+        return self.outfile(num) + ".json"
+
+    def checkpointfile(self, num):
+        if self.fit_only:
+            return self.fit_tag + "{:}.ckpt".format(num)
+        else:
+            return self.project_tag + "{:}.ckpt".format(num)
+
+    @property
+    def folder_trace(self):
+        """Folder of the job traces, None if tracing is not enabled"""
+        from .tracing import trace_folder
+
+        if self.fit_only:
+            default = path.join(self.targetdir, "trace_fit")
+        else:
+            default = path.join(self.targetdir, "trace" + self._stage_tag)
+        folder = trace_folder(default)
+        if folder is None and self.trace:
+            folder = default if self.trace is True else self.trace
+        return folder
+
+    def tracefile(self, num):
+        if self.fit_only:
+            return self.fit_tag + "{:}.trace.json".format(num)
+        else:
+            return self.project_tag + "{:}.trace.json".format(num)
+
+    def heartbeatfile(self, num):
+        if self.fit_only:
+            return self.fit_tag + "{:}.heartbeat".format(num)
+        else:
+            return self.project_tag + "{:}.heartbeat".format(num)
+
+    def costfile(self, num):
+        if self.fit_only:
+            return self.fit_tag + "{:}.cost".format(num)
+        else:
+            return self.project_tag + "{:}.cost".format(num)
+
     def setup_project(self):
         """Sets up the standard folders and files in the project folder"""
         from os import makedirs
 
+        if self.refinement is not None:
+            # the first stage of an adaptive scan computes the coarsest grid
+            from .refine import normalize_strides, stage_points
+
+            if path.exists(self.refinementfile):
+                raise Exception(
+                    "_setup_project():: project already exists, delete old files first!!"
+                )
+            makedirs(self.targetdir, exist_ok=True)
+            strides = normalize_strides(self.refinement["strides"], len(self.shape))
+            self._start_stage(0, stage_points(self.shape, strides[0]))
+        elif self.extends is not None:
+            if path.exists(self.extensionfile):
+                raise Exception(
+                    "_setup_project():: project already exists, delete old files first!!"
+                )
+            self._start_extension()
+
         # step 1: create the project folders
         try:
             print("making directories:")
@@ -200,18 +657,249 @@ class PropagationProject(object):
         from shutil import copyfile
 
         copyfile(self.inputpath, self.runfile)
+        if self.sampling is not None:
+            from .sampling import draw_samples, parse_bounds, write_samples
+
+            names = parse_bounds(self.sampling["bounds"])[0]
+            write_samples(self.samplefile, names, draw_samples(self.sampling))
+            print(("sample points written to", self.samplefile))
+        self._create_manifest()
         # step 3: create a submit file from template
-        with open(self.subfile, "w") as subfile:
-            subfile.write(
-                template_submit.format(
-                    project_tag=self.project_tag,
-                    runfile=self.runfile,
-                    folder_log=self.folder_log,
-                    folder_out=self.folder_out,
-                    hours=self.hours_per_job,
-                    mem=self.max_memory,
+        self._write_submit_file()
+
+    def _write_submit_file(self):
+        self.scheduler.write_submit_file(
+            self.subfile,
+            project_tag=self.project_tag,
+            runfile=self.runfile,
+            folder_log=self.folder_log,
+            folder_out=self.folder_out,
+            hours=self.hours_per_job,
+            mem=self.max_memory,
+        )
+
+    @property
+    def refinementfile(self):
+        return path.join(self.targetdir, "refinement.json")
+
+    def stagefile(self, stage):
+        """Index tuples of the grid points computed in a refinement stage"""
+        return path.join(self.targetdir, "stage{:}.npy".format(stage))
+
+    def _refinement_state(self):
+        """Current stage and number of jobs of all stages of an adaptive scan"""
+        import json
+
+        if not path.exists(self.refinementfile):
+            return {"stage": 0, "njobs": []}
+        with open(self.refinementfile) as thefile:
+            return json.load(thefile)
+
+    def _enter_stage(self, stage):
+        """Points the folders, the subset and njobs to a refinement stage"""
+        import numpy as np
+
+        self.stage = stage
+        tag = self._stage_tag
+        self.folder_log = path.join(self.targetdir, "log" + tag)
+        self.folder_out = path.join(self.targetdir, "out" + tag)
+        self.folder_cost = path.join(self.targetdir, "cost" + tag)
+        if "checkpoint dir" in self.conf:
+            self.folder_ckpt = path.join(
+                self.conf["checkpoint dir"], "stage{:}".format(stage)
+            )
+        else:
+            self.folder_ckpt = path.join(self.targetdir, "checkpoint" + tag)
+
+        if path.exists(self.stagefile(stage)):
+            points = np.load(self.stagefile(stage))
+            self._perm_subset = [tuple(idx) for idx in points.tolist()]
+            self.njobs = self._refinement_state()["njobs"][stage]
+        # drop everything cached for the previous stage
+        for name in [
+            "_subset_cache",
+            "_subset_lookup_cache",
+            "_manifest",
+            "_task_queue",
+        ]:
+            setattr(self, name, None)
+
+    def _start_stage(self, stage, points):
+        """Stores the grid points of a new stage and makes it the current one
+
+        The number of jobs is scaled, so that each job computes as many grid
+        points as the jobs of the full grid would.
+        """
+        import json
+        import numpy as np
+
+        state = self._refinement_state()
+        nfull = int(np.prod(self.shape, dtype=np.int64))
+        njobs = int(np.ceil(self.conf["njobs"] * len(points) / float(nfull)))
+        state["stage"] = stage
+        state["njobs"] = state["njobs"][:stage] + [max(1, min(njobs, len(points)))]
+        np.save(self.stagefile(stage), np.asarray(points, dtype=np.int64))
+        with open(self.refinementfile, "w") as thefile:
+            json.dump(state, thefile)
+        self._enter_stage(stage)
+        print(
+            (
+                "stage {:}: {:} grid points in {:} jobs".format(
+                    stage, len(points), self.njobs
+                )
+            )
+        )
+
+    def refine(self):
+        """Starts the next stage of an adaptive scan
+
+        The current stage has to be collected completely. The next stage
+        computes the points of the next finer stride around all points with
+        chi2 below the minimum plus config['refinement']['delta chi2']
+        (default 14.16) and ['margin'] (default 0). Returns the new grid
+        points, None if the finest stride was reached.
+        """
+        from os import makedirs
+        import h5py
+        from .refine import normalize_strides, refine_points
+
+        strides = normalize_strides(self.refinement["strides"], len(self.shape))
+        if self.stage + 1 >= len(strides):
+            print(
+                (
+                    "finest stride {:} reached in stage {:}".format(
+                        strides[-1], self.stage
+                    )
+                )
+            )
+            return None
+
+        with h5py.File(path.join(self.targetdir, "collected.hdf5"), "r") as h5file:
+            if not h5file["manifest"]["jobs" + self._stage_tag][:].all():
+                raise Exception(
+                    "Collect all jobs of stage {:} before refining".format(self.stage)
+                )
+            chi2 = h5file["default fit"]["chi2"][()]
+            computed = h5file["computed"][()]
+
+        points = refine_points(
+            chi2,
+            computed,
+            strides[self.stage],
+            strides[self.stage + 1],
+            self.refinement.get("delta chi2", 14.16),
+            self.refinement.get("margin", 0.0),
+        )
+        if len(points) == 0:
+            print("no grid points left to refine")
+            return points
+        self._start_stage(self.stage + 1, points)
+
+        makedirs(self.folder_log)
+        makedirs(self.folder_out)
+        self._create_manifest()
+        self._write_submit_file()
+        print(("submit file for the new stage:", self.subfile))
+        return points
+
+    @property
+    def extensionfile(self):
+        """Index tuples of the grid points not computed by the extended scan"""
+        return path.join(self.targetdir, "extension.npy")
+
+    def _load_points(self, filepath):
+        """Restricts the scan to the index tuples stored in filepath
+
+        The number of jobs is scaled, so that each job computes as many grid
+        points as the jobs of the full grid would.
+        """
+        import numpy as np
+
+        points = np.load(filepath)
+        self._perm_subset = [tuple(idx) for idx in points.tolist()]
+        nfull = int(np.prod(self.shape, dtype=np.int64))
+        njobs = int(np.ceil(self.conf["njobs"] * len(points) / float(nfull)))
+        self.njobs = max(1, min(njobs, len(points)))
+        for name in ["_subset_cache", "_subset_lookup_cache"]:
+            setattr(self, name, None)
+
+    def _extension_maps(self):
+        """Index of each value of the extended scan on the axes of the new grid"""
+        from .extend import axis_maps
+
+        return axis_maps(
+            self.extends["paramlist"],
+            self.paramlist,
+            self.extends.get("rtol", 1e-5),
+            self.extends.get("atol", 1e-8),
+        )
+
+    def _start_extension(self):
+        """Stores the grid points, which are not computed by the extended scan"""
+        from os import makedirs
+        import h5py
+        import numpy as np
+        from .extend import computed_points, missing_points
+
+        collected = path.abspath(self.extends["collected"])
+        if collected == path.abspath(path.join(self.targetdir, "collected.hdf5")):
+            raise Exception("An extension needs a new project_tag or targetdir")
+        maps = self._extension_maps()
+        with h5py.File(collected, "r") as h5file:
+            computed = computed_points(h5file)
+        points = missing_points(self.shape, maps, computed)
+        if len(points) == 0:
+            raise Exception("All grid points are computed in {:}".format(collected))
+
+        makedirs(self.targetdir, exist_ok=True)
+        np.save(self.extensionfile, np.asarray(points, dtype=np.int64))
+        self._load_points(self.extensionfile)
+        print(
+            (
+                "{:} of {:} grid points computed in {:}, {:} new grid points "
+                "in {:} jobs".format(
+                    int(np.prod(self.shape)) - len(points),
+                    int(np.prod(self.shape)),
+                    collected,
+                    len(points),
+                    self.njobs,
                 )
             )
+        )
+
+    def _merge_extended(self, h5file, datasets, shape):
+        """Copies the results of the extended scan to the new grid"""
+        import h5py
+        import numpy as np
+        from tqdm import tqdm
+        from .collect import BlockWriter, open_states
+        from .extend import old_blocks
+
+        collected = self.extends["collected"]
+        maps = self._extension_maps()
+        with h5py.File(collected, "r") as h5old:
+            if not np.allclose(h5old["egrid"][:], h5file["egrid"][:]) or not (
+                np.array_equal(h5old["known_spec"][:], h5file["known_spec"][:])
+            ):
+                raise Exception(
+                    "The energy grid or species differ from {:}".format(collected)
+                )
+            olds = {
+                "states": open_states(h5old),
+                "fractions": h5old["default fit"]["fractions"],
+            }
+            for name, old in olds.items():
+                if old.shape[len(maps) :] != datasets[name].shape[len(shape) :]:
+                    raise Exception(
+                        "The {:} of {:} have a different shape".format(name, collected)
+                    )
+
+            writer = BlockWriter(h5file, datasets, shape, None)
+            print(("copying the results of", collected))
+            for block in tqdm(old_blocks(h5old, maps, shape)):
+                writer.add(None, block)
+            writer.write()
+        h5file.attrs["extended from"] = path.abspath(collected)
 
     def setup_fit(self):
         """Sets up the standard folders and files in the project folder"""
@@ -235,78 +923,160 @@ class PropagationProject(object):
         except:  # noqa: E722
             # we will assume, the file is already in the correct folder
             pass
+        if "refinement" in self.conf and not path.exists(self.fitpointsfile):
+            self._store_fit_points()
+        if not path.exists(self.manifestfile):
+            self._create_manifest()
 
         # step 3: create a submit file from template
-        with open(self.subfile, "w") as subfile:
-            subfile.write(
-                template_submit.format(
-                    project_tag=self.fit_tag,
-                    runfile=self.runfile,
-                    folder_log=self.folder_log,
-                    folder_out=self.folder_out,
-                    hours=self.hours_per_job,
-                    mem=self.max_memory,
-                )
-            )
+        self.scheduler.write_submit_file(
+            self.subfile,
+            project_tag=self.fit_tag,
+            runfile=self.runfile,
+            folder_log=self.folder_log,
+            folder_out=self.folder_out,
+            hours=self.hours_per_job,
+            mem=self.max_memory,
+        )
 
-    def scan_logfiles(self):
-        """Scans the log folder for missing files"""
-        import os
+    @property
+    def fitpointsfile(self):
+        """Index tuples of the computed grid points of an adaptive scan to fit"""
+        return path.join(self.targetdir, "points_" + self.fit_tag + ".npy")
 
-        import itertools
+    def _store_fit_points(self):
+        """Stores the grid points computed by all stages of an adaptive scan
 
-        def ranges(i):
-            for a, b in itertools.groupby(enumerate(i), lambda x_y: x_y[1] - x_y[0]):
-                b = list(b)
-                yield b[0][1], b[-1][1]
+        The grid points of stages collected later are not fitted, remove the
+        points file and run -c again to include them.
+        """
+        import h5py
+        import numpy as np
 
-        expected = list(range(1, self.njobs + 1))
-        existing = os.listdir(self.folder_log)
-        found = [idx for idx in expected if self.logfile(idx) in existing]
-        found = list(ranges(found))
-        missing = [idx for idx in expected if self.logfile(idx) not in existing]
-        num_missing = len(missing)
-        missing = list(ranges(missing))
-        print("------------------------------")
-        print("missing logfiles:")
+        filepath = path.join(self.targetdir, "collected.hdf5")
+        if not path.exists(filepath):
+            raise Exception("Collect the adaptive scan before setting up the fit")
+        with h5py.File(filepath, "r") as h5file:
+            points = np.argwhere(h5file["computed"][()])
+        if len(points) == 0:
+            raise Exception("No computed grid points in {:}".format(filepath))
+        np.save(self.fitpointsfile, points.astype(np.int64))
+        self._load_points(self.fitpointsfile)
         print(
             (
-                ",\n".join(
-                    [
-                        (
-                            "{:}-{:}".format(*tup)
-                            if not tup[0] == tup[1]
-                            else "{:}".format(tup[0])
-                        )
-                        for tup in missing
-                    ]
+                "fitting the {:} computed grid points in {:} jobs".format(
+                    len(points), self.njobs
                 )
             )
         )
-        print(("total missing files:", num_missing))
-        print("------------------------------")
-        return found, missing
 
-    def scan_output(self):
-        """Scans the output folder for missing files"""
+    def _create_manifest(self):
+        """Creates an empty job manifest, if it is enabled"""
+        if self.use_manifest:
+            # the database and its table are created on connecting
+            self._manifest = None
+            self._open_manifest().conn
+
+    def _open_manifest(self):
+        from .manifest import JobManifest
+
+        if getattr(self, "_manifest", None) is None:
+            self._manifest = JobManifest(
+                self.manifestfile, journal_mode=self.manifest_journal_mode
+            )
+        return self._manifest
+
+    @property
+    def manifest(self):
+        """The job manifest, None if it is disabled or was not created
+
+        The manifest is only used, if it exists from the start of the
+        project (or was rebuilt), otherwise it would miss jobs.
+        """
+        if not self.use_manifest or not path.exists(self.manifestfile):
+            return None
+        return self._open_manifest()
+
+    def mark_job(self, jobid, state, speculative=False):
+        """Records the state of a job in the manifest, called by the jobs
+
+        A speculative duplicate is counted on submission (see
+        submit_stragglers), only its output is recorded. Its start would
+        replace the start time and add to the attempts of the original job,
+        and its failure would mark the still running original as failed.
+        """
+        import os
+        import socket
+
+        manifest = self.manifest
+        if manifest is None:
+            return
+        if speculative and state != "done":
+            print(("speculative copy of job {:} {:}".format(jobid, state)))
+            return
+        size = None
+        if state == "done":
+            outputfile = path.join(self.folder_out, self.outfile(jobid))
+            if os.path.exists(outputfile):
+                size = os.path.getsize(outputfile)
+        manifest.mark(jobid, state, host=socket.gethostname(), size=size)
+
+    def rebuild_manifest(self):
+        """Rebuilds the job manifest from the log and output folders
+
+        For projects without a manifest or after files were moved by hand.
+        Jobs with an output are done, jobs with only a log are running.
+        """
         import os
 
-        import itertools
+        from .manifest import DONE, RUNNING
+
+        print("scanning log and output folders:")
+        logs = {entry.name: entry for entry in os.scandir(self.folder_log)}
+        outs = {entry.name: entry for entry in os.scandir(self.folder_out)}
+        entries = []
+        for jobid in range(1, self.njobs + 1):
+            log = logs.get(self.logfile(jobid))
+            out = outs.get(self.outfile(jobid))
+            started = log.stat().st_ctime if log is not None else None
+            if out is not None:
+                stat = out.stat()
+                entries.append(
+                    (jobid, DONE, None, started, stat.st_mtime, stat.st_size)
+                )
+            elif log is not None:
+                entries.append((jobid, RUNNING, None, started, None, None))
+        self.use_manifest = True
+        self._open_manifest().rebuild(entries)
+        self.manifest_status()
+
+    def manifest_status(self):
+        counts = self.manifest.counts()
+        print("------------------------------")
+        print("job manifest:")
+        for state, count in counts.items():
+            print(("{:<8} {:}".format(state, count)))
+        print(("{:<8} {:}".format("unknown", self.njobs - sum(counts.values()))))
+        print("------------------------------")
+        return counts
+
+    def _existing_jobs(self, folder, filename):
+        """Job ids with an existing file filename(jobid) in folder"""
+        import os
 
-        def ranges(i):
-            for a, b in itertools.groupby(enumerate(i), lambda x_y1: x_y1[1] - x_y1[0]):
-                b = list(b)
-                yield b[0][1], b[-1][1]
+        existing = set(os.listdir(folder))
+        return [
+            jobid for jobid in range(1, self.njobs + 1) if filename(jobid) in existing
+        ]
 
-        expected = list(range(1, self.njobs + 1))
-        existing = os.listdir(self.folder_out)
-        found = [idx for idx in expected if self.outfile(idx) in existing]
-        found = list(ranges(found))
-        missing = [idx for idx in expected if self.outfile(idx) not in existing]
+    def _report_scan(self, kind, found):
+        """Prints the missing jobs, returns found and missing jobs as ranges"""
+        found = set(found)
+        missing = [jobid for jobid in range(1, self.njobs + 1) if jobid not in found]
         num_missing = len(missing)
-        missing = list(ranges(missing))
+        missing = _to_ranges(missing)
         print("------------------------------")
-        print("missing outputfiles:")
+        print(("missing {:}:".format(kind)))
         print(
             (
                 ",\n".join(
@@ -323,90 +1093,884 @@ class PropagationProject(object):
         )
         print(("total missing files:", num_missing))
         print("------------------------------")
-        return found, missing
+        return _to_ranges(sorted(found)), missing
 
-    def submit_all_jobs(self):
-        """Submits a job array"""
-        import subprocess
+    def scan_logfiles(self):
+        """Scans the manifest (or the log folder) for jobs that never started"""
+        from .manifest import RUNNING, DONE, FAILED
 
-        _ = subprocess.call(["qsub", "-t", "1:{:}".format(self.njobs), self.subfile])
+        manifest = self.manifest
+        if manifest is None:
+            found = self._existing_jobs(self.folder_log, self.logfile)
+        else:
+            found = manifest.jobs([RUNNING, DONE, FAILED])
+        return self._report_scan("logfiles", found)
 
-    def run_subset(self, jobid, outputfile):
-        """Run the calculations for a subset of the parameter space"""
+    def scan_output(self):
+        """Scans the manifest (or the output folder) for missing outputs
 
-        # Runs the function supplied by config on a a fraction of the parameter space
-        # Fraction depends on the number of total jobs
-        setup = self.conf["setup_func"]()
-        results = []
-
-        for perm in self.perm_slice(jobid):
-            # inp = {}
-            # for key, arr, idx in zip(self.param_names, self.param_values,
-            #                          perm):
-            #     inp[key] = arr[idx]
-
-            # func = self.conf['single_run_func']
-            # results.append(func(setup, **inp))
-            perm = tuple(perm)
-            func = self.conf["single_run_func"]
-            results.append(func(setup, perm))
-
-        # Save the list of results to pickle
-        import pickle as pickle
-
-        with open(outputfile, "wb") as thefile:
-            pickle.dump(results, thefile, protocol=pickle.HIGHEST_PROTOCOL)
-        print(("collected results dumped to ", outputfile))
+        Jobs running longer than 'hours per job' (plus 10 minutes) were
+        killed by the scheduler, they are marked as failed in the manifest.
+        """
+        from .manifest import DONE
 
-    def submit_missing_jobs(self):
-        import subprocess
-        import os
+        manifest = self.manifest
+        if manifest is None:
+            found = self._existing_jobs(self.folder_out, self.outfile)
+        else:
+            expired = manifest.expire(3600.0 * self.hours_per_job + 600.0)
+            if len(expired) > 0:
+                print(
+                    (
+                        "jobs running longer than 'hours per job', marked as failed:",
+                        array_spec(expired),
+                    )
+                )
+            found = manifest.jobs([DONE])
+        return self._report_scan("outputfiles", found)
 
-        _, missing = self.scan_output()
-        for jobid in missing:
-            for sid in range(jobid[0], jobid[1] + 1):
-                if os.path.exists("./log/{:}".format(self.logfile(sid))):
-                    os.remove("./log/{:}".format(self.logfile(sid)))
-            _ = subprocess.call(
-                ["qsub", "-t", "{:}:{:}".format(*jobid), self.subfile]
+    def submit_all_jobs(self):
+        """Submits a job array"""
+        self._submit(range(1, self.njobs + 1))
+
+    def _submit(self, jobids):
+        """Submits the jobids and marks them as queued in the manifest"""
+        jobids = list(jobids)
+        if self.scheduler.submit(self.subfile, jobids) == 0:
+            manifest = self.manifest
+            if manifest is not None:
+                manifest.mark_queued(jobids)
+
+    def _open_checkpoint(self, jobid, perms, speculative=False):
+        """Checkpoint of the job and the results of the grid points done before
+
+        perms are the index tuples of the grid points of the job, None with
+        work stealing. A speculative copy of a job uses its own checkpoint,
+        which starts from the grid points done by the original job.
+        """
+        from os import makedirs
+        from .checkpoint import Checkpoint, copy_records
+
+        makedirs(self.folder_ckpt, exist_ok=True)
+        filepath = path.join(self.folder_ckpt, self.checkpointfile(jobid))
+        if speculative:
+            original, filepath = filepath, filepath + ".spec"
+            if not path.exists(filepath):
+                copy_records(original, filepath)
+        positions = None if perms is None else self._grid_flat(perms)
+        ckpt = Checkpoint(filepath, jobid, positions)
+        done = ckpt.load()
+        if len(done) > 0:
+            print(
+                (
+                    "resuming from checkpoint, {:} of {:} grid points done".format(
+                        len(done), ckpt.header[1]["npoints"]
+                    )
+                )
             )
+        ckpt.start()
+        return ckpt, done
 
-    def submit_single_job(self, jobid):
-        import subprocess
+    def run_subset(self, jobid, outputfile, setup=None, speculative=False):
+        """Run the calculations for a subset of the parameter space
+
+        speculative is set for a duplicate of a slow job, see submit_stragglers.
+        If tracing is enabled, the spans of the job are written to
+        tracefile(jobid) in folder_trace, see tracing.py
+        """
+        from . import tracing
+
+        folder = self.folder_trace
+        if folder is None:
+            return self._run_subset(jobid, outputfile, setup, speculative)
+
+        import socket
+        from os import makedirs
+
+        makedirs(folder, exist_ok=True)
+        filename = self.tracefile(jobid)
+        tracing.start(
+            path.join(folder, "spec_" + filename if speculative else filename),
+            jobid=jobid,
+            host=socket.gethostname(),
+            project=self.project_tag,
+        )
+        try:
+            with tracing.span("job", jobid=jobid, speculative=speculative):
+                return self._run_subset(jobid, outputfile, setup, speculative)
+        finally:
+            tracing.stop()
+
+    def _run_subset(self, jobid, outputfile, setup, speculative):
+        """Runs the grid points of a job, see run_subset"""
+        from .tracing import span
+
+        # Runs the function supplied by config on a a fraction of the parameter space
+        # Fraction depends on the number of total jobs
+        # The setup can be passed in, if it is shared between several subsets
+        if setup is None:
+            with span("setup"):
+                setup = self.conf["setup_func"]()
+        if self.work_stealing:
+            return self._run_from_queue(jobid, outputfile, setup)
+        perms = self.perm_slice(jobid)
+        func = self.conf["single_run_func"]
+        import time
+        from .costs import PointTimer
+
+        # results of each grid point are checkpointed, a restarted job skips
+        # the grid points which are already done
+        done, costs = {}, {}
+        if self.checkpointing:
+            ckpt, done = self._open_checkpoint(jobid, perms, speculative)
+            costs = ckpt.costs
+        # a speculative copy leaves the heartbeat to the original job
+        beat = None if speculative else self._open_heartbeat(jobid, len(perms), done)
+
+        # the output of a duplicated job appears once one copy has finished,
+        # the other copy stops then
+        finalfile = path.join(self.folder_out, self.outfile(jobid))
+        started = time.time()
+        try:
+            for loc, perm in enumerate(perms):
+                if loc in done:
+                    continue
+                if path.exists(finalfile) and path.getmtime(finalfile) > started:
+                    raise Exception(
+                        "Job {:} was finished by another copy".format(jobid)
+                    )
+                perm = tuple(perm)
+                with PointTimer() as timer, span("grid point", index=perm, loc=loc):
+                    done[loc] = func(setup, perm)
+                costs[loc] = timer.cost
+                if self.checkpointing:
+                    ckpt.append(loc, done[loc], costs[loc])
+                if beat is not None:
+                    beat.beat(timer.cost[0])
+        finally:
+            if self.checkpointing:
+                ckpt.close()
+
+        # Save the list of results, as pickle or as columns, see outputs.py
+        from .outputs import write_output
+
+        results = [done[loc] for loc in range(len(perms))]
+        # shards mapped by a virtual dataset store their grid positions
+        with span("write output", format=self.output_format[0]):
+            write_output(
+                results,
+                outputfile,
+                *self.output_format,
+                positions=self.grid_positions(jobid) if self.virtual_states else None,
+            )
+        print(("collected results dumped to ", outputfile))
+        self._write_checksum(jobid, outputfile, len(results))
+        self._write_costs(jobid, [costs.get(loc) for loc in range(len(perms))])
+        if self.checkpointing:
+            ckpt.remove()
+            self._remove_checkpoints(jobid)
+
+    def _open_heartbeat(self, jobid, npoints, done):
+        """Heartbeat of the job, None if disabled by config['heartbeat']"""
+        if not self.heartbeat:
+            return None
+        from .heartbeat import Heartbeat
+
+        beat = Heartbeat(
+            path.join(self.folder_log, self.heartbeatfile(jobid)),
+            jobid,
+            npoints,
+            done=len(done),
+        )
+        beat.write()
+        return beat
+
+    def _remove_checkpoints(self, jobid):
+        """Removes the checkpoints of both copies of a duplicated job"""
+        from os import remove
+
+        filepath = path.join(self.folder_ckpt, self.checkpointfile(jobid))
+        for filename in [filepath, filepath + ".spec"]:
+            if path.exists(filename):
+                remove(filename)
+
+    def _write_checksum(self, jobid, outputfile, nrecords):
+        """Writes the checksum sidecar next to the output
+
+        It is moved to the output folder together with the output
+        """
+        from .outputs import write_checksum
 
-        _ = subprocess.call(
-            ["qsub", "-t", "{:}:{:}".format(jobid, jobid), self.subfile]
+        write_checksum(outputfile, outputfile + ".json", nrecords)
+
+    def _write_costs(self, jobid, costs):
+        """Writes the costs of the grid points of a job, NaN where unknown"""
+        from os import makedirs
+        from .costs import write_costs, cost_names
+
+        nan = (float("nan"),) * len(cost_names)
+        makedirs(self.folder_cost, exist_ok=True)
+        write_costs(
+            path.join(self.folder_cost, self.costfile(jobid)),
+            [nan if cost is None else cost for cost in costs],
         )
 
-    def check_job_results(self):
-        """Check the computed output pickle files for integrity"""
+    def _run_from_queue(self, jobid, outputfile, setup):
+        """Run grid points claimed from the shared task queue until it is empty
+
+        The output contains the grid positions of the results, as they
+        differ from perm_slice(jobid)
+        """
+        func = self.conf["single_run_func"]
+        queue = self.task_queue
+        queue.populate(self.nperms)
+        owner = str(jobid)
+        from .costs import PointTimer
+        from .tracing import span
+
+        done, costs = {}, {}
+        if self.checkpointing:
+            ckpt, done = self._open_checkpoint(jobid, None)
+            costs = ckpt.costs
+        beat = self._open_heartbeat(jobid, None, done)
+
+        try:
+            while True:
+                positions = queue.claim(owner, self.queue_batch)
+                if len(positions) == 0:
+                    break
+                for pos in positions:
+                    if pos not in done:
+                        perm = tuple(self.flat_to_indices(pos)[0].tolist())
+                        with PointTimer() as timer, span(
+                            "grid point", index=perm, position=pos
+                        ):
+                            done[pos] = func(setup, perm)
+                        costs[pos] = timer.cost
+                        if self.checkpointing:
+                            ckpt.append(pos, done[pos], costs[pos])
+                        if beat is not None:
+                            beat.beat(timer.cost[0])
+                    queue.renew(owner)
+        finally:
+            if self.checkpointing:
+                ckpt.close()
+
+        from .outputs import write_output
+
+        positions = sorted(done)
+        results = [done[pos] for pos in positions]
+        with span("write output", format=self.output_format[0]):
+            write_output(
+                results,
+                outputfile,
+                *self.output_format,
+                positions=self._grid_flat(self.flat_to_indices(positions)),
+            )
+        print(("{:} results dumped to ".format(len(results)), outputfile))
+        self._write_checksum(jobid, outputfile, len(results))
+        self._write_costs(jobid, [costs.get(pos) for pos in positions])
+        queue.complete(positions)
+        if self.checkpointing:
+            ckpt.remove()
 
-        import pickle as pickle
-        import os.path as path
+    @property
+    def task_queue(self):
+        from .taskqueue import TaskQueue
+
+        if getattr(self, "_task_queue", None) is None:
+            self._task_queue = TaskQueue(
+                self.queuefile,
+                lease=self.queue_lease_hours * 3600.0,
+                journal_mode=self.queue_journal_mode,
+            )
+        return self._task_queue
 
-        # Loop over the single output files
+    def queue_status(self):
+        counts = self.task_queue.counts()
+        print("------------------------------")
+        print("task queue:")
+        for state in ["pending", "leased", "expired", "done"]:
+            print(("{:<8} {:}".format(state, counts[state])))
+        print("------------------------------")
+        return counts
+
+    def status(self, nslowest=10):
+        """Progress of the scan from the heartbeats of the jobs
+
+        Prints the current throughput of the running jobs in grid points per
+        hour, the projected completion of the scan, the running jobs with
+        the longest time per grid point, the jobs which stopped beating and
+        the projected runtime of the jobs compared to 'hours per job'.
+        The mean wall time per grid point along each parameter axis is
+        shown for the finished jobs, from their cost files.
+        """
+        import time
+        import numpy as np
+        from .heartbeat import read_heartbeat, summarize, projected_hours
+        from .manifest import DONE
+        from .scheduler import array_spec
+
+        records = []
+        for jobid in range(1, self.njobs + 1):
+            record = read_heartbeat(
+                path.join(self.folder_log, self.heartbeatfile(jobid))
+            )
+            if record is not None:
+                records.append(record)
+        if self.manifest is not None:
+            finished = self.manifest.jobs([DONE])
+        else:
+            finished = self._existing_jobs(self.folder_out, self.outfile)
+        # the heartbeats of work stealing jobs or of jobs finished by a
+        # speculative copy do not show the end of the job
+        finished_set = set(finished)
+        for record in records:
+            if record["jobid"] in finished_set:
+                record["remaining"] = 0
+
+        # grid points of the jobs, which did not start yet
+        if self.work_stealing:
+            counts = self.task_queue.counts()
+            pending = counts["pending"] + counts["leased"] + counts["expired"]
+            not_started = []
+        else:
+            beating = set(record["jobid"] for record in records)
+            not_started = [
+                jobid
+                for jobid in range(1, self.njobs + 1)
+                if jobid not in beating and jobid not in finished_set
+            ]
+            pending = sum(len(self.job_positions(jobid)) for jobid in not_started)
+
+        now = time.time()
+        summary = summarize(records, pending, now)
+        print("------------------------------")
+        print(
+            (
+                "jobs: {:} running, {:} silent, {:} finished, {:} not started".format(
+                    len(summary["running"]),
+                    len(summary["silent"]),
+                    len(finished),
+                    len(not_started),
+                )
+            )
+        )
+        print(("throughput: {:.1f} grid points per hour".format(summary["throughput"])))
+        print(("remaining:  {:} grid points".format(summary["remaining"])))
+        if summary["eta"] is not None and summary["remaining"] > 0:
+            print(
+                (
+                    "projected completion: {:} (in {:.1f} hours)".format(
+                        time.ctime(summary["eta"]), (summary["eta"] - now) / 3600.0
+                    )
+                )
+            )
+
+        slowest = sorted(
+            [rec for rec in summary["running"] if rec["seconds per point"]],
+            key=lambda rec: -rec["seconds per point"],
+        )[:nslowest]
+        if len(slowest) > 0:
+            print("------------------------------")
+            print("slowest running jobs:")
+            print(
+                (
+                    "{:>6} {:>6} {:>9} {:>9} {:>9}  {:}".format(
+                        "jobid", "done", "remaining", "s/point", "hours", "host"
+                    )
+                )
+            )
+            for rec in slowest:
+                # the remaining points of work stealing jobs are not known
+                hours = projected_hours(rec)
+                print(
+                    (
+                        "{:>6} {:>6} {:>9} {:>9.1f} {:>9}  {:}".format(
+                            rec["jobid"],
+                            rec["done"],
+                            "-" if rec["remaining"] is None else rec["remaining"],
+                            rec["seconds per point"],
+                            "-" if hours is None else "{:.2f}".format(hours),
+                            rec["host"],
+                        )
+                    )
+                )
+        if len(summary["silent"]) > 0:
+            print(
+                (
+                    "no heartbeat for 3 times their time per grid point: {:}".format(
+                        array_spec([rec["jobid"] for rec in summary["silent"]])
+                    )
+                )
+            )
+
+        hours = [
+            projected_hours(rec)
+            for rec in summary["running"] + summary["finished"]
+            if projected_hours(rec) is not None
+        ]
+        if len(hours) > 0:
+            print("------------------------------")
+            print(
+                (
+                    "projected hours per job: median {:.2f}, max {:.2f}, "
+                    "'hours per job' is {:}".format(
+                        np.median(hours), np.max(hours), self.hours_per_job
+                    )
+                )
+            )
+            late = np.count_nonzero(np.array(hours) > self.hours_per_job)
+            if late > 0:
+                print(("{:} jobs will exceed 'hours per job'".format(late)))
+
+        self._print_cost_profile(finished)
+        print("------------------------------")
+        return summary
+
+    def trace_summary(self, nspans=20):
+        """Hot spots of the traces of all jobs, see tracing.py
+
+        Prints the spans with the largest self time (without the nested
+        spans) summed over all jobs and writes all traces merged into
+        merged.json in the trace folder, one process per job.
+        """
+        import glob
+        from .tracing import summarize_traces
+
+        folder = self.folder_trace
+        if folder is None:
+            raise Exception("Tracing is not enabled, set PRINCE_TRACE or 'trace'")
+        filepaths = sorted(glob.glob(path.join(folder, "*.trace.json")))
+        if len(filepaths) == 0:
+            print(("no traces in", folder))
+            return {}
+        merged = path.join(folder, "merged.json")
+        summary = summarize_traces(filepaths, merged=merged)
+
+        total = sum(entry["self"] for entry in summary.values())
+        print("------------------------------")
+        print(("hot spots of {:} traced jobs:".format(len(filepaths))))
+        print(
+            (
+                "{:<22} {:>8} {:>10} {:>10} {:>6} {:>10}".format(
+                    "span", "count", "total [s]", "self [s]", "self", "max [s]"
+                )
+            )
+        )
+        ranked = sorted(summary.items(), key=lambda item: -item[1]["self"])
+        for name, entry in ranked[:nspans]:
+            print(
+                (
+                    "{:<22} {:>8} {:>10.1f} {:>10.1f} {:>5.1f}% {:>10.2f}".format(
+                        name[:22],
+                        entry["count"],
+                        entry["total"],
+                        entry["self"],
+                        100.0 * entry["self"] / total if total > 0 else 0.0,
+                        entry["max"],
+                    )
+                )
+            )
+        print(("merged trace written to", merged))
+        print("------------------------------")
+        return summary
+
+    def _print_cost_profile(self, jobids, name="wall time", width=40):
+        """Bars of the mean cost per grid point along each parameter axis"""
+        import numpy as np
+        from .costs import read_costs
+
+        positions, costs = [], []
+        for jobid in jobids:
+            pos = self.grid_positions(jobid)
+            costfile = path.join(self.folder_cost, self.costfile(jobid))
+            if pos is None or not path.exists(costfile):
+                continue
+            cost = read_costs(costfile, len(pos))[name]
+            positions.append(pos[: len(cost)])
+            costs.append(cost)
+        if len(costs) == 0:
+            return
+        positions, costs = np.concatenate(positions), np.concatenate(costs)
+        known = np.isfinite(costs)
+        positions, costs = positions[known], costs[known]
+        if len(costs) == 0:
+            return
+
+        if self.sampling is not None:
+            from .sampling import parse_bounds
+
+            # sample points are binned along each sampled parameter
+            names, _, _, log = parse_bounds(self.sampling["bounds"])
+            points = self.sample_points[positions]
+            points[:, log] = np.log10(points[:, log])
+            axes = []
+            for axis in range(points.shape[1]):
+                edges = np.histogram_bin_edges(points[:, axis], bins=10)
+                which = np.clip(np.digitize(points[:, axis], edges) - 1, 0, 9)
+                centers = 0.5 * (edges[1:] + edges[:-1])
+                axes.append((10 ** centers if log[axis] else centers, which))
+        else:
+            names = self.param_names
+            indices = np.unravel_index(positions, self.shape)
+            axes = list(zip(self.param_values, indices))
+
+        print("------------------------------")
+        print(("mean {:} per grid point [s] of the finished jobs:".format(name)))
+        for pname, (values, which) in zip(names, axes):
+            total = np.bincount(which, weights=costs, minlength=len(values))
+            count = np.bincount(which, minlength=len(values))
+            mean = np.where(count > 0, total / np.maximum(count, 1), np.nan)
+            scale = width / np.nanmax(mean) if np.nanmax(mean) > 0 else 0.0
+            print(pname)
+            for value, cost in zip(values, mean):
+                if np.isnan(cost):
+                    continue
+                print(
+                    (
+                        "  {:>10.4g} {:>9.3g} {:}".format(
+                            value, cost, "#" * int(round(cost * scale))
+                        )
+                    )
+                )
+
+    def run_local(self, nprocs, jobids=None):
+        """Runs the jobs on a local process pool instead of submitting them
+
+        Each worker calls setup_func once and then runs whole jobs,
+        writing the same log and output files as a job on the cluster
+        """
+        import gc
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        from os import makedirs
         from tqdm import tqdm
 
-        print("reading output files:")
-        for jobid in tqdm(list(range(1, self.njobs + 1))):
-            outputfile = path.join(self.folder_out, self.outfile(jobid))
-            with open(outputfile, "rb") as thefile:
+        if jobids is None:
+            jobids = list(range(1, self.njobs + 1))
+        makedirs(self.folder_log, exist_ok=True)
+        makedirs(self.folder_out, exist_ok=True)
+
+        print("running {:} jobs on {:} local processes:".format(len(jobids), nprocs))
+        # unreachable objects with open database connections would be closed
+        # by the garbage collection in the forked workers
+        gc.collect()
+        failed = []
+        with ProcessPoolExecutor(
+            max_workers=nprocs, initializer=_init_local_worker, initargs=(self,)
+        ) as pool:
+            futures = {pool.submit(_run_local_job, jobid): jobid for jobid in jobids}
+            for future in tqdm(as_completed(futures), total=len(futures)):
                 try:
-                    results = pickle.load(thefile)  # noqa: F841
-                except:  # noqa: E722
-                    print(("Error reading jobfile {:}".format(jobid)))
+                    future.result()
+                except Exception as e:
+                    print(("Error in job {:}: {:}".format(futures[future], e)))
+                    failed.append(futures[future])
+
+        if len(failed) != 0:
+            print(("failed jobs:", array_spec(failed)))
+        return failed
+
+    def submit_jobs(self, jobids):
+        """Submits the given job ids as a single job array"""
+        jobids = self._prepare_resubmission(jobids)
+        if len(jobids) > 0:
+            self._submit(jobids)
+
+    def _prepare_resubmission(self, jobids):
+        """Clears the files of earlier runs of the jobs, returns the jobs to submit
+
+        Jobs with a valid output (e.g. if recording the end in the manifest
+        failed) are marked as done instead. Other outputs are moved to
+        '<output folder>/replaced', as the submit script does not replace
+        existing outputs. Old log files are removed, so they are not counted
+        as started jobs.
+        """
+        import os
+        import time
+        from .manifest import DONE
 
-    def collect_job_results(self):
-        """Collect the computed results to a single array"""
+        manifest = self.manifest
+        todo, valid = [], []
+        for jobid in jobids:
+            outputfile = path.join(self.folder_out, self.outfile(jobid))
+            if os.path.exists(outputfile) and self._check_job(jobid) is None:
+                if manifest is not None:
+                    manifest.mark(jobid, DONE, size=os.path.getsize(outputfile))
+                valid.append(jobid)
+                continue
+            todo.append(jobid)
+            for filepath in [
+                path.join(self.folder_log, self.logfile(jobid)),
+                path.join(self.folder_log, self.heartbeatfile(jobid)),
+            ]:
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+            folder = path.join(self.folder_out, "replaced")
+            for filename in [self.outfile(jobid), self.checksumfile(jobid)]:
+                filepath = path.join(self.folder_out, filename)
+                if os.path.exists(filepath):
+                    os.makedirs(folder, exist_ok=True)
+                    os.replace(
+                        filepath,
+                        path.join(folder, "{:}.{:.0f}".format(filename, time.time())),
+                    )
+        if len(valid) > 0:
+            print(("jobs with a valid output, marked as done:", array_spec(valid)))
+        return todo
+
+    def submit_missing_jobs(self):
         _, missing = self.scan_output()
-        if len(missing) != 0:
+        self.submit_jobs(_expand_ranges(missing))
+
+    def submit_single_job(self, jobid):
+        self._submit([jobid])
+
+    def find_stragglers(self, factor=None):
+        """Running jobs, which are slower than the median finished job by factor
+
+        The progress of a running job is the number of grid points in its
+        checkpoint. A job is a straggler, if a job running at the median rate
+        of the finished jobs would have computed factor times as many grid
+        points. Returns a list of (jobid, points done, points expected).
+        """
+        import time
+        import numpy as np
+        from .checkpoint import scan_records
+        from .manifest import RUNNING, DONE
+
+        factor = self.straggler_factor if factor is None else factor
+        manifest = self.manifest
+        if manifest is None or self.work_stealing:
             raise Exception(
-                "Cannot collect results, not all results were computed yet!"
+                "Straggler detection needs the job manifest and fixed job slices"
+            )
+
+        rates = [
+            len(self.job_positions(info["jobid"]))
+            / (info["finished"] - info["started"])
+            for info in manifest.entries([DONE])
+            if info["started"] is not None
+            and info["finished"] is not None
+            and info["finished"] > info["started"]
+        ]
+        if len(rates) < self.straggler_min_done:
+            print(
+                ("only {:} finished jobs, cannot detect stragglers".format(len(rates)))
+            )
+            return []
+        rate = np.median(rates)
+
+        now = time.time()
+        stragglers = []
+        for info in manifest.entries([RUNNING]):
+            if info["started"] is None or info["duplicates"] >= self.max_duplicates:
+                continue
+            jobid = info["jobid"]
+            npoints = len(self.job_positions(jobid))
+            expected = rate * (now - info["started"])
+            if self.checkpointing:
+                done, _ = scan_records(
+                    path.join(self.folder_ckpt, self.checkpointfile(jobid))
+                )
+                slow = expected > factor * max(done, 1)
+            else:
+                # without checkpoints, only the total runtime is known
+                done = 0
+                slow = expected > factor * npoints
+            if slow:
+                stragglers.append((jobid, done, expected))
+        return stragglers
+
+    def submit_stragglers(self, factor=None):
+        """Submits a speculative duplicate of each straggling job
+
+        Both copies run until one of them links its output to the output
+        folder, the output of the other one is discarded.
+        """
+        stragglers = self.find_stragglers(factor)
+        print("------------------------------")
+        print(("{:} stragglers:".format(len(stragglers))))
+        for jobid, done, expected in stragglers:
+            print(
+                (
+                    "job {:}: {:} grid points done, {:.1f} at the median rate".format(
+                        jobid, done, expected
+                    )
+                )
+            )
+        print("------------------------------")
+        for jobid, _, _ in stragglers:
+            if (
+                self.scheduler.submit(self.subfile, [jobid], env={"SPECULATIVE": "1"})
+                == 0
+            ):
+                self.manifest.mark_duplicate(jobid)
+        return [jobid for jobid, _, _ in stragglers]
+
+    def run_daemon(self, nprocs=1):
+        """Submits, resubmits and collects the project until all jobs are done
+
+        See daemon.JobController, nprocs is passed to --collect
+        """
+        from .daemon import JobController
+
+        if self.manifest is None:
+            raise Exception("The daemon needs the job manifest, see --rebuild-manifest")
+        JobController(
+            self,
+            max_queued=self.max_queued,
+            max_retries=self.max_retries,
+            poll_interval=60 * self.poll_minutes,
+            nprocs=nprocs,
+        ).run()
+
+    def _check_job(self, jobid):
+        """Reason why the output of a job is corrupt, None if it is fine"""
+        import os
+        from .outputs import verify_checksum, read_output, count_records
+
+        outputfile = path.join(self.folder_out, self.outfile(jobid))
+        sidecarfile = path.join(self.folder_out, self.checksumfile(jobid))
+        if not os.path.exists(outputfile):
+            return None
+        reason = verify_checksum(outputfile, sidecarfile)
+        if reason is None:
+            return None
+
+        # fully decode only the outputs failing the checksum test
+        try:
+            nrecords = count_records(read_output(outputfile))
+        except Exception as e:
+            return "{:}, cannot be read: {:}".format(reason, e)
+        if reason == "no checksum":
+            expected = len(self.job_positions(jobid))
+            if not self.work_stealing and nrecords != expected:
+                return "{:} records instead of {:}".format(nrecords, expected)
+            return None
+        return reason
+
+    def check_job_results(self, nthreads=8):
+        """Check the computed output files for integrity
+
+        The outputs are compared with their checksum sidecars on nthreads
+        threads, only outputs without or with a mismatching checksum are
+        decoded. Returns the ids of the corrupt jobs.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from tqdm import tqdm
+
+        jobids = list(range(1, self.njobs + 1))
+        print("checking output files:")
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            reasons = list(tqdm(pool.map(self._check_job, jobids), total=len(jobids)))
+
+        corrupt = [jobid for jobid, reason in zip(jobids, reasons) if reason]
+        print("------------------------------")
+        for jobid, reason in zip(jobids, reasons):
+            if reason:
+                print(("Error in jobfile {:}: {:}".format(jobid, reason)))
+        print(("corrupt jobs:", array_spec(corrupt) if corrupt else "none"))
+        print("------------------------------")
+
+        manifest = self.manifest
+        if manifest is not None:
+            for jobid in corrupt:
+                manifest.mark(jobid, "failed")
+        return corrupt
+
+    def load_output(self, jobid):
+        """Reads the output file of a single job"""
+        from .collect import load_output_file
+
+        try:
+            return load_output_file(path.join(self.folder_out, self.outfile(jobid)))
+        except:  # noqa: E722
+            print(("Error reading jobfile {:}".format(jobid)))
+            raise
+
+    def _grid_flat(self, indices):
+        """Flat positions in the full parameter grid of index tuples"""
+        import numpy as np
+
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1, len(self.shape))
+        return np.ravel_multi_index(tuple(indices.T), self.shape)
+
+    def grid_positions(self, jobid):
+        """Flat positions in the full parameter grid computed by job jobid
+
+        None with work stealing, then the positions are read from the outputs
+        """
+        if self.work_stealing:
+            return None
+        elif self._perm_subset is None:
+            return self.job_positions(jobid)
+        else:
+            return self._grid_flat(self.perm_slice_array(jobid))
+
+    def _write_sample_points(self, h5file):
+        """Stores the parameter values of a sampled scan next to the results"""
+        from .sampling import read_samples
+
+        names, points = read_samples(self.samplefile)
+        dset = h5file.create_dataset("sample points", data=points)
+        dset.attrs["names"] = names
+        dset.attrs["method"] = self.sampling.get("method", "sobol")
+
+    def _require_manifest(self, group, reset=False):
+        """Dataset in the hdf5 group, which marks the already collected jobs"""
+        grp = group.require_group("manifest")
+        d_jobs = grp.require_dataset(
+            "jobs" + self._stage_tag, (self.njobs,), dtype=bool, fillvalue=False
+        )
+        if reset:
+            d_jobs[:] = False
+        return d_jobs
+
+    def _require_cost_datasets(self, group):
+        """Datasets in the 'cost' subgroup for the runtime costs of the grid points"""
+        import numpy as np
+        from .costs import cost_names
+
+        grp = group.require_group("cost")
+        return {
+            name: grp.require_dataset(
+                name, self.shape, dtype=np.float64, fillvalue=np.nan
             )
+            for name in cost_names
+        }
 
+    def _jobs_to_collect(self, d_jobs, incremental):
+        """Finished jobs, which are not yet marked in the manifest"""
+        import numpy as np
+
+        found, missing = self.scan_output()
+        if not incremental and len(missing) != 0:
+            raise Exception(
+                "Cannot collect results, not all results were computed yet!"
+            )
+        collected = d_jobs[:]
+        todo = [jobid for jobid in _expand_ranges(found) if not collected[jobid - 1]]
+        print(
+            (
+                "jobs already collected: {:}, new: {:}, still missing: {:}".format(
+                    np.count_nonzero(collected), len(todo), len(_expand_ranges(missing))
+                )
+            )
+        )
+        return todo
+
+    def collect_job_results(self, incremental=True, nprocs=1):
+        """Collect the computed results to a single array
+
+        With incremental=True, only finished jobs not yet contained in
+        collected.hdf5 are read, grid points without results are NaN.
+        The output files are decoded on nprocs processes.
+        With config['virtual states'] the states are not copied, 'states' is
+        a virtual dataset of the states in the hdf5 shards, which is
+        rebuilt by each collection.
+        """
         import numpy as np
-        import pickle as pickle
-        import os.path as path
 
         # Create an array of the needed size
         shape = tuple(arr.size for arr in self.param_values)
@@ -414,147 +1978,589 @@ class PropagationProject(object):
         # create a hdf5 file to store the data intensive stuff
         import h5py
 
-        h5file = h5py.File(path.join(self.targetdir, "collected.hdf5"), "w")
+        from .collect import (
+            states_layout_kwargs,
+            states_dtype,
+            chunk_cache_kwargs,
+            open_states,
+            SparseStates,
+            virtual_states,
+        )
 
-        # read first output to get the grid dimensions
-        outputfile = path.join(self.folder_out, self.outfile(1))
-        with open(outputfile, "rb") as thefile:
-            try:
-                results = pickle.load(thefile)
-            except:
-                print(("Error reading jobfile {:}".format(1)))
-                raise
-
-        chi2, minres, results = results[0]
-        egrid = results[0]["egrid"]
-        state = results[0]["state"]
-        known_spec = np.array(results[0]["known_spec"], dtype=np.int)
-        frac = np.array(minres[1][2:])
-        injected = len(results)
+        layout = self.conf["states layout"] if "states layout" in self.conf else {}
+        filepath = path.join(self.targetdir, "collected.hdf5")
+        # the stages of an adaptive scan share the file, only reset the manifest
+        staged = self.refinement is not None
+        h5file = h5py.File(
+            filepath,
+            "a" if incremental or staged else "w",
+            **chunk_cache_kwargs(layout.get("cache MB", None)),
+        )
+        d_jobs = self._require_manifest(h5file, reset=staged and not incremental)
+        todo = self._jobs_to_collect(d_jobs, incremental)
+        if len(todo) == 0:
+            h5file.close()
+            return
+
+        if "egrid" not in h5file:
+            # read first output with results to get the grid dimensions
+            from .outputs import read_columns
+
+            for jobid in todo:
+                columns = read_columns(path.join(self.folder_out, self.outfile(jobid)))
+                if columns is not None and "states" in columns:
+                    break
+            else:
+                raise Exception("No results in any of the collected jobs")
+            egrid = columns["egrid"]
+            known_spec = np.array(columns["known_spec"], dtype=np.int64)
+            injected, state_size = columns["states"].shape[1:]
+            nfrac = columns["fit params"].shape[1] - 2
+
+            # create datasets on hdf5
+            dset = h5file.create_dataset("egrid", (egrid.size,), dtype=np.float64)
+            dset[:] = egrid
+            dset = h5file.create_dataset(
+                "known_spec", (known_spec.size,), dtype=np.int32
+            )
+            dset[:] = known_spec
+            if self.virtual_states:
+                virtual_states(h5file, shape, (injected, state_size), [])
+            elif "sparse threshold" in layout:
+                SparseStates.create(
+                    h5file, shape, (injected, state_size), known_spec.size, layout
+                )
+            else:
+                h5file.create_dataset(
+                    "states",
+                    shape + (injected, state_size),
+                    dtype=states_dtype(layout),
+                    fillvalue=np.nan,
+                    **states_layout_kwargs(layout, shape, (injected, state_size)),
+                )
+            grp = h5file.create_group("default fit")
+            for name in ["chi2", "norm", "delta E", "xmax_shift"]:
+                grp.create_dataset(name, shape, dtype=np.float64, fillvalue=np.nan)
+            grp.create_dataset(
+                "fractions", shape + (nfrac,), dtype=np.float64, fillvalue=np.nan
+            )
+            if self.sampling is not None:
+                self._write_sample_points(h5file)
+
+        grp = h5file["default fit"]
+        names = ["chi2", "norm", "delta E", "xmax_shift", "fractions"]
+        datasets = {name: grp[name] for name in names}
+        datasets["states"] = open_states(h5file)
+        datasets["computed"] = h5file.require_dataset(
+            "computed", shape, dtype=bool, fillvalue=False
+        )
+        datasets.update(self._require_cost_datasets(h5file))
+        state_shape = datasets["states"].shape[len(shape) :]
+        if self.extends is not None and "extended from" not in h5file.attrs:
+            self._merge_extended(h5file, datasets, shape)
 
-        # create datasets on hdf5
-        dset = h5file.create_dataset("egrid", (egrid.size,), dtype=np.float64)
-        dset[:] = egrid
-        dset = h5file.create_dataset("known_spec", (known_spec.size,), dtype=np.int32)
-        dset[:] = known_spec
-        d_states = h5file.create_dataset(
-            "states", shape + (injected, state.size), dtype=np.float64
-        )
-        grp = h5file.create_group("default fit")
-        d_chi2 = grp.create_dataset("chi2", shape, dtype=np.float64)
-        d_norm = grp.create_dataset("norm", shape, dtype=np.float64)
-        d_deltaE = grp.create_dataset("delta E", shape, dtype=np.float64)
-        d_xshift = grp.create_dataset("xmax_shift", shape, dtype=np.float64)
-        d_fractions = grp.create_dataset(
-            "fractions", shape + (frac.size,), dtype=np.float64
-        )
-
-        # Loop over the single output files
+        # Decode the single output files and write them in sorted batches
         from tqdm import tqdm
+        from .collect import (
+            decode_job_output,
+            decode_shard_fits,
+            decode_pipeline,
+            BlockWriter,
+        )
 
+        if self.virtual_states:
+            # only the fit results are copied, the states stay in the shards
+            decode = decode_shard_fits
+            del datasets["states"]
+        else:
+            decode = decode_job_output
+        tasks = [
+            (
+                jobid,
+                (
+                    path.join(self.folder_out, self.outfile(jobid)),
+                    self.grid_positions(jobid),
+                    state_shape[0] if self.virtual_states else state_shape,
+                    path.join(self.folder_cost, self.costfile(jobid)),
+                ),
+            )
+            for jobid in todo
+        ]
+        writer = BlockWriter(h5file, datasets, shape, d_jobs)
         print("reading output files:")
-        for jobid in tqdm(list(range(1, self.njobs + 1))):
-            outputfile = path.join(self.folder_out, self.outfile(jobid))
-            with open(outputfile, "rb") as thefile:
-                try:
-                    results = pickle.load(thefile)
-                except:
-                    print(("Error reading jobfile {:}".format(jobid)))
-                    raise
-
-            # write to arrays
-            for res, perm in zip(results, self.perm_slice(jobid)):
-                perm = tuple(perm)
-                chi2, minres, results = res
-                if chi2 == minres == results == np.inf:
-                    # Something went wrong in this case, no data there, just continue
-                    d_chi2[perm] = np.inf
-                    continue
-                stack = np.vstack([r["state"] for r in results])
-                dE = minres[1][0]
-                xshift = minres[1][1]
-                norm = sum(minres[1][2:])
-                frac = [f / norm for f in minres[1][2:]]
-
-                d_states[perm] = stack
-                d_chi2[perm] = chi2
-                d_norm[perm] = norm
-                d_deltaE[perm] = dE
-                d_xshift[perm] = xshift
-                d_fractions[perm] = frac
-                h5file.flush()
+        for jobid, block in tqdm(
+            decode_pipeline(decode, tasks, nprocs=nprocs), total=len(tasks)
+        ):
+            writer.add(jobid, block)
+        writer.write()
+        if self.virtual_states:
+            self._map_virtual_states(h5file, shape, state_shape, d_jobs)
 
         h5file.flush()
         h5file.close()
 
-    def collect_fit_results(self):
-        """Collect the computed results to a single array"""
-        _, missing = self.scan_output()
-        if len(missing) != 0:
-            raise Exception(
-                "Cannot collect results, not all results were computed yet!"
-            )
+    def _map_virtual_states(self, h5file, shape, state_shape, d_jobs):
+        """Maps the states of all collected jobs of the stage as virtual dataset
 
+        The shards of earlier refinement stages stay mapped
+        """
         import numpy as np
-        import pickle as pickle
-        import os.path as path
+        from .collect import shard_rows, virtual_states
+
+        folder = path.relpath(self.folder_out, self.targetdir)
+        shards = []
+        for jobid in np.flatnonzero(d_jobs[:]) + 1:
+            rows = shard_rows(
+                path.join(self.folder_out, self.outfile(jobid)),
+                self.grid_positions(jobid),
+            )
+            if rows is not None:
+                shards.append((path.join(folder, self.outfile(jobid)), rows))
+        virtual_states(
+            h5file,
+            shape,
+            state_shape,
+            shards,
+            keep=lambda filename: path.dirname(filename) != folder,
+        )
+        print(("states of {:} shards mapped".format(len(shards))))
 
-        # Create an array of the needed size
-        shape = tuple(arr.size for arr in self.param_values)
+    def collect_fit_results(self, incremental=True, nprocs=1):
+        """Collect the computed results to a single array
+
+        With incremental=True, only finished jobs not yet contained in
+        the fit group of collected.hdf5 are read.
+        The output files are decoded on nprocs processes.
+        With config['fit configs'], the fits are collected to one group each.
+        """
+        shape = self.shape
 
         # create a hdf5 file to store the data intensive stuff
         import h5py
 
         h5file = h5py.File(path.join(self.targetdir, "collected.hdf5"), "r+")
-
-        # read first output to get the grid dimensions
-        outputfile = path.join(self.folder_out, self.outfile(1))
-        with open(outputfile, "rb") as thefile:
-            results = pickle.load(thefile)
-
-        chi2, minres = results[0]
-        frac = np.array(minres[1][2:])
+        grp = h5file.require_group(self.fit_tag)
+        d_jobs = self._require_manifest(grp, reset=not incremental)
+        todo = self._jobs_to_collect(d_jobs, incremental)
+        if len(todo) == 0:
+            h5file.close()
+            return
+        if self.fit_configs is not None:
+            return self._collect_multi_fit_results(h5file, grp, d_jobs, todo, nprocs)
+
+        # read first output with results to get the grid dimensions
+        from .outputs import read_columns
+
+        for jobid in todo:
+            columns = read_columns(path.join(self.folder_out, self.outfile(jobid)))
+            if columns is not None and "fit params" in columns:
+                break
+        else:
+            raise Exception("No fit results in any of the collected jobs")
+        nfrac = columns["fit params"].shape[1] - 2
 
         # create datasets on hdf5
-        grp = h5file.require_group(self.fit_tag)
-        d_chi2 = grp.require_dataset("chi2", shape, dtype=np.float64)
-        d_norm = grp.require_dataset("norm", shape, dtype=np.float64)
-        d_deltaE = grp.require_dataset("delta E", shape, dtype=np.float64)
-        d_xshift = grp.require_dataset("xmax_shift", shape, dtype=np.float64)
-        d_fractions = grp.require_dataset(
-            "fractions", shape + (frac.size,), dtype=np.float64
-        )
+        datasets = self._fit_datasets(grp, nfrac)
+        datasets.update(self._require_cost_datasets(grp))
 
-        # Loop over the single output files
+        # Decode the single output files and write them in sorted batches
         from tqdm import tqdm
+        from .collect import decode_fit_output, decode_pipeline, BlockWriter
 
+        tasks = [
+            (
+                jobid,
+                (
+                    path.join(self.folder_out, self.outfile(jobid)),
+                    self.grid_positions(jobid),
+                    nfrac,
+                    path.join(self.folder_cost, self.costfile(jobid)),
+                ),
+            )
+            for jobid in todo
+        ]
+        writer = BlockWriter(h5file, datasets, shape, d_jobs)
         print("reading output files:")
-        for jobid in tqdm(list(range(1, self.njobs + 1))):
-            outputfile = path.join(self.folder_out, self.outfile(jobid))
-            with open(outputfile, "rb") as thefile:
-                results = pickle.load(thefile)
+        for jobid, block in tqdm(
+            decode_pipeline(decode_fit_output, tasks, nprocs=nprocs), total=len(tasks)
+        ):
+            writer.add(jobid, block)
+        writer.write()
 
-            # write to arrays
-            for res, perm in zip(results, self.perm_slice(jobid)):
-                chi2, minres = res
-                dE = minres[1][0]
-                xshift = minres[1][1]
-                norm = sum(minres[1][2:])
-                frac = [f / norm for f in minres[1][2:]]
+        h5file.flush()
+        h5file.close()
 
-                perm = tuple(perm)
-                d_chi2[perm] = chi2
-                d_norm[perm] = norm
-                d_deltaE[perm] = dE
-                d_xshift[perm] = xshift
-                d_fractions[perm] = frac
-                h5file.flush()
+    def _fit_datasets(self, grp, nfrac):
+        """Datasets of the fit results in grp, created if needed"""
+        import numpy as np
+
+        shape = self.shape
+        datasets = {
+            name: grp.require_dataset(name, shape, dtype=np.float64, fillvalue=np.nan)
+            for name in ["chi2", "norm", "delta E", "xmax_shift"]
+        }
+        datasets["fractions"] = grp.require_dataset(
+            "fractions", shape + (nfrac,), dtype=np.float64, fillvalue=np.nan
+        )
+        datasets["computed"] = grp.require_dataset(
+            "computed", shape, dtype=bool, fillvalue=False
+        )
+        return datasets
+
+    def _collect_multi_fit_results(self, h5file, grp, d_jobs, todo, nprocs):
+        """Collects the fits of all configurations to the group of each fit_tag
+
+        The collected jobs and the runtime costs are stored in the group of
+        the project's own fit_tag, as all fits share them.
+        """
+        from tqdm import tqdm
+        from .collect import decode_multi_fit_output, decode_pipeline, BlockWriter
+        from .outputs import read_columns
+
+        tags = [conf["fit_tag"] for conf in self.fit_configs]
+        # read outputs until each fit has results to get the grid dimensions
+        nfracs = {}
+        for jobid in todo:
+            columns = read_columns(path.join(self.folder_out, self.outfile(jobid)))
+            if columns is None:
+                continue
+            for tag in tags:
+                if tag not in nfracs and tag + "/fit params" in columns:
+                    nfracs[tag] = columns[tag + "/fit params"].shape[1] - 2
+            if len(nfracs) == len(tags):
+                break
+        else:
+            raise Exception(
+                "No results of the fits {:} in any of the collected jobs".format(
+                    [tag for tag in tags if tag not in nfracs]
+                )
+            )
+
+        datasets = self._require_cost_datasets(grp)
+        for tag in tags:
+            for name, dset in self._fit_datasets(
+                h5file.require_group(tag), nfracs[tag]
+            ).items():
+                datasets[tag + "/" + name] = dset
+
+        tasks = [
+            (
+                jobid,
+                (
+                    path.join(self.folder_out, self.outfile(jobid)),
+                    self.grid_positions(jobid),
+                    nfracs,
+                    path.join(self.folder_cost, self.costfile(jobid)),
+                ),
+            )
+            for jobid in todo
+        ]
+        writer = BlockWriter(h5file, datasets, self.shape, d_jobs)
+        print(("reading output files of {:} fits:".format(len(tags))))
+        for jobid, block in tqdm(
+            decode_pipeline(decode_multi_fit_output, tasks, nprocs=nprocs),
+            total=len(tasks),
+        ):
+            writer.add(jobid, block)
+        writer.write()
 
         h5file.flush()
         h5file.close()
 
-    def collect_fireball_results(self, superphotos=False):
-        """Collect the computed results to a single array"""
+    def balance_jobs(self, njobs=None, costfile=None, group="cost", name="wall time"):
+        """Partitions the grid points into jobs of equal predicted runtime
+
+        The costs are read from the group of a collected.hdf5 with the same
+        grid, by default the 'cost' group of this project. Grid points
+        without costs are predicted by the additive model in costs.py.
+        The partition is written to partition.npz in the project folder,
+        set it as 'partition file' in the config to use it.
+        """
+        import numpy as np
+        import h5py
+        from .costs import fit_cost_model, lpt_partition, save_partition
+
+        njobs = self.njobs if njobs is None else njobs
+        if costfile is None:
+            costfile = path.join(self.targetdir, "collected.hdf5")
+        with h5py.File(costfile, "r") as h5file:
+            costs = h5file[group][name][()]
+        if costs.shape != self.shape:
+            raise Exception(
+                "Error: costs of shape {:} for grid of shape {:}".format(
+                    costs.shape, self.shape
+                )
+            )
+        print(
+            (
+                "costs known for {:} of {:} grid points".format(
+                    np.count_nonzero(np.isfinite(costs)), costs.size
+                )
+            )
+        )
+        costs = fit_cost_model(costs)
+        if self._perm_subset is None:
+            costs = costs.ravel()
+        else:
+            costs = costs[tuple(self._subset_array.T)]
+
+        positions, loads = lpt_partition(costs, njobs)
+        if self.fit_only:
+            filename = path.join(self.targetdir, "partition_" + self.fit_tag + ".npz")
+        else:
+            filename = path.join(self.targetdir, "partition.npz")
+        save_partition(filename, positions)
+
+        hours = loads / 3600.0
+        total, longest = costs.sum() / 3600.0, costs.max() / 3600.0
+        print("------------------------------")
+        print(("predicted hours per job for {:} jobs:".format(njobs)))
+        print(
+            (
+                "max {:.2f}, mean {:.2f}, min {:.2f}".format(
+                    hours.max(), hours.mean(), hours.min()
+                )
+            )
+        )
+        # the longest job of the LPT partition exceeds the mean by at most
+        # the longest grid point
+        if longest < self.hours_per_job:
+            print(
+                (
+                    "jobs needed for {:} hours per job: {:}".format(
+                        self.hours_per_job,
+                        int(np.ceil(total / (self.hours_per_job - longest))),
+                    )
+                )
+            )
+        else:
+            print(("single grid points need up to {:.2f} hours".format(longest)))
+        print(("partition written to", filename))
+        print("------------------------------")
+        return positions, loads
+
+    def pilot(self, npoints, nprocs=1, margin=1.3, write_config=False, seed=None):
+        """Estimates the resources of the scan from npoints random grid points
+
+        The grid points are computed locally (on nprocs forked processes
+        sharing one setup) and their results discarded. From the wall time,
+        the peak memory and the output size per grid point, the total core
+        hours, the wall time of the jobs, the number of jobs for 'hours per
+        job' and the sizes of the outputs and collected.hdf5 are predicted.
+        The job wall time is the sum of its grid points plus two standard
+        deviations, times margin. With write_config, njobs, 'hours per job'
+        and 'max memory GB' are replaced in the input file (and the run file
+        of an existing project). Returns the estimates as dict.
+        """
+        import gc
+        import tempfile
+        import numpy as np
+        from .costs import PointTimer
+        from .outputs import write_output, results_to_columns
+
+        if self.sampling is not None and not path.exists(self.samplefile):
+            raise Exception("Create the sampled project with -c before the pilot")
+        rng = np.random.default_rng(seed)
+        positions = np.sort(
+            rng.choice(self.nperms, size=min(npoints, self.nperms), replace=False)
+        )
+        perms = [tuple(idx) for idx in self.flat_to_indices(positions).tolist()]
+
+        print(("pilot run of {:} grid points:".format(len(perms))))
+        with PointTimer() as timer:
+            setup = self.conf["setup_func"]()
+        setup_seconds = timer.cost[0]
+        func = self.conf["single_run_func"]
+        if nprocs is None or nprocs <= 1:
+            runs = []
+            for perm in perms:
+                with PointTimer() as timer:
+                    result = func(setup, perm)
+                runs.append((result, timer.cost))
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+
+            # the forked workers share the setup of this process
+            gc.collect()
+            with ProcessPoolExecutor(
+                max_workers=nprocs,
+                initializer=_init_local_worker,
+                initargs=(self, setup),
+            ) as pool:
+                runs = list(pool.map(_run_pilot_point, perms))
+        results = [result for result, _ in runs]
+        wall, cpu, rss = np.array([cost for _, cost in runs]).T
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpfile = path.join(tmpdir, "pilot.out")
+            write_output(results, tmpfile, *self.output_format)
+            output_bytes = path.getsize(tmpfile) / float(len(results))
+
+        # the columns of the results are the datasets of collected.hdf5,
+        # with the costs (3 floats) and the computed flag per grid point
+        columns = results_to_columns(results)
+        collected_bytes = None
+        if columns is not None:
+            from .collect import states_dtype
+
+            collected_bytes = 8 * 3 + 1
+            for name, arr in columns.items():
+                size = int(np.prod(arr.shape[1:]))
+                if name.split("/")[-1] != "states":
+                    collected_bytes += arr.dtype.itemsize * size
+                elif not self.virtual_states:
+                    layout = self.conf.get("states layout", None)
+                    collected_bytes += states_dtype(layout).itemsize * size
+
+        def job_seconds(nper):
+            # sum of nper grid points plus two standard deviations
+            spread = 2 * np.std(wall) * np.sqrt(nper)
+            return margin * (setup_seconds + nper * np.mean(wall) + spread)
+
+        limit = 3600.0 * self.hours_per_job
+        nper = int(np.ceil(self.nperms / float(self.njobs)))
+        if job_seconds(1) > limit:
+            njobs = self.nperms
+        else:
+            # the most grid points per job within hours per job
+            low, high = 1, self.nperms
+            while low < high:
+                mid = (low + high + 1) // 2
+                if job_seconds(mid) <= limit:
+                    low = mid
+                else:
+                    high = mid - 1
+            njobs = int(np.ceil(self.nperms / float(low)))
+        nper_new = int(np.ceil(self.nperms / float(njobs)))
+
+        estimate = {
+            "setup seconds": setup_seconds,
+            "seconds per point": float(np.mean(wall)),
+            "cpu seconds per point": float(np.mean(cpu)),
+            "max seconds per point": float(np.max(wall)),
+            "peak memory MB": float(np.max(rss)),
+            "output bytes per point": output_bytes,
+            "core hours": float(
+                (self.nperms * np.mean(wall) + njobs * setup_seconds) / 3600.0
+            ),
+            "job hours": float(job_seconds(nper) / 3600.0),
+            "njobs": njobs,
+            "hours per job": float(np.ceil(2 * job_seconds(nper_new) / 3600.0) / 2),
+            "max memory GB": float(np.ceil(2 * margin * np.max(rss) / 1024.0) / 2),
+            "output GB": self.nperms * output_bytes / 2.0**30,
+            "collected GB": (
+                None
+                if collected_bytes is None
+                else self.nperms * collected_bytes / 2.0**30
+            ),
+        }
+
+        print("------------------------------")
+        print(
+            (
+                "setup {:.1f} s, per grid point: wall {:.1f} s (max {:.1f}), "
+                "cpu {:.1f} s, peak memory {:.0f} MB, output {:.0f} kB".format(
+                    setup_seconds,
+                    np.mean(wall),
+                    np.max(wall),
+                    np.mean(cpu),
+                    np.max(rss),
+                    output_bytes / 1024.0,
+                )
+            )
+        )
+        print(
+            (
+                "{:} grid points: {:.0f} core hours, outputs {:.2f} GB".format(
+                    self.nperms, estimate["core hours"], estimate["output GB"]
+                )
+            )
+        )
+        if estimate["collected GB"] is not None:
+            print(
+                (
+                    "collected.hdf5: {:.2f} GB (uncompressed)".format(
+                        estimate["collected GB"]
+                    )
+                )
+            )
+        print(
+            (
+                "{:} jobs with {:} grid points: {:.2f} hours per job "
+                "(margin {:}), 'hours per job' is {:}".format(
+                    self.njobs,
+                    nper,
+                    estimate["job hours"],
+                    margin,
+                    self.hours_per_job,
+                )
+            )
+        )
+        if job_seconds(1) > limit:
+            print(
+                (
+                    "a single grid point needs {:.2f} hours, "
+                    "increase 'hours per job'".format(job_seconds(1) / 3600.0)
+                )
+            )
+        print(
+            (
+                "recommended: njobs {:}, 'hours per job' {:}, 'max memory GB' {:}".format(
+                    njobs, estimate["hours per job"], estimate["max memory GB"]
+                )
+            )
+        )
+        print("------------------------------")
+
+        if write_config:
+            values = {
+                "njobs": njobs,
+                "hours per job": estimate["hours per job"],
+                "max memory GB": estimate["max memory GB"],
+            }
+            for filepath in [self.inputpath, self.runfile]:
+                if path.exists(filepath):
+                    self._write_config_values(filepath, values)
+        return estimate
+
+    def _write_config_values(self, filepath, values):
+        """Replaces the numbers of config keys like '"njobs": 9000' in a file"""
+        import numbers
+        import re
+
+        with open(filepath) as thefile:
+            text = thefile.read()
+        for key, value in values.items():
+            pattern = r"""(["']{:}["']\s*:\s*)[-+0-9.eE]+""".format(re.escape(key))
+            if len(re.findall(pattern, text)) != 1:
+                print(
+                    (
+                        "'{:}' is not set once in {:}, set it to {:} by hand".format(
+                            key, filepath, value
+                        )
+                    )
+                )
+                continue
+            # exact literals, ints like njobs must not become floats like 1e+06
+            if isinstance(value, numbers.Integral):
+                literal = str(int(value))
+            else:
+                literal = repr(float(value))
+            text = re.sub(pattern, lambda match: match.group(1) + literal, text)
+            self.conf[key] = value
+        with open(filepath, "w") as thefile:
+            thefile.write(text)
+        print(("config written to", filepath))
+
+    def collect_fireball_results(self, superphotos=False, nprocs=1):
+        """Collect the ReMuS fireballs of all jobs to collected.hdf5
+
+        The last parameter is the composition, the fireballs are stored in
+        one group per composition tag with the shape of the other parameters.
+        With superphotos=True, the superphotospheric collisions are collected
+        to collected_super_photos.hdf5 in the same pass over the outputs.
+        The output files are decoded on nprocs processes.
+        """
         _, missing = self.scan_output()
         if len(missing) != 0:
             raise Exception(
@@ -562,110 +2568,131 @@ class PropagationProject(object):
             )
 
         print(
-            ("Will only collect superphotospheric collisions: {:}".format(superphotos))
+            ("Will also collect superphotospheric collisions: {:}".format(superphotos))
         )
 
         import numpy as np
-        import pickle as pickle
-        import os.path as path
-
-        # Create an array of the needed size
-        shape = tuple(arr.size for arr in self.param_values)
 
-        # create a hdf5 file to store the data intensive stuff
-        import h5py
+        # use first two parameters to determine array shape, last one assumed to be composition
+        shape = tuple(len(ls) for ls in self.param_values[:-1])
+        comp_tags = np.array(
+            [
+                "mixed" if len(comp) > 1 else str(list(comp.keys())[0])
+                for comp in self.param_values[-1]
+            ]
+        )
 
-        if superphotos:
-            h5file = h5py.File(
-                path.join(self.targetdir, "collected_super_photos.hdf5"), "a"
+        def task(jobid):
+            return (
+                jobid,
+                (
+                    path.join(self.folder_out, self.outfile(jobid)),
+                    self.grid_positions(jobid),
+                    self.shape,
+                    comp_tags,
+                    superphotos,
+                ),
             )
-        else:
-            h5file = h5py.File(path.join(self.targetdir, "collected.hdf5"), "a")
 
-        # read first output to get the grid dimensions
-        outputfile = path.join(self.folder_out, self.outfile(1))
-        with open(outputfile, "rb") as thefile:
-            try:
-                results = pickle.load(thefile)
-            except:  # noqa: E722
-                print(("Error reading jobfile {:}".format(1)))
-                raise
+        from .collect import decode_fireball_output, decode_pipeline, BlockWriter
 
-        if superphotos:
-            try:
-                egrid = results[0].specCosmicRays.source_energy
-            except:  # noqa: E722
-                egrid = results[0].specAllCosmicRays.source_energy
+        # the shapes of the datasets are taken from one job per composition
+        # tag, with fixed slices it is found from the grid positions, with
+        # work stealing the outputs are decoded in turn. Only the shapes are
+        # kept, all jobs are decoded in parallel below.
+        if self.work_stealing:
+            probes = range(1, self.njobs + 1)
         else:
-            egrid = results[0].specAllCosmicRays.source_energy
-
-        grp = h5file.require_group("source")
-        dset_egrid = grp.require_dataset("egrid", (egrid.size,), dtype=np.float64)
-        dset_egrid[:] = egrid
+            probes = []
+            tags = set(comp_tags)
+            for jobid in range(1, self.njobs + 1):
+                comps = np.unravel_index(self.grid_positions(jobid), self.shape)[-1]
+                if len(tags & set(comp_tags[comps])) > 0:
+                    probes.append(jobid)
+                    tags -= set(comp_tags[comps])
+                if len(tags) == 0:
+                    break
+        tags = set(comp_tags)
+        egrid = {}
+        samples = {}
+        for jobid in probes:
+            job_egrid, blocks = decode_fireball_output(*task(jobid)[1])
+            egrid.update(job_egrid)
+            for tag, block in blocks.items():
+                if tag not in samples:
+                    samples[tag] = {
+                        name: value.shape[1:] for name, value in block.items()
+                    }
+            tags -= set(blocks)
+            if len(tags) == 0:
+                break
 
-        # use first two parameters to determine array shape, last one assumed to be composition
-        shape = tuple(len(ls) for ls in self.param_values[:-1])
-
-        # Loop over the single output files
-        from tqdm import tqdm as tqdm
-
-        print("reading output files:")
-        for jobid in tqdm(list(range(1, self.njobs + 1))):
-            outputfile = path.join(self.folder_out, self.outfile(jobid))
-            with open(outputfile, "rb") as thefile:
-                try:
-                    fireballs = pickle.load(thefile)
-                except:
-                    print(("Error reading jobfile {:}".format(jobid)))
-                    raise
-            # write to arrays
-            for fb, perm in zip(fireballs, self.perm_slice(jobid)):
-                perm = tuple(perm)
-                params = tuple(p[i] for p, i in zip(self.param_values, perm))
-                # comp = params[-1]
-                if len(params[-1]) > 1:
-                    tag = "mixed"
-                else:
-                    tag = str(list(params[-1].keys())[0])
-                subgrp = grp.require_group(tag)
+        # create a hdf5 file to store the data intensive stuff
+        import h5py
 
-                # TODO: max idx 400: workaround for faulty files, remove when files are fixed
-                if superphotos:
-                    try:
-                        indices = fb.specCosmicRays.pids
-                    except:  # noqa: E722
-                        indices = fb.specAllCosmicRays.pids
-                else:
-                    indices = fb.specAllCosmicRays.pids
-                nonzero_ids = np.nonzero(indices)
-                indices = indices[nonzero_ids]
-                if superphotos:
-                    try:
-                        spectra = fb.specCosmicRays.source_spectrum().T[nonzero_ids]
-                        neutrinos = fb.specNeutrinos.source_spectrum().T
-                    except:  # noqa: E722
-                        spectra = fb.specAllCosmicRays.source_spectrum().T[nonzero_ids]
-                        neutrinos = fb.specAllNeutrinos.source_spectrum().T
-                        spectra = np.zeros_like(spectra)
-                        neutrinos = np.zeros_like(neutrinos)
-                else:
-                    spectra = fb.specAllCosmicRays.source_spectrum().T[nonzero_ids]
-                    neutrinos = fb.specAllNeutrinos.source_spectrum().T
-                dset_indices = subgrp.require_dataset(
-                    "indices", shape + indices.shape, dtype=np.int64
-                )
-                dset_spectra = subgrp.require_dataset(
-                    "spectra", shape + spectra.shape, dtype=np.float64
+        kinds = [("", "collected.hdf5", "egrid")]
+        if superphotos:
+            kinds.append(
+                (
+                    "super ",
+                    "collected_super_photos.hdf5",
+                    "super egrid" if "super egrid" in egrid else "egrid",
                 )
-                dset_neutrinos = subgrp.require_dataset(
-                    "neutrinos", shape + neutrinos.shape, dtype=np.float64
+            )
+        h5files = []
+        writers = {}
+        for prefix, filename, egrid_name in kinds:
+            h5file = h5py.File(path.join(self.targetdir, filename), "a")
+            h5files.append(h5file)
+            grp = h5file.require_group("source")
+            dset_egrid = grp.require_dataset(
+                "egrid", egrid[egrid_name].shape, dtype=np.float64
+            )
+            dset_egrid[:] = egrid[egrid_name]
+            for tag, sample in samples.items():
+                subgrp = grp.require_group(tag)
+                datasets = {
+                    name: subgrp.require_dataset(
+                        name,
+                        shape + sample[prefix + name],
+                        dtype=np.int64 if name == "indices" else np.float64,
+                    )
+                    for name in ["indices", "spectra", "neutrinos"]
+                }
+                writers[prefix, tag] = BlockWriter(
+                    h5file, datasets, shape, None, batch_bytes=2**27
                 )
-                dset_indices[perm[:-1]] = indices
-                dset_spectra[perm[:-1]] = spectra
-                dset_neutrinos[perm[:-1]] = neutrinos
 
-        h5file.flush()
-        h5file.close()
+        def add(jobid, blocks):
+            for (prefix, tag), writer in writers.items():
+                if tag in blocks:
+                    block = blocks[tag]
+                    writer.add(
+                        jobid,
+                        {
+                            "positions": block["positions"],
+                            "indices": block[prefix + "indices"],
+                            "spectra": block[prefix + "spectra"],
+                            "neutrinos": block[prefix + "neutrinos"],
+                        },
+                    )
+
+        # Decode the remaining output files and write them in sorted batches
+        from tqdm import tqdm
+
+        print("reading output files:")
+        tasks = [task(jobid) for jobid in range(1, self.njobs + 1)]
+        for jobid, (_, blocks) in tqdm(
+            decode_pipeline(decode_fireball_output, tasks, nprocs=nprocs),
+            total=len(tasks),
+        ):
+            add(jobid, blocks)
+        for writer in writers.values():
+            writer.write()
+
+        for h5file in h5files:
+            h5file.flush()
+            h5file.close()
 
     def run_from_terminal(self):
         from optparse import OptionParser, OptionGroup
@@ -713,6 +2740,19 @@ class PropagationProject(object):
             action="store_true",
             help="If this is set, the project results will be collected into a single folder",
         )
+        parser.add_option(
+            "--recollect",
+            dest="recollect",
+            action="store_true",
+            help="If this is set with --collect, all results are collected again instead of only the new ones",
+        )
+        parser.add_option(
+            "--nprocs",
+            dest="nprocs",
+            type="int",
+            default=1,
+            help="Number of processes used to decode the output files with --collect, or threads used by --check",
+        )
         parser.add_option(
             "--fit",
             dest="fit",
@@ -731,7 +2771,85 @@ class PropagationProject(object):
             "--superphotos",
             dest="superphotos",
             action="store_true",
-            help="If this is set and the objects to collect are ReMuS fireballs, will only account for superphotospheric collisions",
+            help="If this is set and the objects to collect are ReMuS fireballs, the superphotospheric collisions are also collected to collected_super_photos.hdf5",
+        )
+
+        parser.add_option(
+            "--local",
+            dest="local",
+            type="int",
+            help="Run all jobs (or only the missing ones with -m) on a local pool of N processes",
+        )
+
+        parser.add_option(
+            "--stragglers",
+            dest="stragglers",
+            action="store_true",
+            help="Submit duplicates of running jobs, which are much slower than the finished ones",
+        )
+
+        parser.add_option(
+            "--status",
+            dest="status",
+            action="store_true",
+            help="Print the throughput, projected completion and slowest jobs from the job heartbeats",
+        )
+
+        parser.add_option(
+            "--trace-summary",
+            dest="trace_summary",
+            action="store_true",
+            help="Print the hot spots of the job traces and merge them, needs PRINCE_TRACE or 'trace' in the config",
+        )
+
+        parser.add_option(
+            "--pilot",
+            dest="pilot",
+            type="int",
+            help="Run N random grid points locally and estimate the runtime, memory and storage of the scan",
+        )
+
+        parser.add_option(
+            "--write-config",
+            dest="write_config",
+            action="store_true",
+            help="With --pilot, write the recommended njobs, hours per job and max memory GB into the config",
+        )
+
+        parser.add_option(
+            "--daemon",
+            dest="daemon",
+            action="store_true",
+            help="Submit, resubmit and collect the jobs until all are done",
+        )
+
+        parser.add_option(
+            "--refine",
+            dest="refine",
+            action="store_true",
+            help="Start the next stage of an adaptive scan from the collected results",
+        )
+
+        parser.add_option(
+            "--balance",
+            dest="balance",
+            action="store_true",
+            help="Partition the grid points into jobs of equal runtime, using the costs of collected.hdf5",
+        )
+
+        parser.add_option(
+            "--mark",
+            dest="mark",
+            type="choice",
+            choices=["running", "done", "failed"],
+            help="Record the state of job --jobid in the job manifest, used by the submit script",
+        )
+
+        parser.add_option(
+            "--rebuild-manifest",
+            dest="rebuild_manifest",
+            action="store_true",
+            help="Rebuild the job manifest from the log and output folders",
         )
 
         parser.add_option(
@@ -750,6 +2868,12 @@ class PropagationProject(object):
             type="str",
             help="ouput will be written to this file",
         )
+        run_group.add_option(
+            "--speculative",
+            dest="speculative",
+            action="store_true",
+            help="The job is a duplicate of a slow job, also used with --mark",
+        )
         run_group.add_option(
             "--jobid",
             dest="jobid",
@@ -759,11 +2883,23 @@ class PropagationProject(object):
         parser.add_option_group(run_group)
         options, args = parser.parse_args()
 
-        if options.create:
+        if options.mark:
+            self.mark_job(options.jobid, options.mark, speculative=options.speculative)
+        elif options.rebuild_manifest:
+            self.rebuild_manifest()
+        elif options.create:
             if self.fit_only:
                 self.setup_fit()
             else:
                 self.setup_project()
+        elif options.local:
+            if options.missing:
+                _, missing = self.scan_output()
+                self.run_local(options.local, jobids=_expand_ranges(missing))
+            else:
+                self.run_local(options.local)
+        elif options.check and options.submit:
+            self.submit_jobs(self.check_job_results(nthreads=max(options.nprocs, 8)))
         elif options.submit and options.single:
             self.submit_single_job(options.jobid)
         elif options.submit and options.missing:
@@ -773,16 +2909,46 @@ class PropagationProject(object):
         elif options.missing:
             self.scan_logfiles()
             self.scan_output()
+            if self.manifest is not None:
+                self.manifest_status()
+            if self.work_stealing:
+                self.queue_status()
         elif options.run:
-            self.run_subset(options.jobid, options.outputfile)
+            self.run_subset(
+                options.jobid, options.outputfile, speculative=options.speculative
+            )
+        elif options.pilot:
+            self.pilot(
+                options.pilot,
+                nprocs=options.nprocs,
+                write_config=options.write_config,
+            )
+        elif options.status:
+            self.status()
+        elif options.trace_summary:
+            self.trace_summary()
+        elif options.daemon:
+            self.run_daemon(nprocs=options.nprocs)
+        elif options.stragglers:
+            self.submit_stragglers()
+        elif options.refine:
+            self.refine()
+        elif options.balance:
+            self.balance_jobs()
         elif options.check:
-            self.check_job_results()
+            self.check_job_results(nthreads=max(options.nprocs, 8))
         elif options.collect:
             if options.fireball:
-                self.collect_fireball_results(superphotos=options.superphotos)
+                self.collect_fireball_results(
+                    superphotos=options.superphotos, nprocs=options.nprocs
+                )
             elif self.fit_only:
-                self.collect_fit_results()
+                self.collect_fit_results(
+                    incremental=not options.recollect, nprocs=options.nprocs
+                )
             else:
-                self.collect_job_results()
+                self.collect_job_results(
+                    incremental=not options.recollect, nprocs=options.nprocs
+                )
         else:
             raise Exception("No valid options specified, set either -s -r -c")
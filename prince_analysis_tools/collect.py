@@ -0,0 +1,607 @@
+"""Helpers for collecting job outputs into collected.hdf5
+
+Job outputs are decoded into contiguous numpy blocks, optionally on a pool of
+worker processes. The collecting process is the single writer, it merges the
+blocks of several jobs, sorts them by grid position and writes them as
+hyperslabs, flushing only at checkpoints.
+"""
+
+import numpy as np
+
+
+def register_filters():
+    """Registers the extra hdf5 compression filters, if hdf5plugin is installed"""
+    try:
+        import hdf5plugin  # noqa: F401
+
+        return True
+    except ImportError:
+        return False
+
+
+def states_layout_kwargs(layout, grid_shape, state_shape):
+    """Keyword arguments for create_dataset of the states from a layout config
+
+    layout is a dict with the optional keys
+        'chunks': 'point' (default), 'species', 'auto', None or a tuple
+        'compression': None (default), 'gzip', 'lzf' or 'blosc'
+        'compression_opts': compression level
+        'shuffle': apply the byte shuffle filter (default True if compressed)
+        'dtype': 'float64' (default) or 'float32', see states_dtype
+        'sparse threshold': store the states sparsely, see SparseStates
+    """
+    layout = {} if layout is None else layout
+    ndim = len(grid_shape)
+
+    # chunks aligned to reading the states of single grid points
+    chunks = layout.get("chunks", "point")
+    if chunks == "point":
+        chunks = (1,) * ndim + tuple(state_shape)
+    elif chunks == "species":
+        chunks = (1,) * ndim + (1,) + tuple(state_shape[1:])
+    elif chunks == "auto":
+        chunks = True
+    elif chunks is not None:
+        chunks = tuple(chunks)
+    kwargs = {"chunks": chunks}
+    kwargs.update(_compression_kwargs(layout, chunks is not None))
+    return kwargs
+
+
+def _compression_kwargs(layout, chunked):
+    """Keyword arguments for create_dataset of the compression of the states"""
+    kwargs = {}
+    compression = layout.get("compression", None)
+    shuffle = layout.get("shuffle", compression is not None)
+    if compression is None:
+        pass
+    elif not chunked:
+        raise Exception("Compression of the states needs a chunked layout")
+    elif compression in ["gzip", "lzf"]:
+        kwargs["compression"] = compression
+        if "compression_opts" in layout:
+            kwargs["compression_opts"] = layout["compression_opts"]
+        kwargs["shuffle"] = shuffle
+    elif compression == "blosc":
+        if not register_filters():
+            raise Exception("Blosc compression needs the hdf5plugin package")
+        import hdf5plugin
+
+        kwargs.update(
+            hdf5plugin.Blosc(
+                cname="zstd",
+                clevel=layout.get("compression_opts", 5),
+                shuffle=(
+                    hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE
+                ),
+            )
+        )
+    else:
+        raise Exception("Unknown compression for the states: {:}".format(compression))
+    return kwargs
+
+
+def states_dtype(layout):
+    """dtype of the stored states, float32 halves the size at 7 digits"""
+    dtype = np.dtype((layout or {}).get("dtype", "float64"))
+    if dtype not in [np.float32, np.float64]:
+        raise Exception(
+            "The states are stored as float32 or float64, not {:}".format(dtype)
+        )
+    return dtype
+
+
+class SparseStates(object):
+    """States stored sparsely per injected species in the group 'states'
+
+    A state is the concatenation of the spectra (egrid size) of all species
+    in known_spec. For each injected species i, the subgroup 'injected<i>'
+    holds 'species', the indices of the kept species, and 'values' with the
+    shape grid + (len(species), egrid size). A species is kept, once its
+    spectrum exceeds threshold times the maximum of the state at any grid
+    point, the spectra of all other species are zero.
+
+    The kept species grow while the grid points are collected. Values of
+    species added after a grid point was written are NaN on disk and read
+    as zero. Grid points, which were not computed, are read as NaN.
+    Supports the item assignment used by write_points and reads the dense
+    states of a grid point by index.
+    """
+
+    def __init__(self, group):
+        self.group = group
+        self.grid_shape = tuple(group.attrs["grid shape"])
+        self.nspec = int(group.attrs["species count"])
+        self.nbins = int(group.attrs["egrid size"])
+        self.threshold = float(group.attrs["threshold"])
+        self.injected = [
+            group["injected{:}".format(i)] for i in range(group.attrs["injected"])
+        ]
+        self.species = [list(sub["species"][:]) for sub in self.injected]
+
+    @classmethod
+    def create(cls, h5file, grid_shape, state_shape, nspec, layout):
+        """Creates the group 'states' in h5file, layout as in states_layout_kwargs"""
+        injected, state_size = state_shape
+        if state_size % nspec != 0:
+            raise Exception(
+                "State size {:} is not a multiple of {:} species".format(
+                    state_size, nspec
+                )
+            )
+        nbins = state_size // nspec
+        group = h5file.create_group("states")
+        group.attrs["grid shape"] = grid_shape
+        group.attrs["species count"] = nspec
+        group.attrs["egrid size"] = nbins
+        group.attrs["threshold"] = layout["sparse threshold"]
+        group.attrs["injected"] = injected
+
+        # one chunk per grid point and a few species
+        chunks = (1,) * len(grid_shape) + (min(8, nspec), nbins)
+        for i in range(injected):
+            sub = group.create_group("injected{:}".format(i))
+            sub.create_dataset("species", (0,), maxshape=(nspec,), dtype=np.int32)
+            sub.create_dataset(
+                "values",
+                tuple(grid_shape) + (0, nbins),
+                maxshape=tuple(grid_shape) + (nspec, nbins),
+                dtype=states_dtype(layout),
+                fillvalue=np.nan,
+                chunks=chunks,
+                **_compression_kwargs(layout, True),
+            )
+        return cls(group)
+
+    @property
+    def shape(self):
+        return self.grid_shape + (len(self.injected), self.nspec * self.nbins)
+
+    def __setitem__(self, sel, data):
+        """Writes the dense states data to the grid selection sel"""
+        data = np.asarray(data).reshape(
+            (-1, len(self.injected), self.nspec, self.nbins)
+        )
+        with np.errstate(invalid="ignore"):
+            peak = np.nanmax(np.abs(data), axis=(2, 3), initial=0.0)
+            relevant = np.abs(data).max(axis=3) > self.threshold * peak[:, :, None]
+        for i, sub in enumerate(self.injected):
+            species = self.species[i]
+            new = np.setdiff1d(np.flatnonzero(relevant[:, i].any(axis=0)), species)
+            if len(new) > 0:
+                species += list(new)
+                sub["species"].resize((len(species),))
+                sub["species"][:] = species
+                sub["values"].resize(len(species), axis=len(self.grid_shape))
+            if len(species) > 0:
+                sub["values"][sel] = data[:, i][:, species]
+
+    def __getitem__(self, index):
+        """Dense states (injected, state size) of the grid point index"""
+        index = tuple(int(i) for i in index)
+        if len(index) != len(self.grid_shape):
+            raise Exception("SparseStates are read one grid point at a time")
+        states = np.zeros((len(self.injected), self.nspec, self.nbins))
+        computed = False
+        for i, sub in enumerate(self.injected):
+            species = self.species[i]
+            if len(species) == 0:
+                continue
+            values = sub["values"][index]
+            if np.isnan(values).all():
+                continue
+            computed = True
+            states[i, species] = np.nan_to_num(values, nan=0.0)
+        if not computed:
+            states[:] = np.nan
+        return states.reshape(len(self.injected), -1)
+
+
+class FlatStates(object):
+    """States of a virtual dataset over the flat grid positions
+
+    The virtual dataset maps the 'states' of the hdf5 job shards without
+    copying them, see virtual_states. It is read by grid index like the
+    dataset in collected.hdf5.
+    """
+
+    def __init__(self, dset):
+        self.dset = dset
+        self.grid_shape = tuple(int(n) for n in dset.attrs["grid shape"])
+
+    @property
+    def shape(self):
+        return self.grid_shape + self.dset.shape[1:]
+
+    def __getitem__(self, index):
+        """States (injected, state size) of the grid point index"""
+        index = tuple(int(i) for i in index)
+        if len(index) != len(self.grid_shape):
+            raise Exception("FlatStates are read one grid point at a time")
+        return self.dset[np.ravel_multi_index(index, self.grid_shape)]
+
+
+def open_states(h5file):
+    """The states of collected.hdf5, a dataset, SparseStates or FlatStates"""
+    import h5py
+
+    states = h5file["states"]
+    if isinstance(states, h5py.Group):
+        return SparseStates(states)
+    elif "grid shape" in states.attrs:
+        return FlatStates(states)
+    return states
+
+
+def _arithmetic_runs(positions):
+    """Splits positions into runs with a constant positive step
+
+    Returns a list of (first row, first position, step, count).
+    """
+    runs = []
+    diffs = np.diff(positions)
+    start = 0
+    while start < len(positions):
+        count, step = 1, 1
+        if start < len(diffs) and diffs[start] > 0:
+            step = diffs[start]
+            other = np.flatnonzero(diffs[start:] != step)
+            count = (other[0] if len(other) > 0 else len(diffs) - start) + 1
+        runs.append((start, int(positions[start]), int(step), int(count)))
+        start += count
+    return runs
+
+
+def shard_rows(outputfile, positions):
+    """Flat grid positions of the rows of the states in a hdf5 job shard
+
+    positions are the grid positions of the job, they are read from the
+    shard if it stores them. Returns None if the shard has no states,
+    i.e. all its grid points failed.
+    """
+    import h5py
+
+    with h5py.File(outputfile, "r") as h5file:
+        if "states" not in h5file:
+            return None
+        if "grid positions" in h5file:
+            positions = h5file["grid positions"][()]
+        return np.asarray(positions[: h5file["states"].shape[0]], dtype=np.int64)
+
+
+def virtual_states(h5file, grid_shape, state_shape, shards, keep=None):
+    """(Re)creates 'states' as virtual dataset of the states of job shards
+
+    The dataset has the shape (grid size, injected, state size), its attrs
+    store the grid shape, see FlatStates. shards is a list of (filename,
+    positions), filename relative to the folder of h5file, positions the
+    flat grid positions of the rows of the shard. The mappings of an
+    existing virtual dataset are kept for the source files with keep(name)
+    True. Grid points without a shard are NaN.
+    """
+    import h5py
+
+    state_shape = tuple(state_shape)
+    shape = (int(np.prod(grid_shape, dtype=np.int64)),) + state_shape
+    zeros = (0,) * len(state_shape)
+
+    dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+    dcpl.set_fill_value(np.array(np.nan))
+    if "states" in h5file:
+        old = h5file["states"]
+        if old.is_virtual and keep is not None:
+            for vmap in old.virtual_sources():
+                if keep(vmap.file_name):
+                    dcpl.set_virtual(
+                        vmap.vspace,
+                        vmap.file_name.encode(),
+                        vmap.dset_name.encode(),
+                        vmap.src_space,
+                    )
+        del h5file["states"]
+
+    for filename, positions in shards:
+        src = h5py.h5s.create_simple((len(positions),) + state_shape)
+        for row, first, step, count in _arithmetic_runs(positions):
+            vspace = h5py.h5s.create_simple(shape)
+            vspace.select_hyperslab(
+                (first,) + zeros,
+                (count,) + (1,) * len(state_shape),
+                stride=(step,) + (1,) * len(state_shape),
+                block=(1,) + state_shape,
+            )
+            src.select_hyperslab((row,) + zeros, (count,) + state_shape)
+            dcpl.set_virtual(vspace, filename.encode(), b"states", src)
+
+    if dcpl.get_layout() != h5py.h5d.VIRTUAL:
+        # nothing to map yet, an empty dataset of fill values
+        dcpl.set_layout(h5py.h5d.CHUNKED)
+        dcpl.set_chunk((1,) + state_shape)
+    h5py.h5d.create(
+        h5file.id,
+        b"states",
+        h5py.h5t.IEEE_F64LE,
+        h5py.h5s.create_simple(shape),
+        dcpl=dcpl,
+    )
+    h5file["states"].attrs["grid shape"] = np.asarray(grid_shape, dtype=np.int64)
+
+
+def chunk_cache_kwargs(cache_mb=None):
+    """Keyword arguments for h5py.File to set the size of the chunk cache"""
+    if cache_mb is None:
+        return {}
+    nbytes = int(cache_mb * 2**20)
+    # number of hash slots, a prime about 100 times the number of cached chunks
+    return {"rdcc_nbytes": nbytes, "rdcc_nslots": 100003, "rdcc_w0": 0.75}
+
+
+def load_output_file(outputfile):
+    """Reads the output file of a single job, see outputs.py for the formats"""
+    from .outputs import read_output
+
+    return read_output(outputfile)
+
+
+def _columns_to_block(columns, positions, nfrac):
+    """Converts the columns of a job output to the datasets of a fit group"""
+    if columns is None:
+        raise Exception("Unknown structure of the job results")
+    npoints = columns["chi2"].size
+    if "grid positions" in columns:
+        positions = columns["grid positions"]
+    if "fit params" in columns:
+        params = np.asarray(columns["fit params"])
+    else:
+        # all grid points of this job failed
+        params = np.full((npoints, nfrac + 2), np.nan)
+    norm = params[:, 2:].sum(axis=1)
+    return {
+        "positions": np.asarray(positions[:npoints], dtype=np.int64),
+        "chi2": np.asarray(columns["chi2"], dtype=np.float64),
+        "norm": norm,
+        "delta E": params[:, 0],
+        "xmax_shift": params[:, 1],
+        "fractions": params[:, 2:] / norm[:, np.newaxis],
+    }
+
+
+def decode_job_output(outputfile, positions, state_shape, costfile=None):
+    """Decodes the output of a propagation job to numpy blocks
+
+    positions are the flat grid positions of the results in the file,
+    None if they are stored in the file itself.
+    Failed grid points have chi2 = inf, all other values are NaN.
+    The runtime costs are read from costfile, NaN if it does not exist.
+    """
+    from .outputs import read_columns
+    from .costs import read_costs
+
+    columns = read_columns(outputfile)
+    block = _columns_to_block(columns, positions, state_shape[0])
+    if "states" in columns:
+        block["states"] = np.array(columns["states"], dtype=np.float64)
+    else:
+        block["states"] = np.full((block["chi2"].size,) + tuple(state_shape), np.nan)
+    block.update(read_costs(costfile, block["chi2"].size))
+    return block
+
+
+def decode_shard_fits(outputfile, positions, nfrac, costfile=None):
+    """Decodes all but the states of a hdf5 job shard to numpy blocks
+
+    The states stay in the shard, they are mapped by virtual_states.
+    """
+    from .outputs import read_columns
+    from .costs import read_costs
+
+    columns = read_columns(outputfile, exclude=["states"])
+    block = _columns_to_block(columns, positions, nfrac)
+    block.update(read_costs(costfile, block["chi2"].size))
+    return block
+
+
+def decode_fit_output(outputfile, positions, nfrac, costfile=None):
+    """Decodes the output of a fit only job to numpy blocks"""
+    from .outputs import read_columns
+    from .costs import read_costs
+
+    block = _columns_to_block(read_columns(outputfile), positions, nfrac)
+    block.update(read_costs(costfile, block["chi2"].size))
+    return block
+
+
+def decode_multi_fit_output(outputfile, positions, nfracs, costfile=None):
+    """Decodes the output of a multi configuration fit job to numpy blocks
+
+    nfracs maps the fit tags to their number of fractions, the datasets of
+    each fit are named '<fit_tag>/chi2', ... in the returned block.
+    """
+    from .outputs import read_columns
+    from .costs import read_costs
+
+    columns = read_columns(outputfile)
+    if columns is None:
+        raise Exception("Unknown structure of the job results")
+    block = {}
+    for tag, nfrac in nfracs.items():
+        prefix = tag + "/"
+        sub = {
+            name[len(prefix) :]: arr
+            for name, arr in columns.items()
+            if name.startswith(prefix)
+        }
+        if "chi2" not in sub:
+            # all grid points of this job failed, the columns have no fit tags
+            sub["chi2"] = columns["chi2"]
+        if "grid positions" in columns:
+            sub["grid positions"] = columns["grid positions"]
+        for name, arr in _columns_to_block(sub, positions, nfrac).items():
+            block[name if name == "positions" else prefix + name] = arr
+    block.update(read_costs(costfile, block["positions"].size))
+    return block
+
+
+def _nonzero_pids(pids, spectra):
+    """Drops the rows of the species with pid 0"""
+    nonzero = np.nonzero(pids)
+    return pids[nonzero], spectra[nonzero]
+
+
+def decode_fireball_output(outputfile, positions, shape, tags, superphotos=False):
+    """Decodes the ReMuS fireballs of a job to one block per composition tag
+
+    positions are the flat positions of the fireballs in the grid of shape,
+    whose last axis is the composition with the tags. They are read from the
+    output, if it stores them (work stealing). Each block holds the
+    positions in the grid without the composition axis, the 'indices'
+    (pids), source 'spectra' and 'neutrinos' of all collisions and, with
+    superphotos, the same of the superphotospheric collisions only as
+    'super indices', ... These are zero, if a fireball does not record them.
+    """
+    from .outputs import read_output
+
+    try:
+        fireballs = read_output(outputfile)
+    except Exception:
+        print(("Error reading jobfile {:}".format(outputfile)))
+        raise
+    if isinstance(fireballs, dict):
+        if "results" not in fireballs:
+            raise Exception("{:} does not contain fireballs".format(outputfile))
+        positions = fireballs["grid positions"]
+        fireballs = fireballs["results"]
+    if positions is None or len(positions) != len(fireballs):
+        raise Exception(
+            "Cannot find the grid positions of the fireballs in {:}".format(outputfile)
+        )
+    indices = np.unravel_index(np.asarray(positions, dtype=np.int64), shape)
+    positions = np.ravel_multi_index(indices[:-1], shape[:-1])
+    tags = np.asarray(tags)[indices[-1]]
+
+    rows = {}
+    egrid = {}
+    for fb, pos, tag in zip(fireballs, positions, tags):
+        total = fb.specAllCosmicRays
+        spectra = total.source_spectrum().T
+        row = {"positions": pos, "neutrinos": fb.specAllNeutrinos.source_spectrum().T}
+        row["indices"], row["spectra"] = _nonzero_pids(total.pids, spectra)
+        egrid.setdefault("egrid", total.source_energy)
+        if superphotos and hasattr(fb, "specCosmicRays"):
+            super_spectra = fb.specCosmicRays.source_spectrum().T
+            row["super neutrinos"] = fb.specNeutrinos.source_spectrum().T
+            row["super indices"], row["super spectra"] = _nonzero_pids(
+                fb.specCosmicRays.pids, super_spectra
+            )
+            egrid.setdefault("super egrid", fb.specCosmicRays.source_energy)
+        elif superphotos:
+            row["super indices"] = row["indices"]
+            row["super spectra"] = np.zeros_like(row["spectra"])
+            row["super neutrinos"] = np.zeros_like(row["neutrinos"])
+        rows.setdefault(tag, []).append(row)
+
+    blocks = {
+        tag: {name: np.stack([row[name] for row in lst]) for name in lst[0]}
+        for tag, lst in rows.items()
+    }
+    return egrid, blocks
+
+
+def decode_pipeline(decode, tasks, nprocs=1, max_pending=None):
+    """Yields (key, decode(*args)) for all (key, args) in tasks
+
+    With nprocs > 1 the tasks are decoded on a process pool. At most
+    max_pending decoded blocks are in flight, they are yielded in task order.
+    """
+    if nprocs is None or nprocs <= 1:
+        for key, args in tasks:
+            yield key, decode(*args)
+        return
+
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+
+    max_pending = 2 * nprocs if max_pending is None else max_pending
+    with ProcessPoolExecutor(max_workers=nprocs) as pool:
+        pending = deque()
+        for key, args in tasks:
+            pending.append((key, pool.submit(decode, *args)))
+            if len(pending) >= max_pending:
+                key, future = pending.popleft()
+                yield key, future.result()
+        while pending:
+            key, future = pending.popleft()
+            yield key, future.result()
+
+
+def write_points(dset, positions, data, shape):
+    """Writes rows of data to the flat grid positions of a grid shaped dataset
+
+    positions have to be sorted. Consecutive positions along the last grid
+    axis are combined into a single hyperslab write.
+    """
+    if len(positions) == 0:
+        return
+    breaks = np.flatnonzero(
+        (np.diff(positions) != 1) | (positions[1:] % shape[-1] == 0)
+    )
+    starts = np.concatenate([[0], breaks + 1])
+    ends = np.concatenate([breaks + 1, [len(positions)]])
+    first = np.stack(np.unravel_index(positions[starts], shape), axis=-1).tolist()
+    for start, end, idx in zip(starts, ends, first):
+        sel = tuple(idx[:-1]) + (slice(idx[-1], idx[-1] + end - start),)
+        dset[sel] = data[start:end]
+
+
+class BlockWriter(object):
+    """Buffers decoded blocks and writes them in sorted batches
+
+    The buffered blocks are written and flushed when they exceed
+    batch_bytes, only then the jobs are marked in the manifest d_jobs
+    (if it is not None).
+    Datasets named 'computed' (or '<group>/computed') are set to True at all
+    written positions.
+    """
+
+    def __init__(self, h5file, datasets, shape, d_jobs, batch_bytes=2**29):
+        self.h5file = h5file
+        self.datasets = datasets
+        self.shape = shape
+        self.d_jobs = d_jobs
+        self.batch_bytes = batch_bytes
+        self.blocks = []
+        self.jobids = []
+        self.nbytes = 0
+
+    def add(self, jobid, block):
+        self.blocks.append(block)
+        self.jobids.append(jobid)
+        self.nbytes += sum(arr.nbytes for arr in block.values())
+        if self.nbytes >= self.batch_bytes:
+            self.write()
+
+    def write(self):
+        """Writes all buffered blocks and marks their jobs as collected"""
+        if len(self.blocks) == 0:
+            return
+        positions = np.concatenate([block["positions"] for block in self.blocks])
+        order = np.argsort(positions, kind="stable")
+        positions = positions[order]
+        for name, dset in self.datasets.items():
+            if name.split("/")[-1] == "computed":
+                data = np.ones(positions.size, dtype=bool)
+            else:
+                data = np.concatenate([block[name] for block in self.blocks])[order]
+            write_points(dset, positions, data, self.shape)
+
+        # mark the jobs only after their data is on disk, to allow resuming
+        self.h5file.flush()
+        if self.d_jobs is not None:
+            collected = self.d_jobs[:]
+            collected[np.array(self.jobids) - 1] = True
+            self.d_jobs[:] = collected
+            self.h5file.flush()
+
+        self.blocks = []
+        self.jobids = []
+        self.nbytes = 0
@@ -0,0 +1,150 @@
+"""Runtime costs of the grid points and cost balanced job partitions
+
+run_subset records wall time, CPU time and peak memory for each grid point.
+They are collected into the 'cost' group of collected.hdf5 and can be used
+to partition the grid points of a new scan or fit into jobs of equal cost.
+"""
+
+import numpy as np
+
+cost_names = ["wall time", "cpu time", "peak rss"]
+
+
+def _reset_peak_rss():
+    """Resets the peak RSS of this process (Linux only), True on success"""
+    try:
+        with open("/proc/self/clear_refs", "w") as thefile:
+            thefile.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _peak_rss():
+    """Peak resident memory of this process in MB"""
+    try:
+        with open("/proc/self/status") as thefile:
+            for line in thefile:
+                if line.startswith("VmHWM:"):
+                    return float(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    import resource
+
+    # kB on Linux, not resettable, i.e. the peak since the start of the job
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class PointTimer(object):
+    """Context manager measuring wall time, CPU time and peak RSS of a grid point"""
+
+    def __enter__(self):
+        import time
+
+        _reset_peak_rss()
+        self._wall = time.time()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, *args):
+        import time
+
+        self.cost = (
+            time.time() - self._wall,
+            time.process_time() - self._cpu,
+            _peak_rss(),
+        )
+        return False
+
+
+def write_costs(costfile, costs):
+    """Writes the costs of the grid points of a job, in the order of its results"""
+    costs = np.array(costs, dtype=np.float64).reshape(-1, len(cost_names))
+    with open(costfile, "wb") as thefile:
+        np.savez(thefile, **{name: costs[:, i] for i, name in enumerate(cost_names)})
+
+
+def read_costs(costfile, npoints):
+    """Reads the costs of a job, NaN if they were not recorded"""
+    from os import path
+
+    if costfile is not None and path.exists(costfile):
+        with np.load(costfile) as npz:
+            return {name: npz[name][:npoints] for name in cost_names}
+    return {name: np.full(npoints, np.nan) for name in cost_names}
+
+
+def fit_cost_model(costs, niter=20):
+    """Fills the unknown (NaN) entries of a grid of costs
+
+    The logarithm of the cost is modelled as a sum of one term per parameter
+    axis, fitted by backfitting to the known grid points. Returns the
+    completed grid, known entries are kept.
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    known = np.isfinite(costs) & (costs > 0)
+    if not known.any():
+        return np.ones_like(costs)
+
+    logc = np.where(known, np.log(np.where(known, costs, 1.0)), 0.0)
+    mean = logc[known].mean()
+    terms = [np.zeros(n) for n in costs.shape]
+
+    def expand(axis, term):
+        shape = [1] * costs.ndim
+        shape[axis] = term.size
+        return term.reshape(shape)
+
+    for _ in range(niter):
+        for axis in range(costs.ndim):
+            others = sum(expand(a, t) for a, t in enumerate(terms) if a != axis)
+            resid = np.where(known, logc - mean - others, 0.0)
+            other_axes = tuple(a for a in range(costs.ndim) if a != axis)
+            nknown = known.sum(axis=other_axes)
+            # axis values without any known grid point keep the average
+            terms[axis] = np.where(
+                nknown > 0, resid.sum(axis=other_axes) / np.maximum(nknown, 1), 0.0
+            )
+
+    model = np.exp(mean + sum(expand(a, t) for a, t in enumerate(terms)))
+    return np.where(known, costs, model)
+
+
+def lpt_partition(costs, njobs):
+    """Longest processing time first partition of the costs into njobs bins
+
+    Returns a list with the positions (indices into costs) for each job,
+    sorted within each job, and the total cost of each job.
+    """
+    import heapq
+
+    costs = np.asarray(costs, dtype=np.float64)
+    order = np.argsort(-costs, kind="stable")
+    heap = [(0.0, job) for job in range(njobs)]
+    assignment = np.empty(costs.size, dtype=np.int64)
+    for pos in order:
+        load, job = heapq.heappop(heap)
+        assignment[pos] = job
+        heapq.heappush(heap, (load + costs[pos], job))
+
+    loads = np.bincount(assignment, weights=costs, minlength=njobs)
+    # a stable sort keeps the positions of each job in increasing order
+    order = np.argsort(assignment, kind="stable")
+    counts = np.bincount(assignment, minlength=njobs)
+    positions = np.split(order, np.cumsum(counts)[:-1])
+    return positions, loads
+
+
+def save_partition(filename, positions):
+    """Saves a partition (list of position arrays) to a npz file"""
+    offsets = np.cumsum([0] + [len(pos) for pos in positions])
+    flat = np.concatenate([np.asarray(pos, dtype=np.int64) for pos in positions])
+    with open(filename, "wb") as thefile:
+        np.savez(thefile, positions=flat, offsets=offsets)
+
+
+def load_partition(filename):
+    """Loads a partition saved by save_partition as list of position arrays"""
+    with np.load(filename) as npz:
+        flat, offsets = npz["positions"], npz["offsets"]
+    return [flat[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
@@ -0,0 +1,227 @@
+"""Unattended job control of a project
+
+The JobController (started with --daemon) replaces the manual cycle of -s,
+-m, -m -s and --collect. It keeps at most max_queued array tasks in the
+scheduler queue, resubmits failed jobs until their retry budget is used up
+and starts the incremental collection while the remaining jobs are running.
+For an adaptive scan it starts the next refinement stage, once a stage is
+collected completely.
+
+The job states are read from the job manifest. Jobs that disappear from the
+scheduler queue without recording their final state (e.g. killed at the
+time limit) are marked as failed. The manifest is only accessed from the
+event loop, the scheduler calls run in a thread and the collection runs as
+a separate process of the run file.
+"""
+
+import asyncio
+import sys
+import time
+
+from .manifest import QUEUED, RUNNING, DONE, FAILED, job_states
+from .scheduler import array_spec
+
+
+class JobController(object):
+    def __init__(
+        self,
+        project,
+        max_queued=1000,
+        max_retries=2,
+        poll_interval=300.0,
+        collect_every=None,
+        collect_interval=3600.0,
+        nprocs=1,
+    ):
+        self.project = project
+        self.max_queued = max_queued
+        self.max_retries = max_retries
+        self.poll_interval = poll_interval
+        # start a collection after collect_every new jobs (default 5% of the
+        # jobs) or collect_interval seconds after the last one
+        self.collect_every = collect_every
+        self.collect_interval = collect_interval
+        self.nprocs = nprocs
+
+        self.submissions = {}
+        self.collected = set()
+        self.last_collect = time.time()
+        self._collect_task = None
+
+    def run(self):
+        """Runs the controller until all jobs are done or out of retries"""
+        return asyncio.run(self.main())
+
+    async def main(self):
+        while True:
+            status = await self.step()
+            if status["finished"]:
+                await self._wait_collection()
+                if not await self._finish_stage(status):
+                    return status
+                continue
+            await asyncio.sleep(self.poll_interval)
+
+    async def _in_thread(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def step(self):
+        """Polls the job states once, submits and collects, returns the status"""
+        project = self.project
+        manifest = project.manifest
+
+        # the queue is queried before reading the manifest, a job which has
+        # left the queue has recorded its final state before
+        queued = await self._in_thread(project.scheduler.queue_length, project.job_name)
+        entries = {info["jobid"]: info for info in manifest.entries(job_states)}
+        for jobid in self._lost_jobs(entries, queued):
+            print(("job {:} left the queue without finishing".format(jobid)))
+            manifest.mark(jobid, FAILED)
+            entries[jobid]["state"] = FAILED
+
+        states = {state: [] for state in job_states}
+        for jobid, info in entries.items():
+            states[info["state"]].append(jobid)
+        unknown = [
+            jobid for jobid in range(1, project.njobs + 1) if jobid not in entries
+        ]
+        retry, exhausted = [], []
+        for jobid in states[FAILED]:
+            if self._tries(entries[jobid]) > self.max_retries:
+                exhausted.append(jobid)
+            else:
+                retry.append(jobid)
+
+        # throttle the submissions to the free places in the queue
+        in_flight = len(states[QUEUED]) + len(states[RUNNING])
+        if queued is not None:
+            in_flight = max(in_flight, queued)
+        todo = sorted(unknown + retry)[: max(self.max_queued - in_flight, 0)]
+        submitted = await self._submit(todo) if len(todo) > 0 else []
+
+        status = {
+            "done": len(states[DONE]),
+            "in flight": in_flight + len(submitted),
+            "waiting": len(unknown) + len(retry) - len(todo),
+            "failed": exhausted,
+            "finished": in_flight + len(unknown) + len(retry) == 0,
+        }
+        print(
+            (
+                "{:}: {:} done, {:} in queue, {:} waiting, {:} out of retries".format(
+                    time.ctime(),
+                    status["done"],
+                    status["in flight"],
+                    status["waiting"],
+                    len(exhausted),
+                )
+            )
+        )
+        self._maybe_collect(set(states[DONE]), status["finished"])
+        return status
+
+    def _tries(self, info):
+        """Number of runs of a job, including submissions which never started"""
+        return max(info["attempts"], self.submissions.get(info["jobid"], 0))
+
+    def _lost_jobs(self, entries, queued):
+        """Queued or running jobs, which are not in the scheduler anymore"""
+        now = time.time()
+        # a job just submitted might not be listed by the scheduler yet
+        settled = now - self.poll_interval
+        time_limit = 3600 * self.project.hours_per_job + self.poll_interval
+        lost = []
+        for jobid, info in entries.items():
+            if info["state"] not in [QUEUED, RUNNING]:
+                continue
+            if queued == 0 and (info["submitted"] or 0) < settled:
+                lost.append(jobid)
+            elif (
+                info["state"] == RUNNING
+                and info["started"] is not None
+                and info["started"] < now - time_limit
+            ):
+                lost.append(jobid)
+        return lost
+
+    async def _submit(self, jobids):
+        """Submits the jobs without a valid output, returns the submitted ones"""
+        project = self.project
+        # jobs with a valid output are marked as done instead, this uses the
+        # manifest and stays on the event loop
+        todo = project._prepare_resubmission(jobids)
+        if len(todo) == 0:
+            return []
+        if await self._in_thread(project.scheduler.submit, project.subfile, todo) != 0:
+            print(("submission of jobs {:} failed".format(array_spec(todo))))
+            return []
+        project.manifest.mark_queued(todo)
+        for jobid in todo:
+            self.submissions[jobid] = self.submissions.get(jobid, 0) + 1
+        return todo
+
+    def _maybe_collect(self, done, finished):
+        """Starts a collection of the new done jobs, unless one is running"""
+        if self._collect_task is not None and not self._collect_task.done():
+            return
+        new = done - self.collected
+        if len(new) == 0:
+            return
+        every = self.collect_every
+        if every is None:
+            every = max(1, self.project.njobs // 20)
+        if (
+            finished
+            or len(new) >= every
+            or time.time() - self.last_collect > self.collect_interval
+        ):
+            self._collect_task = asyncio.ensure_future(self._collect(done))
+
+    async def _collect(self, done):
+        """Runs the incremental collection as a process of the run file"""
+        print(("collecting {:} new jobs".format(len(done - self.collected))))
+        self.last_collect = time.time()
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            self.project.runfile,
+            "--collect",
+            "--nprocs",
+            str(self.nprocs),
+        )
+        if await process.wait() == 0:
+            self.collected |= done
+        else:
+            print(("collection failed with exit code {:}".format(process.returncode)))
+
+    async def _wait_collection(self):
+        """Waits for the running collection and collects the remaining jobs"""
+        if self._collect_task is not None:
+            await self._collect_task
+        self._maybe_collect(set(self.project.manifest.jobs([DONE])), True)
+        if self._collect_task is not None:
+            await self._collect_task
+
+    async def _finish_stage(self, status):
+        """Starts the next refinement stage, returns False if there is none"""
+        project = self.project
+        if len(status["failed"]) > 0:
+            print(
+                (
+                    "jobs {:} failed {:} times, giving up".format(
+                        array_spec(status["failed"]), self.max_retries + 1
+                    )
+                )
+            )
+            return False
+        if len(set(project.manifest.jobs([DONE])) - self.collected) > 0:
+            print("the collection failed, run --collect by hand")
+            return False
+        if project.refinement is None:
+            print("all jobs done and collected")
+            return False
+        points = project.refine()
+        if points is None or len(points) == 0:
+            return False
+        self.submissions = {}
+        self.collected = set()
+        return True
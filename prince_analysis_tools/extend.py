@@ -0,0 +1,173 @@
+"""Extension of a computed scan to a larger grid
+
+A scan with
+
+    "extends": {
+        "collected": "/path/to/old_project/collected.hdf5",
+        "paramlist": old_paramlist,
+    }
+
+computes only the grid points of its paramlist, which are not computed in
+the collected.hdf5 of the old scan. The values of the old axes are matched
+to the new axes with a float tolerance (config['extends']['rtol'] and
+['atol'], as in np.isclose), non-numeric axes exactly, so the new axes can
+add values anywhere or drop old ones. The parameters have to be the same and in the same order.
+The collection copies the old results to their positions in the new grid.
+"""
+
+import numpy as np
+
+
+def value_matches(values, axis, rtol=1e-5, atol=1e-8):
+    """Boolean array (nvalues, axis size) of the values equal to the axis entries
+
+    Numeric axes are matched within the tolerance of np.isclose, all other
+    axes (e.g. strings or the composition dicts of fireball scans) exactly.
+    """
+    axis = np.asarray(axis)
+    values = np.asarray(values).reshape(-1)
+    if axis.dtype.kind in "fiu":
+        try:
+            values = values.astype(np.float64)
+        except (TypeError, ValueError):
+            # values of another type are not on a numeric axis
+            return np.zeros((values.size, axis.size), dtype=bool)
+        return np.isclose(
+            values[:, np.newaxis], axis.astype(np.float64)[np.newaxis, :], rtol, atol
+        )
+    return np.array(
+        [[bool(value == entry) for entry in axis] for value in values],
+        dtype=bool,
+    ).reshape(values.size, axis.size)
+
+
+def match_values(values, axis, rtol=1e-5, atol=1e-8):
+    """Indices of values in the parameter axis, -1 where a value is missing
+
+    Values match as in value_matches. Raises an Exception, if a value
+    matches several entries of the axis.
+    """
+    values = np.asarray(values).reshape(-1)
+    matches = value_matches(values, axis, rtol, atol)
+    counts = matches.sum(axis=1)
+    if (counts > 1).any():
+        pos = np.argmax(counts > 1)
+        raise Exception(
+            "Value {:} matches {:} values of the axis within the tolerance".format(
+                values[pos], counts[pos]
+            )
+        )
+    return np.where(counts == 1, matches.argmax(axis=1), -1)
+
+
+def axis_maps(old_paramlist, new_paramlist, rtol=1e-5, atol=1e-8):
+    """Index of each old axis value on the new axis, -1 if it was dropped"""
+    old_names = [name for name, _ in old_paramlist]
+    new_names = [name for name, _ in new_paramlist]
+    if old_names != new_names:
+        raise Exception(
+            "Cannot extend the parameters {:} to {:}".format(old_names, new_names)
+        )
+    return [
+        match_values(old, new, rtol, atol)
+        for (_, old), (_, new) in zip(old_paramlist, new_paramlist)
+    ]
+
+
+def old_mask(maps):
+    """Boolean old grid marking the points, which are part of the new grid"""
+    mask = np.ones(tuple(len(m) for m in maps), dtype=bool)
+    for axis, amap in enumerate(maps):
+        mask &= (amap >= 0).reshape([-1 if a == axis else 1 for a in range(len(maps))])
+    return mask
+
+
+def to_new_indices(maps, indices):
+    """Index tuples (npoints, ndim) of the old grid on the new grid"""
+    indices = np.asarray(indices, dtype=np.int64).reshape(-1, len(maps))
+    return np.stack([amap[col] for amap, col in zip(maps, indices.T)], axis=-1)
+
+
+def missing_points(new_shape, maps, computed):
+    """Sorted index tuples of the new grid without a computed old grid point
+
+    computed is the boolean old grid of the computed points.
+    """
+    if computed.shape != tuple(len(m) for m in maps):
+        raise Exception(
+            "The old grid {:} does not have the shape of the old paramlist {:}".format(
+                computed.shape, tuple(len(m) for m in maps)
+            )
+        )
+    covered = np.zeros(new_shape, dtype=bool)
+    old = np.argwhere(computed & old_mask(maps))
+    covered[tuple(to_new_indices(maps, old).T)] = True
+    return np.argwhere(~covered)
+
+
+def computed_points(h5old):
+    """Boolean grid of the grid points computed in the collected.hdf5 h5old
+
+    Files written before the collection stored the 'computed' dataset mark
+    the failed grid points by an infinite chi2, as read by ScanPlotter.
+    """
+    if "computed" in h5old:
+        return h5old["computed"][()]
+    return np.isfinite(h5old["default fit"]["chi2"][()])
+
+
+def old_blocks(h5old, maps, new_shape, slab_bytes=2**27):
+    """Yields the computed old results as blocks at their new grid positions
+
+    The blocks hold the datasets written by collect_job_results ('chi2',
+    'norm', 'delta E', 'xmax_shift', 'fractions', 'states' and the costs)
+    and 'positions'. The old grid is read in slabs of the leading axes of
+    at most slab_bytes (or a single grid point).
+    """
+    from .collect import open_states
+    from .costs import cost_names
+
+    computed = computed_points(h5old) & old_mask(maps)
+    old_shape = computed.shape
+    fit = h5old["default fit"]
+    states = open_states(h5old)
+    dense = not hasattr(states, "grid_shape")
+
+    # the states and the fit and cost values of a grid point in float64
+    point_bytes = 8 * (
+        int(np.prod(states.shape[len(old_shape) :]))
+        + 4
+        + fit["fractions"].shape[-1]
+        + len(cost_names)
+    )
+    max_points = max(1, slab_bytes // point_bytes)
+
+    # the number of leading axes iterated, the others are read as slab
+    lead = 0
+    while lead < len(old_shape) and np.prod(old_shape[lead:]) > max_points:
+        lead += 1
+    for head in np.ndindex(*old_shape[:lead]):
+        rest = np.argwhere(computed[head])
+        if len(rest) == 0:
+            continue
+        sel = tuple(rest.T)
+        indices = np.column_stack(
+            [np.full(len(rest), i, dtype=np.int64) for i in head] + [rest]
+        )
+        block = {
+            "positions": np.ravel_multi_index(
+                tuple(to_new_indices(maps, indices).T), new_shape
+            )
+        }
+        for name in ["chi2", "norm", "delta E", "xmax_shift", "fractions"]:
+            block[name] = fit[name][head][sel]
+        for name in cost_names:
+            if "cost" in h5old and name in h5old["cost"]:
+                block[name] = h5old["cost"][name][head][sel]
+            else:
+                block[name] = np.full(len(rest), np.nan)
+        if dense:
+            block["states"] = np.asarray(states[head], dtype=np.float64)[sel]
+        else:
+            block["states"] = np.array([states[tuple(idx)] for idx in indices])
+        yield block
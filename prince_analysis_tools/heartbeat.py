@@ -0,0 +1,118 @@
+"""Heartbeats of the running jobs
+
+After each grid point a job replaces a small json record next to its log
+file with the number of grid points done and remaining and the mean wall
+time per grid point computed so far. --status summarizes the records of all
+jobs into the throughput of the scan, its projected completion and the
+slowest jobs, see PropagationProject.status.
+"""
+
+import json
+import os
+import socket
+import time
+
+
+class Heartbeat(object):
+    """Heartbeat record of a job with npoints grid points
+
+    npoints is None if the number of grid points is not known in advance
+    (work stealing), done the number of grid points restored from a
+    checkpoint. These do not count for the time per grid point.
+    """
+
+    def __init__(self, filepath, jobid, npoints, done=0):
+        self.filepath = filepath
+        self.record = {
+            "jobid": int(jobid),
+            "host": socket.gethostname(),
+            "started": time.time(),
+            "npoints": npoints,
+            "done": done,
+            "computed": 0,
+            "seconds": 0.0,
+        }
+
+    def beat(self, seconds):
+        """Records a grid point computed in seconds and writes the record"""
+        self.record["done"] += 1
+        self.record["computed"] += 1
+        self.record["seconds"] += seconds
+        self.write()
+
+    def write(self):
+        record = dict(self.record)
+        record["time"] = time.time()
+        if record["npoints"] is None:
+            record["remaining"] = None
+        else:
+            record["remaining"] = record["npoints"] - record["done"]
+        if record["computed"] > 0:
+            record["seconds per point"] = record["seconds"] / record["computed"]
+        else:
+            record["seconds per point"] = None
+        tmpfile = self.filepath + ".tmp"
+        with open(tmpfile, "w") as thefile:
+            json.dump(record, thefile)
+        os.replace(tmpfile, self.filepath)
+
+
+def read_heartbeat(filepath):
+    """The record written by Heartbeat, None if it does not exist"""
+    try:
+        with open(filepath) as thefile:
+            return json.load(thefile)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def is_silent(record, now, grace=600.0):
+    """True if an unfinished job did not beat for 3 times its time per point
+
+    Such jobs are probably dead or hanging and candidates to be requeued.
+    """
+    if record["remaining"] == 0:
+        return False
+    expected = 3 * (record["seconds per point"] or 0.0) + grace
+    return now - record["time"] > expected
+
+
+def summarize(records, pending_points, now=None):
+    """Throughput and projected completion of the jobs with heartbeats
+
+    pending_points is the number of grid points of the jobs, which did not
+    start yet. The throughput is the current rate of all running jobs in
+    grid points per hour. Returns a dict with the running, silent and
+    finished records, the throughput, the remaining grid points and the
+    projected completion time (None if nothing runs).
+    """
+    now = time.time() if now is None else now
+    finished = [rec for rec in records if rec["remaining"] == 0]
+    silent = [rec for rec in records if is_silent(rec, now)]
+    running = [
+        rec for rec in records if rec["remaining"] != 0 and not is_silent(rec, now)
+    ]
+    throughput = sum(
+        3600.0 / rec["seconds per point"] for rec in running if rec["seconds per point"]
+    )
+    remaining = pending_points + sum(rec["remaining"] or 0 for rec in running + silent)
+    if throughput > 0:
+        eta = now + 3600.0 * remaining / throughput
+    else:
+        eta = None
+    return {
+        "running": running,
+        "silent": silent,
+        "finished": finished,
+        "throughput": throughput,
+        "remaining": remaining,
+        "eta": eta,
+    }
+
+
+def projected_hours(record):
+    """Projected total runtime of a job in hours, None if not known yet"""
+    if record["seconds per point"] is None or record["remaining"] is None:
+        return None
+    end = record["time"] + record["remaining"] * record["seconds per point"]
+    return (end - record["started"]) / 3600.0
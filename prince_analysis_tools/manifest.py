@@ -0,0 +1,185 @@
+"""Job state manifest of a project
+
+An SQLite database in the project folder holds the state of each job
+(queued, running, done or failed), the host, the start and end time and the
+size of the output. The submit scripts update it with --mark, so that the
+status of a project is known without listing the log and output folders.
+Projects created before the manifest existed can be scanned into it with
+--rebuild-manifest.
+
+The manifest is written by jobs on many nodes, so it uses SQLite's default
+rollback journal, which works with the locking of network filesystems. WAL
+mode needs shared memory between the processes and is only safe if the
+project folder is on a local disk.
+"""
+
+import sqlite3
+import time
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+job_states = [QUEUED, RUNNING, DONE, FAILED]
+
+
+class JobManifest(object):
+    def __init__(self, dbpath, journal_mode="delete", timeout=600.0):
+        self.dbpath = dbpath
+        self.journal_mode = journal_mode
+        self.timeout = timeout
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(
+                self.dbpath, timeout=self.timeout, isolation_level=None
+            )
+            self._conn.execute("PRAGMA journal_mode={:}".format(self.journal_mode))
+            # only WAL stays consistent with fewer syncs on a power loss
+            synchronous = "NORMAL" if self.journal_mode.lower() == "wal" else "FULL"
+            self._conn.execute("PRAGMA synchronous={:}".format(synchronous))
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                    jobid INTEGER PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    host TEXT,
+                    submitted REAL,
+                    started REAL,
+                    finished REAL,
+                    size INTEGER,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    duplicates INTEGER NOT NULL DEFAULT 0
+                )""")
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def mark_queued(self, jobids):
+        """Marks jobs as queued, e.g. after submitting them"""
+        now = time.time()
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            """INSERT INTO jobs (jobid, state, submitted) VALUES (?, ?, ?)
+            ON CONFLICT (jobid) DO UPDATE SET state = excluded.state,
+            submitted = excluded.submitted, started = NULL, finished = NULL,
+            duplicates = 0""",
+            [(int(jobid), QUEUED, now) for jobid in jobids],
+        )
+        conn.execute("COMMIT")
+
+    def mark(self, jobid, state, host=None, size=None):
+        """Updates the state of a single job, called by the running job"""
+        if state not in job_states:
+            raise Exception("Unknown job state: {:}".format(state))
+        now = time.time()
+        if state == RUNNING:
+            self.conn.execute(
+                """INSERT INTO jobs (jobid, state, host, started, attempts)
+                VALUES (?, ?, ?, ?, 1)
+                ON CONFLICT (jobid) DO UPDATE SET state = excluded.state,
+                host = excluded.host, started = excluded.started,
+                finished = NULL, size = NULL, attempts = attempts + 1""",
+                (int(jobid), state, host, now),
+            )
+        else:
+            self.conn.execute(
+                """INSERT INTO jobs (jobid, state, host, finished, size)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (jobid) DO UPDATE SET state = excluded.state,
+                host = COALESCE(excluded.host, host),
+                finished = excluded.finished, size = excluded.size""",
+                (int(jobid), state, host, now, size),
+            )
+
+    def expire(self, time_limit):
+        """Marks jobs running for more than time_limit seconds as failed
+
+        Such jobs were killed by the scheduler (e.g. at h_rt or h_rss) before
+        they could record their final state. Returns their ids.
+        """
+        limit = time.time() - time_limit
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        jobids = [
+            row[0]
+            for row in conn.execute(
+                "SELECT jobid FROM jobs WHERE state = ? AND started < ? ORDER BY jobid",
+                (RUNNING, limit),
+            )
+        ]
+        conn.executemany(
+            "UPDATE jobs SET state = ? WHERE jobid = ?",
+            [(FAILED, jobid) for jobid in jobids],
+        )
+        conn.execute("COMMIT")
+        return jobids
+
+    def mark_duplicate(self, jobid):
+        """Counts a speculative duplicate submitted for a running job"""
+        self.conn.execute(
+            "UPDATE jobs SET duplicates = duplicates + 1 WHERE jobid = ?",
+            (int(jobid),),
+        )
+
+    def jobs(self, states=None):
+        """Sorted ids of the jobs in one of the given states (all if None)"""
+        if states is None:
+            rows = self.conn.execute("SELECT jobid FROM jobs ORDER BY jobid")
+        else:
+            states = list(states)
+            rows = self.conn.execute(
+                "SELECT jobid FROM jobs WHERE state IN ({:}) ORDER BY jobid".format(
+                    ",".join("?" * len(states))
+                ),
+                states,
+            )
+        return [row[0] for row in rows]
+
+    def entries(self, states):
+        """Dicts with the manifest entries of all jobs in one of the states"""
+        states = list(states)
+        cursor = self.conn.execute(
+            "SELECT * FROM jobs WHERE state IN ({:}) ORDER BY jobid".format(
+                ",".join("?" * len(states))
+            ),
+            states,
+        )
+        names = [col[0] for col in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+
+    def info(self, jobid):
+        """Dict with the manifest entry of a job, None if it is unknown"""
+        cursor = self.conn.execute("SELECT * FROM jobs WHERE jobid = ?", (int(jobid),))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([col[0] for col in cursor.description], row))
+
+    def counts(self):
+        """Number of jobs in each state"""
+        res = {state: 0 for state in job_states}
+        for state, count in self.conn.execute(
+            "SELECT state, COUNT(*) FROM jobs GROUP BY state"
+        ):
+            res[state] = count
+        return res
+
+    def rebuild(self, entries):
+        """Replaces the manifest by entries, a list of
+        (jobid, state, host, started, finished, size) tuples
+        """
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM jobs")
+            conn.executemany(
+                """INSERT INTO jobs (jobid, state, host, started, finished, size)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                entries,
+            )
+            conn.execute("COMMIT")
+        except:  # noqa: E722
+            conn.execute("ROLLBACK")
+            raise
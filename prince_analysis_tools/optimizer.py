@@ -1,4 +1,5 @@
 import numpy as np
+from .tracing import span
 from .xmax import XmaxSimple
 
 
@@ -13,6 +14,7 @@ class UHECROptimizer(object):
         Emin=6e9,
         norms=None,
         xmax_model=None,
+        interpolators=None,
     ):
         self.Emin = Emin
 
@@ -40,9 +42,35 @@ class UHECROptimizer(object):
             ncoids = list(range(len(self.lst_res)))
         self.ncoids = ncoids
 
-        self._create_interpolators()
+        # the interpolated model only depends on the results, not on the data
+        if interpolators is None:
+            with span("create_interpolators", nspecies=len(self.lst_res)):
+                self._create_interpolators()
+        else:
+            self.intp_spectrum, self.intp_mean_lnA, self.intp_var_lnA = interpolators
         self.compute_combined_result(norms)
 
+    @property
+    def interpolators(self):
+        return self.intp_spectrum, self.intp_mean_lnA, self.intp_var_lnA
+
+    def for_data(self, spectrum, Xmax, XRMS, Emin=None, xmax_model=None):
+        """Optimizer for other data, Emin or Xmax model with the same model
+
+        Reuses the interpolators of the model observables instead of reading
+        them again from the results.
+        """
+        return UHECROptimizer(
+            self.lst_res,
+            spectrum,
+            Xmax,
+            XRMS,
+            ncoids=self.ncoids,
+            Emin=self.Emin if Emin is None else Emin,
+            xmax_model=xmax_model,
+            interpolators=self.interpolators,
+        )
+
     def _create_interpolators(self):
         from scipy.interpolate import interp1d
 
@@ -272,9 +300,13 @@ class UHECROptimizer(object):
                 )
 
                 params.update(minimizer_args)
-                m = Minuit(chi2, forced_parameters=arg_names, errordef=1.0, **params)
-                # m.print_param()
-                m.migrad(ncall=100000)
+                with span("migrad", deltaE=delta_start, xmax_shift=shift_start) as sp:
+                    m = Minuit(
+                        chi2, forced_parameters=arg_names, errordef=1.0, **params
+                    )
+                    # m.print_param()
+                    m.migrad(ncall=100000)
+                    sp["fval"] = m.fval
 
                 if m_best is None:
                     m_best = m
@@ -313,42 +345,44 @@ class UHECRWalker(object):
 
         lst_models = []
         for ncoid in particle_ids:
+            with span("solve", species=ncoid, rmax=rmax, gamma=gamma, m=m):
+                solver = UHECRPropagationSolverBDF(
+                    initial_z=initial_z,
+                    final_z=final_z,
+                    prince_run=self.prince_run,
+                    enable_partial_diff_jacobian=True,
+                    atol=atol,
+                )
 
-            solver = UHECRPropagationSolverBDF(
-                initial_z=initial_z,
-                final_z=final_z,
-                prince_run=self.prince_run,
-                enable_partial_diff_jacobian=True,
-                atol=atol,
-            )
-
-            if sclass == "auger":
-                params = {
-                    ncoid: (gamma, rmax, 1.0),
-                }
-                source = AugerFitSource(self.prince_run, params=params, m=m, norm=1.0)
-            elif sclass == "simple":
-                params = {
-                    ncoid: (gamma, rmax, 1.0),
-                }
-                source = SimpleSource(self.prince_run, params=params, m=m, norm=1.0)
-            elif sclass == "rflex":
-                params = {
-                    ncoid: (gamma, rmax, rscale, 1.0),
-                }
-                source = RigidityFlexSource(
-                    self.prince_run, params=params, m=m, norm=1.0
+                if sclass == "auger":
+                    params = {
+                        ncoid: (gamma, rmax, 1.0),
+                    }
+                    source = AugerFitSource(
+                        self.prince_run, params=params, m=m, norm=1.0
+                    )
+                elif sclass == "simple":
+                    params = {
+                        ncoid: (gamma, rmax, 1.0),
+                    }
+                    source = SimpleSource(self.prince_run, params=params, m=m, norm=1.0)
+                elif sclass == "rflex":
+                    params = {
+                        ncoid: (gamma, rmax, rscale, 1.0),
+                    }
+                    source = RigidityFlexSource(
+                        self.prince_run, params=params, m=m, norm=1.0
+                    )
+                else:
+                    raise Exception("Unknown source class: {:}".format(sclass))
+                solver.add_source_class(source)
+                # solver.set_initial_condition()
+                solver.solve(
+                    dz=max_step,
+                    verbose=False,
+                    full_reset=False,
+                    progressbar=self.progressbar,
                 )
-            else:
-                raise Exception("Unknown source class: {:}".format(sclass))
-            solver.add_source_class(source)
-            # solver.set_initial_condition()
-            solver.solve(
-                dz=max_step,
-                verbose=False,
-                full_reset=False,
-                progressbar=self.progressbar,
-            )
 
             lst_models.append(solver.res)
 
@@ -364,7 +398,8 @@ class UHECRWalker(object):
         # print 'computing with source parameters :'
         # print source_params
 
-        lst_models = self.compute_models(particle_ids, **source_params)
+        with span("compute_models", species=list(particle_ids), **source_params):
+            lst_models = self.compute_models(particle_ids, **source_params)
 
         optimizer = UHECROptimizer(
             lst_models,
@@ -374,8 +409,11 @@ class UHECRWalker(object):
             Emin=Emin,
             ncoids=particle_ids,
         )
-        minres = optimizer.fit_data_minuit(spectrum_only=spectrum_only)
-        lst_res = [res.to_dict() for res in optimizer.lst_res]
+        with span("fit_data_minuit", spectrum_only=spectrum_only) as sp:
+            minres = optimizer.fit_data_minuit(spectrum_only=spectrum_only)
+            sp["fval"] = minres.fval
+        with span("to_dict"):
+            lst_res = [res.to_dict() for res in optimizer.lst_res]
         mindetail = (
             minres.parameters,
             list(minres.args),
@@ -0,0 +1,328 @@
+"""Formats of the per job output files
+
+By default a job pickles the list of results returned by single_run_func.
+Alternatively the results are stored as fixed dtype columns in a npz or
+hdf5 shard, with egrid and known_spec stored only once per job. The file
+name stays the same, the format is detected from the first bytes.
+
+Columns of a shard:
+    chi2        (npoints,)
+    failed      (npoints,) grid points, where the computation failed
+    fit params  (npoints, nparams) delta E, xmax shift and the norms
+    fit errors  (npoints, nparams)
+    states      (npoints, ninjected, state size), only for propagation jobs
+    egrid, known_spec
+    grid positions (npoints,) only if the results are not in perm_slice order
+
+The results of a fit with several configurations are dicts {fit_tag:
+(chi2, mindetail)}, their columns are stored as '<fit_tag>/chi2', ...
+
+Next to each output, a json sidecar stores its sha256, size and number of
+records, so that its integrity can be checked without decoding it.
+"""
+
+import numpy as np
+
+format_version = 1
+
+_magic = {
+    b"\x89HDF\r\n\x1a\n": "hdf5",
+    b"PK\x03\x04": "npz",
+}
+
+
+def detect_format(outputfile):
+    """Returns 'pickle', 'npz' or 'hdf5' from the first bytes of a file"""
+    with open(outputfile, "rb") as thefile:
+        head = thefile.read(8)
+    for magic, fmt in _magic.items():
+        if head.startswith(magic):
+            return fmt
+    return "pickle"
+
+
+def _errors(mindetail, nparams):
+    """Parameter errors from the mindetail tuple, NaN if not available"""
+    try:
+        errors = mindetail[3]
+        errors = errors.values() if hasattr(errors, "values") else errors
+        errors = [e[1] if isinstance(e, tuple) else e for e in errors]
+        return np.array(errors, dtype=np.float64).reshape(nparams)
+    except Exception:
+        return np.full(nparams, np.nan)
+
+
+def _failed(res):
+    """Failed grid points are stored with all entries set to inf"""
+    return isinstance(res, (tuple, list)) and all(
+        np.isscalar(x) and np.isinf(x) for x in res
+    )
+
+
+def _is_columnar(res):
+    """True for a (chi2, mindetail[, result dicts]) tuple, which fits the columns"""
+    if not isinstance(res, (tuple, list)) or len(res) not in [2, 3]:
+        return False
+    mindetail = res[1]
+    if not isinstance(mindetail, (tuple, list)) or len(mindetail) < 2:
+        return False
+    if np.ndim(mindetail[1]) != 1:
+        return False
+    if len(res) == 3:
+        singles = res[2]
+        return (
+            isinstance(singles, (tuple, list))
+            and len(singles) > 0
+            and all(
+                isinstance(single, dict)
+                and all(key in single for key in ["state", "egrid", "known_spec"])
+                for single in singles
+            )
+        )
+    return True
+
+
+def results_to_columns(results):
+    """Converts a list of job results to a dict of arrays
+
+    Handles the results of UHECRWalker.compute_gridpoint, i.e. tuples of
+    (chi2, mindetail, [result dicts]), of fit only jobs, (chi2, mindetail),
+    and of multi configuration fits, dicts of (chi2, mindetail).
+    If all grid points failed, only chi2 and failed are returned.
+    Returns None for results with any other structure.
+    """
+    multi = next((res for res in results if isinstance(res, dict)), None)
+    if multi is not None:
+        # a point that failed completely is a single tuple of inf
+        columns = {}
+        for tag in multi:
+            sub = results_to_columns(
+                [res[tag] if isinstance(res, dict) else res for res in results]
+            )
+            if sub is None:
+                return None
+            columns.update({tag + "/" + name: arr for name, arr in sub.items()})
+        return columns
+    valid = [res for res in results if not _failed(res)]
+    if not all(_is_columnar(res) for res in valid):
+        return None
+    npoints = len(results)
+    if len(valid) == 0:
+        # all grid points failed (or none computed), only chi2 is known
+        return {"chi2": np.full(npoints, np.inf), "failed": np.ones(npoints, bool)}
+    sample = valid[0]
+    if len(set(len(res) for res in valid)) != 1:
+        return None
+    nparams = len(sample[1][1])
+    columns = {
+        "chi2": np.full(npoints, np.inf),
+        "failed": np.ones(npoints, dtype=bool),
+        "fit params": np.full((npoints, nparams), np.nan),
+        "fit errors": np.full((npoints, nparams), np.nan),
+    }
+    if len(sample) == 3:
+        first = sample[2][0]
+        state_shape = (len(sample[2]), first["state"].size)
+        columns["egrid"] = np.asarray(first["egrid"], dtype=np.float64)
+        columns["known_spec"] = np.asarray(first["known_spec"], dtype=np.int64)
+        columns["states"] = np.full((npoints,) + state_shape, np.nan)
+
+    for row, res in enumerate(results):
+        if _failed(res):
+            # Something went wrong in this case, no data there
+            continue
+        chi2, mindetail = res[0], res[1]
+        columns["chi2"][row] = chi2
+        columns["failed"][row] = False
+        columns["fit params"][row] = mindetail[1]
+        columns["fit errors"][row] = _errors(mindetail, nparams)
+        if "states" in columns:
+            for inj, single in enumerate(res[2]):
+                columns["states"][row, inj] = single["state"]
+    return columns
+
+
+def write_output(results, outputfile, fmt="pickle", compression=None, positions=None):
+    """Writes the results of a job in the given format
+
+    fmt is 'pickle', 'npz' or 'hdf5'. compression is None, 'zip' (npz),
+    'gzip', 'lzf' or 'zstd' (hdf5, zstd needs hdf5plugin). Results, which
+    cannot be stored as columns, are pickled.
+    positions are the flat grid positions of the results, they are only
+    stored if the results are not in the order of perm_slice(jobid).
+    """
+    import pickle as pickle
+
+    columns = None if fmt == "pickle" else results_to_columns(results)
+    if fmt != "pickle" and columns is None:
+        print("results cannot be stored as columns, pickling them instead")
+
+    if columns is None:
+        if positions is not None:
+            results = {"grid positions": np.asarray(positions), "results": results}
+        with open(outputfile, "wb") as thefile:
+            pickle.dump(results, thefile, protocol=pickle.HIGHEST_PROTOCOL)
+        return
+
+    if positions is not None:
+        columns["grid positions"] = np.asarray(positions, dtype=np.int64)
+    if fmt == "npz":
+        columns["format version"] = np.array(format_version)
+        # the file object keeps numpy from appending .npz to the name
+        with open(outputfile, "wb") as thefile:
+            if compression is None:
+                np.savez(thefile, **columns)
+            else:
+                np.savez_compressed(thefile, **columns)
+    elif fmt == "hdf5":
+        import h5py
+
+        kwargs = {}
+        if compression == "zstd":
+            import hdf5plugin
+
+            kwargs.update(hdf5plugin.Zstd())
+        elif compression is not None:
+            kwargs["compression"] = compression
+        with h5py.File(outputfile, "w") as h5file:
+            h5file.attrs["format version"] = format_version
+            for name, arr in columns.items():
+                if name == "states" and kwargs:
+                    # one chunk per grid point, like in collected.hdf5
+                    h5file.create_dataset(
+                        name, data=arr, chunks=(1,) + arr.shape[1:], **kwargs
+                    )
+                else:
+                    h5file.create_dataset(name, data=arr)
+    else:
+        raise Exception("Unknown output format: {:}".format(fmt))
+
+
+def _read_hdf5_columns(outputfile, mmap, exclude=()):
+    import h5py
+
+    datasets = []
+
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset) and name not in exclude:
+            datasets.append((name, obj))
+
+    columns = {}
+    with h5py.File(outputfile, "r") as h5file:
+        # the columns of multi configuration fits are in one group per fit
+        h5file.visititems(visit)
+        for name, dset in datasets:
+            offset = dset.id.get_offset()
+            if mmap and dset.chunks is None and offset is not None:
+                # contiguous uncompressed data can be mapped directly
+                columns[name] = np.memmap(
+                    outputfile,
+                    dtype=dset.dtype,
+                    mode="r",
+                    offset=offset,
+                    shape=dset.shape,
+                )
+            else:
+                columns[name] = dset[()]
+    return columns
+
+
+def read_columns(outputfile, mmap=True, exclude=()):
+    """Reads a job output as dict of columns, independent of its format
+
+    Uncompressed hdf5 shards are memory-mapped instead of read. The columns
+    in exclude are not read from hdf5 shards.
+    Returns None for pickled results, which cannot be converted to columns.
+    """
+    fmt = detect_format(outputfile)
+    if fmt == "hdf5":
+        return _read_hdf5_columns(outputfile, mmap, exclude)
+    elif fmt == "npz":
+        with np.load(outputfile) as npz:
+            return {name: npz[name] for name in npz.files}
+    else:
+        results = read_output(outputfile)
+        if isinstance(results, dict):
+            columns = results_to_columns(results["results"])
+            if columns is not None:
+                columns["grid positions"] = results["grid positions"]
+            return columns
+        return results_to_columns(results)
+
+
+def read_output(outputfile):
+    """Reads a job output, pickled results as list, shards as dict of columns"""
+    import pickle as pickle
+
+    if detect_format(outputfile) == "pickle":
+        with open(outputfile, "rb") as thefile:
+            return pickle.load(thefile)
+    else:
+        return read_columns(outputfile, mmap=False)
+
+
+def file_checksum(filepath, blocksize=2**20):
+    """sha256 hex digest of a file"""
+    import hashlib
+
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as thefile:
+        for block in iter(lambda: thefile.read(blocksize), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def count_records(results):
+    """Number of grid points in the results returned by read_output"""
+    if isinstance(results, dict) and "results" in results:
+        return len(results["results"])
+    elif isinstance(results, dict):
+        chi2 = [
+            arr
+            for name, arr in results.items()
+            if name == "chi2" or name.endswith("/chi2")
+        ]
+        return len(chi2[0])
+    return len(results)
+
+
+def write_checksum(outputfile, sidecarfile, nrecords):
+    """Writes a json sidecar with the hash, size and record count of an output"""
+    import json
+    import os
+
+    info = {
+        "sha256": file_checksum(outputfile),
+        "size": os.path.getsize(outputfile),
+        "records": nrecords,
+        "format": detect_format(outputfile),
+        "format version": format_version,
+    }
+    tmpfile = sidecarfile + ".tmp"
+    with open(tmpfile, "w") as thefile:
+        json.dump(info, thefile)
+    os.replace(tmpfile, sidecarfile)
+
+
+def verify_checksum(outputfile, sidecarfile):
+    """Compares an output with its sidecar without decoding it
+
+    Returns None if they match, otherwise the reason of the mismatch
+    """
+    import json
+    import os
+
+    if not os.path.exists(sidecarfile):
+        return "no checksum"
+    try:
+        with open(sidecarfile) as thefile:
+            info = json.load(thefile)
+    except Exception:
+        return "unreadable checksum"
+    if os.path.getsize(outputfile) != info["size"]:
+        return "size {:} instead of {:}".format(
+            os.path.getsize(outputfile), info["size"]
+        )
+    elif file_checksum(outputfile) != info["sha256"]:
+        return "checksum mismatch"
+    return None
@@ -1,11 +1,41 @@
 import h5py
 import numpy as np
 
+from .collect import register_filters, chunk_cache_kwargs, open_states
+
+
+def _auger_data(dataset):
+    """Spectrum, Xmax and XRMS data of the Auger dataset from the given year"""
+    if dataset == 2019:
+        from .spectra import auger2019 as spec
+        from .spectra import Xmax2019 as xmax
+        from .spectra import XRMS2019 as xrms
+    elif dataset == 2017:
+        from .spectra import auger2017 as spec
+        from .spectra import Xmax2017 as xmax
+        from .spectra import XRMS2017 as xrms
+    elif dataset == 2015:
+        from .spectra import auger2015 as spec
+        from .spectra import Xmax2015 as xmax
+        from .spectra import XRMS2015 as xrms
+    else:
+        raise Exception("Unknown dataset from year {:}".format(dataset))
+    return spec, xmax, xrms
+
 
 class ScanPlotter(object):
+    """Results of a collected scan
+
+    For a sampled scan (see sampling.py) the arrays are indexed by the
+    sample number, index2params returns the parameters of a sample point and
+    paramlist can be None, the names are read from the file then.
+    """
 
-    def __init__(self, filepath, input_spec, paramlist, fit=None):
+    def __init__(self, filepath, input_spec, paramlist=None, fit=None, cache_mb=None):
         self.filepath = filepath
+        # size of the hdf5 chunk cache used to read the states
+        self.cache_mb = cache_mb
+        register_filters()
 
         with h5py.File(self.filepath, "r") as f:
             self.available = list(f.keys())
@@ -29,9 +59,25 @@ class ScanPlotter(object):
 
             self.fractions_array = f[fit]["fractions"][:]
 
+            # grid points computed in an adaptive scan (or collected so far)
+            if "computed" in f[fit]:
+                self.computed = f[fit]["computed"][:]
+            elif "computed" in f:
+                self.computed = f["computed"][:]
+            else:
+                self.computed = np.isfinite(self.chi2_array)
+
             self.egrid = f["egrid"][:]
             self.known_spec = f["known_spec"][:]
 
+            if "sample points" in f:
+                self.sample_points = f["sample points"][:]
+                self.sample_names = [
+                    str(name) for name in f["sample points"].attrs["names"]
+                ]
+            else:
+                self.sample_points = None
+
         self.input_spec = input_spec
         self.paramlist = paramlist
 
@@ -80,24 +126,36 @@ class ScanPlotter(object):
 
     @property
     def paramnames(self):
+        if self.sample_points is not None:
+            return self.sample_names
         return [p[0] for p in self.paramlist]
 
     @property
     def paramvalues(self):
+        if self.sample_points is not None:
+            return list(self.sample_points.T)
         return [p[1] for p in self.paramlist]
 
     @property
     def minchi2(self):
-        return self.chi2_array.min()
+        # grid points, which are not (yet) collected are NaN
+        return np.nanmin(self.chi2_array)
 
     @property
     def minindex(self):
-        return np.unravel_index(self.chi2_array.argmin(), self.chi2_array.shape)
+        return np.unravel_index(np.nanargmin(self.chi2_array), self.chi2_array.shape)
 
     def index2params(self, index):
+        if self.sample_points is not None:
+            return tuple(self.sample_points[index[0]])
         return tuple(p[i] for p, i in zip(self.paramvalues, index))
 
     def closest_params(self, params):
+        if self.sample_points is not None:
+            # nearest sample point, each parameter in units of its spread
+            scale = np.std(self.sample_points, axis=0)
+            dist = (((self.sample_points - params) / scale) ** 2).sum(axis=1)
+            return (int(dist.argmin()),)
         return tuple(
             (np.abs(array - value)).argmin()
             for array, value in zip(self.paramvalues, params)
@@ -107,19 +165,59 @@ class ScanPlotter(object):
     def permutations(self):
         import itertools as it
 
+        if self.sample_points is not None:
+            return [(i,) for i in range(len(self.sample_points))]
         # Create a list of all permutations of the scan parameters
         permutations = it.product(*[list(range(arr[1].size)) for arr in self.paramlist])
         return list(permutations)
 
+    def points_within(self, chi_max=14.16):
+        """Indices and parameters of all points with chi2 - min(chi2) < chi_max
+
+        Returns an index array (npoints, ndim) and the parameter values
+        (npoints, nparams), sorted by chi2
+        """
+        with np.errstate(invalid="ignore"):
+            sig = np.argwhere(self.chi2_array - self.minchi2 < chi_max)
+        sig = sig[np.argsort(self.chi2_array[tuple(sig.T)])]
+        params = np.array([self.index2params(tuple(idx)) for idx in sig])
+        return sig, params.reshape(len(sig), len(self.paramnames))
+
+    def profile_chi2(self, name, bins=20):
+        """Profile delta chi2 along the parameter name
+
+        The minimum delta chi2 over all other parameters, per value of the
+        parameter for a grid, per bin (number or edges) for a sampled scan.
+        Returns the parameter values (bin centers) and the delta chi2.
+        """
+        axis = list(self.paramnames).index(name)
+        delta = self.chi2_array - self.minchi2
+        if self.sample_points is None:
+            others = tuple(a for a in range(delta.ndim) if a != axis)
+            return np.asarray(self.paramvalues[axis]), np.nanmin(delta, axis=others)
+
+        values = self.sample_points[:, axis]
+        finite = np.isfinite(delta)
+        edges = np.histogram_bin_edges(values, bins=bins)
+        which = np.clip(np.digitize(values, edges) - 1, 0, len(edges) - 2)
+        profile = np.full(len(edges) - 1, np.nan)
+        np.fmin.at(profile, which[finite], delta[finite])
+        return 0.5 * (edges[1:] + edges[:-1]), profile
+
+    def _open_states(self):
+        return h5py.File(self.filepath, "r", **chunk_cache_kwargs(self.cache_mb))
+
     def get_states(self, index):
-        with h5py.File(self.filepath, "r") as f:
-            print((f["states"].shape))
-            states = f["states"][index]
+        """States of the grid point index as float64, also if stored sparsely"""
+        with self._open_states() as f:
+            states = open_states(f)
+            print((states.shape))
+            states = np.asarray(states[index], dtype=np.float64)
         return states
 
     def get_results(self, index):
-        with h5py.File(self.filepath, "r") as f:
-            states = f["states"][index]
+        with self._open_states() as f:
+            states = np.asarray(open_states(f)[index], dtype=np.float64)
 
         dicts = [
             {"egrid": self.egrid, "known_spec": self.known_spec, "state": state}
@@ -146,11 +244,11 @@ class ScanPlotter(object):
         """Reads out the neutrino fluxes within a range defined by chi_max"""
 
         if fix_m is None:
-            sig = np.argwhere(self.chi2_array - self.chi2_array.min() < chi_max)
+            sig = np.argwhere(self.chi2_array - np.nanmin(self.chi2_array) < chi_max)
             sig = [tuple(idx) for idx in sig]
         else:
             sig = np.argwhere(
-                self.chi2_array[:, :, fix_m] - self.chi2_array[:, :, fix_m].min()
+                self.chi2_array[:, :, fix_m] - np.nanmin(self.chi2_array[:, :, fix_m])
                 < chi_max
             )
             sig = [(idx[0], idx[1], fix_m) for idx in sig]
@@ -232,20 +330,7 @@ class ScanPlotter(object):
         spectrum_only=False,
         dataset=2017,
     ):
-        if dataset == 2019:
-            from .spectra import auger2019 as spec
-            from .spectra import Xmax2019 as xmax
-            from .spectra import XRMS2019 as xrms
-        elif dataset == 2017:
-            from .spectra import auger2017 as spec
-            from .spectra import Xmax2017 as xmax
-            from .spectra import XRMS2017 as xrms
-        elif dataset == 2015:
-            from .spectra import auger2015 as spec
-            from .spectra import Xmax2015 as xmax
-            from .spectra import XRMS2015 as xrms
-        else:
-            raise Exception("Unknown dataset from year {:}".format(dataset))
+        spec, xmax, xrms = _auger_data(dataset)
 
         lst_results = self.get_results(index)
         from .optimizer import UHECROptimizer
@@ -267,6 +352,48 @@ class ScanPlotter(object):
 
         return minres, optimizer
 
+    def recompute_fits(self, index, fit_configs):
+        """Fits several configurations to the same grid point
+
+        fit_configs is a list of dicts with the keywords of recompute_fit
+        (minimizer_args, Emin, xmax_model, spectrum_only, dataset). The states
+        are read and the model is interpolated only once for all of them.
+        Returns a list of (minuit, optimizer) in the order of fit_configs.
+        """
+        from .optimizer import UHECROptimizer
+
+        lst_results = self.get_results(index)
+        base = None
+        res = []
+        for conf in fit_configs:
+            spec, xmax, xrms = _auger_data(conf.get("dataset", 2017))
+            if base is None:
+                base = UHECROptimizer(
+                    lst_results,
+                    spec,
+                    xmax,
+                    xrms,
+                    Emin=conf.get("Emin", 6e9),
+                    ncoids=self.input_spec,
+                    xmax_model=conf.get("xmax_model", None),
+                )
+                optimizer = base
+            else:
+                optimizer = base.for_data(
+                    spec,
+                    xmax,
+                    xrms,
+                    Emin=conf.get("Emin", 6e9),
+                    xmax_model=conf.get("xmax_model", None),
+                )
+            params = {"fix_deltaE": True, "fix_xmax_shift": True}
+            params.update(conf.get("minimizer_args", {}))
+            minres = optimizer.fit_data_minuit(
+                spectrum_only=conf.get("spectrum_only", False), minimizer_args=params
+            )
+            res.append((minres, optimizer))
+        return res
+
     def recompute_fit_proton_component(
         self,
         index,
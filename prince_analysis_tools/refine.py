@@ -0,0 +1,68 @@
+"""Grid points of the stages of an adaptive scan
+
+A scan with config['refinement'] = {'strides': [8, 4, 2, 1], ...} first
+computes every 8th grid point along each axis (plus the last one). Each
+following stage computes the points of the next finer stride, but only in
+the cells around points with chi2 below the minimum plus the threshold.
+All stages are collected into the same dense grid in collected.hdf5.
+"""
+
+import numpy as np
+
+
+def normalize_strides(strides, ndim):
+    """List of per axis stride tuples from a list of ints or tuples"""
+    res = []
+    for stride in strides:
+        stride = (stride,) * ndim if np.isscalar(stride) else tuple(stride)
+        if len(stride) != ndim:
+            raise Exception("Stride {:} for a grid of {:} axes".format(stride, ndim))
+        res.append(tuple(int(s) for s in stride))
+    for coarse, fine in zip(res[:-1], res[1:]):
+        if any(c % f != 0 for c, f in zip(coarse, fine)):
+            raise Exception(
+                "Stride {:} is not a multiple of the next stride {:}".format(
+                    coarse, fine
+                )
+            )
+    return res
+
+
+def _on_lattice(idx, stride, size):
+    """Indices on the lattice of the stride along an axis, including the last one"""
+    return (idx % stride == 0) | (idx == size - 1)
+
+
+def lattice_mask(shape, stride):
+    """Boolean grid marking the points on the lattice of stride"""
+    mask = np.ones(shape, dtype=bool)
+    for axis, (size, s) in enumerate(zip(shape, stride)):
+        on_axis = _on_lattice(np.arange(size), s, size)
+        mask &= on_axis.reshape([-1 if a == axis else 1 for a in range(len(shape))])
+    return mask
+
+
+def refine_points(chi2, computed, stride, next_stride, delta_chi2, margin=0.0):
+    """Grid points of the next stage around the points within delta_chi2
+
+    Selects the computed points with chi2 < min(chi2) + delta_chi2 + margin
+    and returns the not yet computed points of the lattice of next_stride
+    within one coarse stride of them, as sorted index tuples (npoints, ndim).
+    """
+    from scipy.ndimage import binary_dilation
+
+    valid = computed & np.isfinite(chi2)
+    if not valid.any():
+        raise Exception("No computed grid points to refine")
+    limit = np.min(chi2[valid]) + delta_chi2 + margin
+    selected = valid & (chi2 < limit)
+
+    # the cells adjacent to the selected points
+    near = binary_dilation(selected, structure=np.ones([2 * s + 1 for s in stride]))
+    todo = near & lattice_mask(chi2.shape, next_stride) & ~computed
+    return np.argwhere(todo)
+
+
+def stage_points(shape, stride):
+    """Index tuples (npoints, ndim) of all grid points on the lattice of stride"""
+    return np.argwhere(lattice_mask(shape, stride))
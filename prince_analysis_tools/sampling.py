@@ -0,0 +1,88 @@
+"""Quasi-random sampling of the parameter space
+
+Instead of the product grid of config['paramlist'], a scan with
+
+    "sampling": {
+        "method": "sobol",  # or "lhs"
+        "npoints": 4096,
+        "seed": 42,
+        "bounds": (
+            ("gamma", -1.5, 2.5),
+            ("rmax", 10**8.5, 10**11.5, "log"),
+            ("m", -6.0, 6.0),
+        ),
+    }
+
+computes npoints points of a scrambled Sobol sequence or a Latin hypercube
+within the bounds (sampled uniformly in log10 for 'log'). The points are
+drawn once by -c and stored in samples.npz in the project folder. The scan
+is distributed as a one dimensional grid of the sample numbers, single_run
+receives the index (i,) and looks up the parameters with sample_params.
+"""
+
+import os.path as path
+
+import numpy as np
+
+sampling_methods = ["sobol", "lhs"]
+
+
+def parse_bounds(bounds):
+    """Names, lower and upper bounds and log flags of the sampled parameters"""
+    names, lower, upper, log = [], [], [], []
+    for bound in bounds:
+        if len(bound) not in [3, 4] or (len(bound) == 4 and bound[3] != "log"):
+            raise Exception(
+                "Bounds are given as (name, lower, upper[, 'log']), not {:}".format(
+                    bound
+                )
+            )
+        names.append(bound[0])
+        log.append(len(bound) == 4)
+        lower.append(np.log10(bound[1]) if log[-1] else float(bound[1]))
+        upper.append(np.log10(bound[2]) if log[-1] else float(bound[2]))
+    return names, np.array(lower), np.array(upper), np.array(log)
+
+
+def draw_samples(sampling):
+    """Array (npoints, ndim) of parameter values drawn from the design"""
+    from scipy.stats import qmc
+
+    names, lower, upper, log = parse_bounds(sampling["bounds"])
+    method = sampling.get("method", "sobol")
+    seed = sampling.get("seed", None)
+    if method == "sobol":
+        sampler = qmc.Sobol(len(names), scramble=True, seed=seed)
+    elif method == "lhs":
+        sampler = qmc.LatinHypercube(len(names), seed=seed)
+    else:
+        raise Exception(
+            "Unknown sampling method {:}, choose one of {:}".format(
+                method, sampling_methods
+            )
+        )
+    points = qmc.scale(sampler.random(int(sampling["npoints"])), lower, upper)
+    points[:, log] = 10 ** points[:, log]
+    return points
+
+
+def write_samples(filepath, names, points):
+    with open(filepath, "wb") as thefile:
+        np.savez(thefile, names=np.array(names), points=points)
+
+
+def read_samples(filepath):
+    """Names and points (npoints, ndim) stored by write_samples"""
+    with np.load(filepath) as data:
+        return [str(name) for name in data["names"]], data["points"]
+
+
+_samples_cache = {}
+
+
+def sample_params(conf, index):
+    """Parameter values of the sample point index, for single_run"""
+    filepath = path.join(conf["targetdir"], conf["project_tag"], "samples.npz")
+    if filepath not in _samples_cache:
+        _samples_cache[filepath] = read_samples(filepath)[1]
+    return tuple(_samples_cache[filepath][index[0]])
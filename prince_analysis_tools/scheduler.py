@@ -0,0 +1,395 @@
+"""Scheduler backends used by PropagationProject to submit its job arrays
+
+Each backend provides a submit template and knows how to submit an arbitrary
+list of job ids as a single array submission.
+"""
+
+import os.path as path
+import subprocess
+from abc import ABC, abstractmethod
+
+template_sge = """#!/bin/zsh
+#$ -N {project_tag}
+#$ -l h_rt={hours}:00:00
+#$ -l h_rss={mem}G
+#$ -j y
+#$ -m ae
+#$ -o /dev/null
+
+# For resubmissions the array task ids point to lines in the list of job ids
+if [ -n "$JOBLIST" ]; then
+    JOBID=$(sed -n "${{SGE_TASK_ID}}p" $JOBLIST)
+else
+    JOBID=$SGE_TASK_ID
+fi
+exec > {folder_log}/{project_tag}$JOBID${{SPECULATIVE:+.spec}}.log 2>&1
+
+OUTFILE={folder_out}/{project_tag}$JOBID.out
+TMPOUT=$TMPDIR/tmp.out
+
+echo Starting job with options on
+echo `hostname`. Now is `date`
+
+source ~/.zshrc
+python {runfile} --mark running --jobid $JOBID ${{SPECULATIVE:+--speculative}}
+
+#Copy output to destination and record the final state in the job manifest
+#The output is hard linked, so of several copies of a job only the first one wins
+if python {runfile} -r --jobid $JOBID --outfile $TMPOUT ${{SPECULATIVE:+--speculative}}; then
+    PARTOUT=$OUTFILE.`hostname`.$$
+    mv $TMPOUT $PARTOUT
+    if ln $PARTOUT $OUTFILE 2>/dev/null; then
+        mv $TMPOUT.json $OUTFILE.json
+        python {runfile} --mark done --jobid $JOBID
+    else
+        echo Output of job $JOBID exists already, discarding this copy
+    fi
+    rm -f $PARTOUT
+elif [ ! -e $OUTFILE ]; then
+    python {runfile} --mark failed --jobid $JOBID ${{SPECULATIVE:+--speculative}}
+fi
+"""
+
+template_slurm = """#!/bin/zsh
+#SBATCH --job-name={project_tag}
+#SBATCH --time={hours}:00:00
+#SBATCH --mem={mem}G
+#SBATCH --output=/dev/null
+
+JOBID=$SLURM_ARRAY_TASK_ID
+exec > {folder_log}/{project_tag}$JOBID${{SPECULATIVE:+.spec}}.log 2>&1
+
+OUTFILE={folder_out}/{project_tag}$JOBID.out
+TMPOUT=${{TMPDIR:-/tmp}}/{project_tag}$JOBID.$SLURM_JOB_ID.tmp.out
+
+echo Starting job with options on
+echo `hostname`. Now is `date`
+
+source ~/.zshrc
+python {runfile} --mark running --jobid $JOBID ${{SPECULATIVE:+--speculative}}
+
+#Copy output to destination and record the final state in the job manifest
+#The output is hard linked, so of several copies of a job only the first one wins
+if python {runfile} -r --jobid $JOBID --outfile $TMPOUT ${{SPECULATIVE:+--speculative}}; then
+    PARTOUT=$OUTFILE.`hostname`.$$
+    mv $TMPOUT $PARTOUT
+    if ln $PARTOUT $OUTFILE 2>/dev/null; then
+        mv $TMPOUT.json $OUTFILE.json
+        python {runfile} --mark done --jobid $JOBID
+    else
+        echo Output of job $JOBID exists already, discarding this copy
+    fi
+    rm -f $PARTOUT
+elif [ ! -e $OUTFILE ]; then
+    python {runfile} --mark failed --jobid $JOBID ${{SPECULATIVE:+--speculative}}
+fi
+"""
+
+template_condor = """#!/bin/zsh
+# The job id and the condor job (cluster.process) are passed as arguments
+# by the submit description {subfile}.sub
+
+JOBID=$1
+exec > {folder_log}/{project_tag}$JOBID${{SPECULATIVE:+.spec}}.log 2>&1
+
+OUTFILE={folder_out}/{project_tag}$JOBID.out
+TMPOUT=${{_CONDOR_SCRATCH_DIR:-/tmp}}/{project_tag}$JOBID.$2.tmp.out
+
+echo Starting job with options on
+echo `hostname`. Now is `date`
+
+source ~/.zshrc
+python {runfile} --mark running --jobid $JOBID ${{SPECULATIVE:+--speculative}}
+
+#Copy output to destination and record the final state in the job manifest
+#The output is hard linked, so of several copies of a job only the first one wins
+if python {runfile} -r --jobid $JOBID --outfile $TMPOUT ${{SPECULATIVE:+--speculative}}; then
+    PARTOUT=$OUTFILE.`hostname`.$$
+    mv $TMPOUT $PARTOUT
+    if ln $PARTOUT $OUTFILE 2>/dev/null; then
+        mv $TMPOUT.json $OUTFILE.json
+        python {runfile} --mark done --jobid $JOBID
+    else
+        echo Output of job $JOBID exists already, discarding this copy
+    fi
+    rm -f $PARTOUT
+elif [ ! -e $OUTFILE ]; then
+    python {runfile} --mark failed --jobid $JOBID ${{SPECULATIVE:+--speculative}}
+fi
+"""
+
+template_condor_description = """executable = {subfile}
+arguments = $(JOBID) $(Cluster).$(Process)
+getenv = True
+request_memory = {mem} GB
++MaxRuntime = {seconds}
+batch_name = {project_tag}
+output = /dev/null
+error = /dev/null
+log = {folder_log}/{project_tag}.condor.log
+"""
+
+
+def array_spec(jobids):
+    """Collapses job ids into a compact array specification like '1-5,7,9-12'"""
+    import itertools
+
+    jobids = sorted(set(int(jobid) for jobid in jobids))
+    res = []
+    for _, group in itertools.groupby(enumerate(jobids), lambda x: x[1] - x[0]):
+        group = list(group)
+        first, last = group[0][1], group[-1][1]
+        res.append("{:}-{:}".format(first, last) if first != last else str(first))
+    return ",".join(res)
+
+
+class Scheduler(ABC):
+    """Base class for the scheduler backends
+
+    Derived classes define the submit template and build the command
+    that submits a list of job ids as a single job array
+    """
+
+    name = None
+    template = None
+
+    def write_submit_file(self, subfile, **kwargs):
+        """Writes the submit script for a project"""
+        with open(subfile, "w") as thefile:
+            thefile.write(self.template.format(subfile=subfile, **kwargs))
+
+    @abstractmethod
+    def submit_command(self, subfile, jobids):
+        """Command (list of arguments) submitting jobids as a single array"""
+
+    def submit(self, subfile, jobids, env=None):
+        """Submits all jobids with a single call to the scheduler
+
+        env is a dict of environment variables passed to the jobs
+        """
+        jobids = sorted(set(int(jobid) for jobid in jobids))
+        if len(jobids) == 0:
+            print("No jobs to submit")
+            return None
+        cmd = self.submit_command(subfile, jobids)
+        if env:
+            cmd = self.add_env(cmd, env)
+        print(("submitting {:} jobs: {:}".format(len(jobids), array_spec(jobids))))
+        return self._call(cmd, env)
+
+    def add_env(self, cmd, env):
+        """Adds env to the submit command, by default it is inherited by the jobs"""
+        return cmd
+
+    def _call(self, cmd, env=None):
+        import os
+
+        if env:
+            env = dict(os.environ, **env)
+        return subprocess.call(cmd, env=env)
+
+    def queue_length(self, name):
+        """Number of array tasks of the job name waiting or running
+
+        Returns None, if the scheduler cannot be queried
+        """
+        return None
+
+    def _query(self, cmd):
+        """Output lines of a scheduler query, None if it failed"""
+        try:
+            output = subprocess.check_output(cmd, universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(("Cannot query the scheduler:", e))
+            return None
+        return [line for line in output.splitlines() if line.strip()]
+
+    def _write_joblist(self, subfile, jobids):
+        """Writes the job ids to a file next to the submit file, one per line"""
+        import os
+        import tempfile
+
+        fd, listfile = tempfile.mkstemp(
+            prefix="jobs_", suffix=".ids", dir=path.dirname(path.abspath(subfile))
+        )
+        with os.fdopen(fd, "w") as thefile:
+            thefile.write("\n".join(str(jobid) for jobid in jobids) + "\n")
+        return listfile
+
+
+class SGEScheduler(Scheduler):
+    """Univa/Sun grid engine, submits with qsub -t"""
+
+    name = "sge"
+    template = template_sge
+
+    def add_env(self, cmd, env):
+        # qsub does not pass the environment, unless it is given by -v
+        extra = []
+        for key, value in env.items():
+            extra += ["-v", "{:}={:}".format(key, value)]
+        return cmd[:1] + extra + cmd[1:]
+
+    def queue_length(self, name):
+        import xml.etree.ElementTree as ElementTree
+
+        lines = self._query(["qstat", "-xml"])
+        if lines is None:
+            return None
+        count = 0
+        for job in ElementTree.fromstring("\n".join(lines)).iter("job_list"):
+            if job.findtext("JB_name") != name:
+                continue
+            # running tasks are listed one by one, pending ones as ranges a-b:s
+            tasks = job.findtext("tasks")
+            if not tasks:
+                count += 1
+                continue
+            for part in tasks.split(","):
+                if "-" in part:
+                    first, rest = part.split("-")
+                    last, _, step = rest.partition(":")
+                    count += (int(last) - int(first)) // int(step or 1) + 1
+                else:
+                    count += 1
+        return count
+
+    def submit_command(self, subfile, jobids):
+        if jobids[-1] - jobids[0] + 1 == len(jobids):
+            # contiguous range, the array task ids are the job ids
+            return ["qsub", "-t", "{:}-{:}".format(jobids[0], jobids[-1]), subfile]
+        else:
+            # qsub -t only accepts a single range, so the task ids are
+            # mapped to the job ids by a list file read in the submit script
+            listfile = self._write_joblist(subfile, jobids)
+            return [
+                "qsub",
+                "-t",
+                "1-{:}".format(len(jobids)),
+                "-v",
+                "JOBLIST={:}".format(listfile),
+                subfile,
+            ]
+
+
+class SlurmScheduler(Scheduler):
+    """Slurm, submits with sbatch --array"""
+
+    name = "slurm"
+    template = template_slurm
+
+    def submit_command(self, subfile, jobids):
+        return ["sbatch", "--array={:}".format(array_spec(jobids)), subfile]
+
+    def queue_length(self, name):
+        import getpass
+
+        # -r lists each array task on its own line
+        lines = self._query(
+            ["squeue", "-h", "-r", "-u", getpass.getuser(), "-n", name, "-o", "%i"]
+        )
+        return None if lines is None else len(lines)
+
+
+class CondorScheduler(Scheduler):
+    """HTCondor, submits with condor_submit reading the job ids from a list file"""
+
+    name = "condor"
+    template = template_condor
+
+    def write_submit_file(self, subfile, **kwargs):
+        Scheduler.write_submit_file(self, subfile, **kwargs)
+        with open(subfile + ".sub", "w") as thefile:
+            thefile.write(
+                template_condor_description.format(
+                    subfile=subfile, seconds=int(kwargs["hours"]) * 3600, **kwargs
+                )
+            )
+
+    def submit_command(self, subfile, jobids):
+        listfile = self._write_joblist(subfile, jobids)
+        return [
+            "condor_submit",
+            subfile + ".sub",
+            "-queue",
+            "JOBID from {:}".format(listfile),
+        ]
+
+    def queue_length(self, name):
+        lines = self._query(
+            [
+                "condor_q",
+                "-constraint",
+                'JobBatchName == "{:}"'.format(name),
+                "-af",
+                "ProcId",
+            ]
+        )
+        return None if lines is None else len(lines)
+
+
+class DryRunScheduler(Scheduler):
+    """Fake backend, records the submissions instead of calling a scheduler
+
+    Uses the SGE submit template, so the created project files are identical.
+    The submitted job ids stay in queue until they are removed by finish,
+    which allows to run the JobController without a cluster.
+    """
+
+    name = "dryrun"
+    template = template_sge
+
+    def __init__(self):
+        self.calls = []
+        self.submitted = []
+        self.queue = []
+
+    def queue_length(self, name):
+        return len(self.queue)
+
+    def finish(self, jobids=None):
+        """Removes jobids (all if None) from the queue, returns the removed ones"""
+        if jobids is None:
+            jobids = list(self.queue)
+        jobids = set(jobids)
+        self.queue = [jobid for jobid in self.queue if jobid not in jobids]
+        return sorted(jobids)
+
+    def submit_command(self, subfile, jobids):
+        return ["submit", "--array={:}".format(array_spec(jobids)), subfile]
+
+    def submit(self, subfile, jobids, env=None):
+        jobids = sorted(set(int(jobid) for jobid in jobids))
+        self.submitted.extend(jobids)
+        self.queue.extend(jobids)
+        return Scheduler.submit(self, subfile, jobids, env=env)
+
+    def add_env(self, cmd, env):
+        return SGEScheduler.add_env(self, cmd, env)
+
+    def _call(self, cmd, env=None):
+        print(("dry run:", " ".join(cmd)))
+        self.calls.append(cmd)
+        return 0
+
+
+schedulers = {
+    cls.name: cls
+    for cls in [SGEScheduler, SlurmScheduler, CondorScheduler, DryRunScheduler]
+}
+
+
+def get_scheduler(scheduler):
+    """Returns a scheduler instance from a name, a class or an instance"""
+    if isinstance(scheduler, Scheduler):
+        return scheduler
+    elif isinstance(scheduler, type) and issubclass(scheduler, Scheduler):
+        return scheduler()
+    elif scheduler in schedulers:
+        return schedulers[scheduler]()
+    else:
+        raise Exception(
+            "Unknown scheduler {:}, choose one of {:}".format(
+                scheduler, list(schedulers.keys())
+            )
+        )
@@ -0,0 +1,147 @@
+"""Node-shared cache of large pickled setup objects
+
+Unpickling a PriNCe kernel (e.g. prince_run_xxx.ppo) in every job costs time
+and a private copy of several GB per process. load_shared converts the pickle
+once per node into a directory in /dev/shm: the large numpy arrays are saved
+as .npy files, the rest of the object as a small pickle referring to them.
+All later processes on the node load the small pickle and memory-map the
+arrays, so the pages are shared between them.
+
+The cache is keyed by the path, size and modification time of the pickle.
+Its memory is only freed by clear_cache (or a reboot of the node).
+"""
+
+import os
+import os.path as path
+import pickle as pickle
+
+import numpy as np
+
+
+def default_cachedir():
+    """/dev/shm if available, otherwise the temporary folder"""
+    import tempfile
+
+    if path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def _cache_folder(filepath, cachedir):
+    import hashlib
+
+    filepath = path.abspath(filepath)
+    stat = os.stat(filepath)
+    key = "{:}:{:}:{:}".format(filepath, stat.st_size, stat.st_mtime_ns)
+    name = "prince_setup_" + hashlib.sha1(key.encode()).hexdigest()[:16]
+    return path.join(cachedir, name)
+
+
+class _ArrayPickler(pickle.Pickler):
+    """Stores numpy arrays larger than min_bytes as .npy files in folder"""
+
+    def __init__(self, thefile, folder, min_bytes):
+        pickle.Pickler.__init__(self, thefile, protocol=pickle.HIGHEST_PROTOCOL)
+        self.folder = folder
+        self.min_bytes = min_bytes
+        self.saved = {}
+
+    def persistent_id(self, obj):
+        if (
+            type(obj) is not np.ndarray
+            or obj.dtype.hasobject
+            or obj.nbytes < self.min_bytes
+        ):
+            return None
+        # pickle checks persistent ids before its memo, keep shared arrays shared
+        if id(obj) not in self.saved:
+            name = "array{:}.npy".format(len(self.saved))
+            np.save(path.join(self.folder, name), obj, allow_pickle=False)
+            self.saved[id(obj)] = (name, obj)
+        return self.saved[id(obj)][0]
+
+
+class _ArrayUnpickler(pickle.Unpickler):
+    """Memory-maps the arrays stored by _ArrayPickler"""
+
+    def __init__(self, thefile, folder, mmap_mode):
+        pickle.Unpickler.__init__(self, thefile)
+        self.folder = folder
+        self.mmap_mode = mmap_mode
+        self.loaded = {}
+
+    def persistent_load(self, pid):
+        if pid not in self.loaded:
+            self.loaded[pid] = np.load(
+                path.join(self.folder, pid), mmap_mode=self.mmap_mode
+            )
+        return self.loaded[pid]
+
+
+def _convert(filepath, folder, min_bytes):
+    """Writes the cache folder, the index pickle is written last"""
+    import shutil
+
+    with open(filepath, "rb") as thefile:
+        obj = pickle.load(thefile)
+    tmpfolder = folder + ".tmp{:}".format(os.getpid())
+    os.makedirs(tmpfolder)
+    try:
+        with open(path.join(tmpfolder, "index.pkl"), "wb") as thefile:
+            _ArrayPickler(thefile, tmpfolder, min_bytes).dump(obj)
+        os.rename(tmpfolder, folder)
+    except:  # noqa: E722
+        shutil.rmtree(tmpfolder, ignore_errors=True)
+        raise
+
+
+def load_shared(filepath, cachedir=None, min_bytes=2**20, mmap_mode="c"):
+    """Loads a pickled setup object through the node-shared cache
+
+    The first process on a node converts the pickle, holding a file lock,
+    the others wait and then attach to the cache. Arrays of at least
+    min_bytes are memory-mapped with mmap_mode, 'c' (copy-on-write, the
+    default) allows to modify them privately, 'r' makes them read-only.
+    If the cache cannot be written (e.g. /dev/shm is full), the pickle is
+    loaded as usual.
+    """
+    import fcntl
+
+    cachedir = default_cachedir() if cachedir is None else cachedir
+    folder = _cache_folder(filepath, cachedir)
+
+    with open(folder + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not path.exists(folder):
+                print(("converting {:} to shared cache {:}".format(filepath, folder)))
+                _convert(filepath, folder, min_bytes)
+            cached = True
+        except (IOError, OSError) as e:
+            print(("Cannot write setup cache, loading without it:", e))
+            cached = False
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    if not cached:
+        with open(filepath, "rb") as thefile:
+            return pickle.load(thefile)
+    with open(path.join(folder, "index.pkl"), "rb") as thefile:
+        return _ArrayUnpickler(thefile, folder, mmap_mode).load()
+
+
+def clear_cache(filepath=None, cachedir=None):
+    """Removes the cache of filepath, or all setup caches in cachedir"""
+    import glob
+    import shutil
+
+    cachedir = default_cachedir() if cachedir is None else cachedir
+    if filepath is not None:
+        pattern = _cache_folder(filepath, cachedir) + "*"
+    else:
+        pattern = path.join(cachedir, "prince_setup_*")
+    for entry in glob.glob(pattern):
+        if path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        else:
+            os.remove(entry)
@@ -0,0 +1,133 @@
+"""Shared task queue for dynamic load balancing of the grid points
+
+Instead of computing the fixed slice perm_slice(jobid), each array task
+claims small batches of grid points from an SQLite database on the shared
+filesystem until the queue is empty. Claimed grid points are leased, the
+lease is renewed after each finished grid point. Grid points of crashed
+tasks are claimed again once their lease has expired.
+
+Note: WAL mode needs shared memory between the processes accessing the
+database. On network filesystems without this support, set the journal
+mode to 'delete'.
+"""
+
+import sqlite3
+import time
+
+PENDING, LEASED, DONE = 0, 1, 2
+
+
+class TaskQueue(object):
+    def __init__(self, dbpath, lease=3600.0, journal_mode="wal", timeout=600.0):
+        self.dbpath = dbpath
+        self.lease = lease
+        self.journal_mode = journal_mode
+        self.timeout = timeout
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(
+                self.dbpath, timeout=self.timeout, isolation_level=None
+            )
+            self._conn.execute("PRAGMA journal_mode={:}".format(self.journal_mode))
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS tasks (
+                    pos INTEGER PRIMARY KEY,
+                    state INTEGER NOT NULL DEFAULT 0,
+                    owner TEXT,
+                    lease_until REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0
+                )""")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, lease_until)"
+            )
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def populate(self, npoints):
+        """Fills the queue with the positions 0 ... npoints - 1, if it is empty"""
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            (count,) = conn.execute("SELECT COUNT(*) FROM tasks").fetchone()
+            if count == 0:
+                conn.executemany(
+                    "INSERT INTO tasks (pos) VALUES (?)",
+                    ((pos,) for pos in range(npoints)),
+                )
+            elif count != npoints:
+                raise Exception(
+                    "Task queue {:} has {:} entries, expected {:}".format(
+                        self.dbpath, count, npoints
+                    )
+                )
+            conn.execute("COMMIT")
+        except:  # noqa: E722
+            conn.execute("ROLLBACK")
+            raise
+
+    def claim(self, owner, batch):
+        """Leases up to batch pending (or expired) positions to owner"""
+        conn = self.conn
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                """SELECT pos FROM tasks
+                WHERE state = ? OR (state = ? AND lease_until < ?)
+                ORDER BY pos LIMIT ?""",
+                (PENDING, LEASED, now, batch),
+            ).fetchall()
+            positions = [row[0] for row in rows]
+            conn.executemany(
+                """UPDATE tasks SET state = ?, owner = ?, lease_until = ?,
+                attempts = attempts + 1 WHERE pos = ?""",
+                [(LEASED, owner, now + self.lease, pos) for pos in positions],
+            )
+            conn.execute("COMMIT")
+        except:  # noqa: E722
+            conn.execute("ROLLBACK")
+            raise
+        return positions
+
+    def renew(self, owner):
+        """Extends the leases of all positions held by owner"""
+        self.conn.execute(
+            "UPDATE tasks SET lease_until = ? WHERE owner = ? AND state = ?",
+            (time.time() + self.lease, owner, LEASED),
+        )
+
+    def complete(self, positions):
+        """Marks positions as done"""
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "UPDATE tasks SET state = ? WHERE pos = ?",
+            [(DONE, int(pos)) for pos in positions],
+        )
+        conn.execute("COMMIT")
+
+    def counts(self):
+        """Number of pending, leased (split by expired) and done positions"""
+        now = time.time()
+        res = {"pending": 0, "leased": 0, "expired": 0, "done": 0}
+        for state, expired, count in self.conn.execute(
+            """SELECT state, lease_until < ?, COUNT(*) FROM tasks
+            GROUP BY state, lease_until < ?""",
+            (now, now),
+        ):
+            if state == PENDING:
+                res["pending"] += count
+            elif state == DONE:
+                res["done"] += count
+            elif expired:
+                res["expired"] += count
+            else:
+                res["leased"] += count
+        return res
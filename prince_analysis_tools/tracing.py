@@ -0,0 +1,187 @@
+"""Opt-in tracing of the stages of the jobs
+
+With the environment variable PRINCE_TRACE or config['trace'] set, each job
+records nested, timed spans (setup, grid points, the solver per species,
+the interpolators, the Minuit starts, writing the output) and writes them
+as Chrome trace JSON, which can be opened in Perfetto (ui.perfetto.dev) or
+chrome://tracing. PRINCE_TRACE=1 or config['trace'] = True write to the
+'trace' folder of the project, any other value is used as folder.
+
+Without a started tracer, span() does nothing, so the instrumented code
+runs as before. summarize_traces merges the traces of all jobs into the
+total and self time (without nested spans) per span name.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+_tracer = None
+
+
+class Tracer(object):
+    """Collects the spans of one job and writes them to filepath"""
+
+    def __init__(self, filepath, metadata=None):
+        self.filepath = filepath
+        self.metadata = {} if metadata is None else metadata
+        self.events = []
+        self.pid = os.getpid()
+
+    def add(self, name, start, end, attrs):
+        self.events.append(
+            {
+                "name": name,
+                "ph": "X",
+                "ts": start * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": self.pid,
+                "tid": threading.get_ident() % 2**31,
+                "args": attrs,
+            }
+        )
+
+    def write(self):
+        """Writes the spans recorded so far as Chrome trace JSON"""
+        name = "job {:}".format(self.metadata.get("jobid", self.pid))
+        events = [
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": self.pid,
+                "args": {"name": name},
+            }
+        ] + self.events
+        tmpfile = self.filepath + ".tmp"
+        with open(tmpfile, "w") as thefile:
+            json.dump(
+                {"traceEvents": events, "otherData": self.metadata},
+                thefile,
+                default=_to_json,
+            )
+        os.replace(tmpfile, self.filepath)
+
+
+def _to_json(obj):
+    """Span attributes, which are not json types (numpy scalars, tuples)"""
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    return str(obj)
+
+
+def trace_folder(default):
+    """Folder for the traces from PRINCE_TRACE, default if it is '1'
+
+    Returns None if PRINCE_TRACE is not set
+    """
+    value = os.environ.get("PRINCE_TRACE", "")
+    if value in ["", "0"]:
+        return None
+    return default if value == "1" else value
+
+
+def start(filepath, **metadata):
+    """Starts recording the spans of a job, replaces a running tracer"""
+    global _tracer
+    _tracer = Tracer(filepath, metadata)
+    return _tracer
+
+
+def stop():
+    """Writes the trace of the running tracer and stops recording"""
+    global _tracer
+    if _tracer is not None:
+        _tracer.write()
+    _tracer = None
+
+
+def enabled():
+    return _tracer is not None
+
+
+@contextmanager
+def span(name, **attrs):
+    """Records the enclosed code as span with the attributes attrs
+
+    Yields the dict of attributes, so that results can be added to it.
+    """
+    if _tracer is None:
+        yield attrs
+        return
+    tracer = _tracer
+    begin = time.time()
+    try:
+        yield attrs
+    finally:
+        tracer.add(name, begin, time.time(), attrs)
+
+
+def read_trace(filepath):
+    """Events and metadata of a trace written by Tracer"""
+    with open(filepath) as thefile:
+        trace = json.load(thefile)
+    return trace["traceEvents"], trace.get("otherData", {})
+
+
+def self_times(events):
+    """Time (us) of each span without the spans nested in it
+
+    events are the complete ('X') events of a trace, the nesting is found
+    per process and thread from the start and end times.
+    """
+    children = [0.0] * len(events)
+    order = sorted(
+        range(len(events)),
+        key=lambda i: (
+            events[i]["pid"],
+            events[i]["tid"],
+            events[i]["ts"],
+            -events[i]["dur"],
+        ),
+    )
+    stack = []
+    for i in order:
+        event = events[i]
+        thread = event["pid"], event["tid"]
+        while stack and (
+            (events[stack[-1]]["pid"], events[stack[-1]]["tid"]) != thread
+            or events[stack[-1]]["ts"] + events[stack[-1]]["dur"] <= event["ts"]
+        ):
+            stack.pop()
+        if stack:
+            children[stack[-1]] += event["dur"]
+        stack.append(i)
+    return [event["dur"] - child for event, child in zip(events, children)]
+
+
+def summarize_traces(filepaths, merged=None):
+    """Hot spots of the traces of several jobs
+
+    Returns a dict {span name: {'count', 'total', 'self', 'max'}} with the
+    times in seconds, 'self' without the nested spans. With merged, all
+    traces are written to this file with one process per job.
+    """
+    summary = {}
+    all_events = []
+    for filepath in filepaths:
+        events, metadata = read_trace(filepath)
+        spans = [event for event in events if event["ph"] == "X"]
+        for event, own in zip(spans, self_times(spans)):
+            entry = summary.setdefault(
+                event["name"], {"count": 0, "total": 0.0, "self": 0.0, "max": 0.0}
+            )
+            entry["count"] += 1
+            entry["total"] += event["dur"] / 1e6
+            entry["self"] += own / 1e6
+            entry["max"] = max(entry["max"], event["dur"] / 1e6)
+        if merged is not None:
+            # the pids of different hosts can collide, use the job id instead
+            pid = metadata.get("jobid", len(all_events))
+            for event in events:
+                all_events.append(dict(event, pid=pid))
+    if merged is not None:
+        with open(merged, "w") as thefile:
+            json.dump({"traceEvents": all_events}, thefile)
+    return summary
@@ -0,0 +1,161 @@
+import asyncio
+import os.path as path
+
+import numpy as np
+import pytest
+
+from prince_analysis_tools.cluster import PropagationProject
+from prince_analysis_tools.daemon import JobController
+from prince_analysis_tools.manifest import QUEUED, RUNNING, DONE, FAILED
+
+
+def setup():
+    return None
+
+
+def single_run(setup, perm):
+    return float(sum(perm)), None, None
+
+
+@pytest.fixture
+def make_project(tmp_path):
+    def make(njobs=4):
+        conf = {
+            "project_tag": "test",
+            "targetdir": str(tmp_path),
+            "inputpath": __file__,
+            "paramlist": (("a", np.arange(4.0)), ("b", np.arange(2.0))),
+            "njobs": njobs,
+            "setup_func": setup,
+            "single_run_func": single_run,
+            "scheduler": "dryrun",
+        }
+        project = PropagationProject(conf)
+        project.setup_project()
+        return project
+
+    return make
+
+
+def step(controller):
+    """Runs JobController.step and waits for a collection it started"""
+
+    async def main():
+        status = await controller.step()
+        if controller._collect_task is not None:
+            await controller._collect_task
+        return status
+
+    return asyncio.run(main())
+
+
+def run_job(project, jobid, state=DONE):
+    """Records a run of jobid in the manifest as the submit script does"""
+    project.manifest.mark(jobid, RUNNING)
+    if state == DONE:
+        project.run_subset(
+            jobid, path.join(project.folder_out, project.outfile(jobid)), setup()
+        )
+    project.manifest.mark(jobid, state)
+
+
+def test_throttle(make_project):
+    project = make_project(njobs=5)
+    scheduler = project.scheduler
+    controller = JobController(project, max_queued=2, poll_interval=0.0)
+
+    status = step(controller)
+    assert scheduler.submitted == [1, 2]
+    assert status["in flight"] == 2
+    assert status["waiting"] == 3
+    assert project.manifest.jobs([QUEUED]) == [1, 2]
+
+    # the queue is full, nothing is submitted
+    step(controller)
+    assert scheduler.submitted == [1, 2]
+
+    # a finished job frees a place in the queue
+    run_job(project, 1)
+    scheduler.finish([1])
+    step(controller)
+    assert scheduler.submitted == [1, 2, 3]
+
+
+def test_retry_budget(make_project):
+    project = make_project(njobs=1)
+    scheduler = project.scheduler
+    controller = JobController(project, max_retries=1, poll_interval=0.0)
+
+    step(controller)
+    for _ in range(2):
+        run_job(project, 1, FAILED)
+        scheduler.finish()
+        status = step(controller)
+    # the first failure is retried, the second one uses up the budget
+    assert scheduler.submitted == [1, 1]
+    assert status["failed"] == [1]
+    assert status["finished"]
+    assert project.manifest.info(1)["attempts"] == 2
+
+
+def test_lost_job(make_project):
+    project = make_project(njobs=1)
+    scheduler = project.scheduler
+    controller = JobController(project, poll_interval=0.0)
+
+    step(controller)
+    project.manifest.mark(1, RUNNING)
+    # the job leaves the queue without recording its final state
+    scheduler.finish()
+    step(controller)
+    assert scheduler.submitted == [1, 1]
+    assert project.manifest.info(1)["state"] == QUEUED
+
+
+def test_auto_collect(make_project):
+    project = make_project(njobs=4)
+    scheduler = project.scheduler
+    controller = JobController(project, poll_interval=0.0, collect_every=3)
+    collections = []
+
+    async def collect(done):
+        collections.append(sorted(done))
+        controller.collected |= done
+
+    controller._collect = collect
+
+    step(controller)
+    for jobid in [1, 2]:
+        run_job(project, jobid)
+        step(controller)
+    assert collections == []
+
+    run_job(project, 3)
+    step(controller)
+    assert collections == [[1, 2, 3]]
+
+    # the last job is collected once all are done, however few are new
+    run_job(project, 4)
+    scheduler.finish()
+    status = step(controller)
+    assert status["finished"]
+    assert collections == [[1, 2, 3], [1, 2, 3, 4]]
+
+
+def test_resubmit_valid_output(make_project):
+    project = make_project(njobs=2)
+    scheduler = project.scheduler
+    controller = JobController(project, poll_interval=0.0)
+
+    step(controller)
+    run_job(project, 1)
+    run_job(project, 2)
+    # the job wrote its output, but recording the end failed
+    project.manifest.mark(1, FAILED)
+    scheduler.finish()
+
+    status = step(controller)
+    assert scheduler.submitted == [1, 2]
+    assert project.manifest.info(1)["state"] == DONE
+    assert status["done"] == 1
+    assert status["in flight"] == 0
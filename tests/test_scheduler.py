@@ -0,0 +1,139 @@
+import os
+import os.path as path
+import shutil
+import subprocess
+
+import pytest
+
+from prince_analysis_tools.scheduler import (
+    CondorScheduler,
+    DryRunScheduler,
+    Scheduler,
+    SGEScheduler,
+    SlurmScheduler,
+    array_spec,
+    get_scheduler,
+)
+
+submit_kwargs = {
+    "project_tag": "test",
+    "runfile": "run.py",
+    "folder_log": "log",
+    "folder_out": "out",
+    "hours": 3,
+    "mem": 2,
+}
+
+
+def read_lines(filepath):
+    with open(filepath) as thefile:
+        return thefile.read().split()
+
+
+def test_array_spec():
+    assert array_spec([1, 2, 3, 5, 7, 8]) == "1-3,5,7-8"
+    assert array_spec([8, 3, 2, 2, 1]) == "1-3,8"
+    assert array_spec([4]) == "4"
+    assert array_spec([]) == ""
+
+
+def test_get_scheduler():
+    assert isinstance(get_scheduler("slurm"), SlurmScheduler)
+    assert isinstance(get_scheduler(CondorScheduler), CondorScheduler)
+    scheduler = DryRunScheduler()
+    assert get_scheduler(scheduler) is scheduler
+    with pytest.raises(Exception, match="Unknown scheduler"):
+        get_scheduler("pbs")
+
+
+def test_submit_command_is_abstract():
+    class Incomplete(Scheduler):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_sge_contiguous(tmp_path):
+    subfile = str(tmp_path / "sub.sh")
+    assert SGEScheduler().submit_command(subfile, [3, 4, 5]) == [
+        "qsub",
+        "-t",
+        "3-5",
+        subfile,
+    ]
+
+
+def test_sge_joblist(tmp_path):
+    subfile = str(tmp_path / "sub.sh")
+    cmd = SGEScheduler().submit_command(subfile, [2, 5, 6, 9])
+    assert cmd[:3] == ["qsub", "-t", "1-4"]
+    assert cmd[3] == "-v" and cmd[-1] == subfile
+    listfile = cmd[4].partition("JOBLIST=")[2]
+    assert path.dirname(listfile) == str(tmp_path)
+    assert read_lines(listfile) == ["2", "5", "6", "9"]
+
+
+@pytest.mark.skipif(shutil.which("sed") is None, reason="needs sed")
+def test_sge_joblist_script(tmp_path):
+    """The submit script maps the array task ids to the job ids of the list"""
+    subfile = str(tmp_path / "sub.sh")
+    scheduler = SGEScheduler()
+    scheduler.write_submit_file(subfile, **submit_kwargs)
+    with open(subfile) as thefile:
+        script = thefile.read()
+    start = script.index('if [ -n "$JOBLIST" ]')
+    snippet = script[start : script.index("fi\n", start) + 3] + "echo $JOBID\n"
+
+    def jobid(env):
+        env = dict(env, PATH=os.environ["PATH"])
+        return subprocess.check_output(
+            ["sh", "-c", snippet], env=env, universal_newlines=True
+        ).strip()
+
+    listfile = scheduler.submit_command(subfile, [2, 5, 6, 9])[4].partition("=")[2]
+    assert jobid({"SGE_TASK_ID": "3", "JOBLIST": listfile}) == "6"
+    assert jobid({"SGE_TASK_ID": "3"}) == "3"
+
+
+def test_slurm_array(tmp_path):
+    subfile = str(tmp_path / "sub.sh")
+    assert SlurmScheduler().submit_command(subfile, [1, 2, 3, 7]) == [
+        "sbatch",
+        "--array=1-3,7",
+        subfile,
+    ]
+
+
+def test_condor(tmp_path):
+    subfile = str(tmp_path / "sub.sh")
+    scheduler = CondorScheduler()
+    scheduler.write_submit_file(subfile, **submit_kwargs)
+    with open(subfile + ".sub") as thefile:
+        description = thefile.read()
+    assert "executable = {:}\n".format(subfile) in description
+    assert "arguments = $(JOBID) $(Cluster).$(Process)\n" in description
+    assert "+MaxRuntime = 10800\n" in description
+
+    cmd = scheduler.submit_command(subfile, [4, 8])
+    assert cmd[:3] == ["condor_submit", subfile + ".sub", "-queue"]
+    assert read_lines(cmd[3].partition(" from ")[2]) == ["4", "8"]
+
+
+def test_dryrun_submit(tmp_path):
+    subfile = str(tmp_path / "sub.sh")
+    scheduler = DryRunScheduler()
+    assert scheduler.submit(subfile, []) is None
+    assert scheduler.submit(subfile, [3, 1, 2, 2]) == 0
+    assert scheduler.submit(subfile, [5], env={"SPECULATIVE": "1"}) == 0
+    assert scheduler.calls == [
+        ["submit", "--array=1-3", subfile],
+        ["submit", "-v", "SPECULATIVE=1", "--array=5", subfile],
+    ]
+    assert scheduler.submitted == [1, 2, 3, 5]
+    assert scheduler.queue_length("test") == 4
+
+    assert scheduler.finish([2, 5]) == [2, 5]
+    assert scheduler.queue == [1, 3]
+    assert scheduler.finish() == [1, 3]
+    assert scheduler.queue_length("test") == 0